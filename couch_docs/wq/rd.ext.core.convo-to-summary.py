@@ -4,6 +4,15 @@
 # Building the summary is expensive, but it means less work by the front end.
 # We also record we are dependent on any of the messages themselves changing,
 # so when as item is marked as 'unread', the summary changes accordingly.
+#
+# To avoid opening every schema of every message each time any message in a
+# long conversation changes, we also emit an 'rd.conv.summary-state' schema
+# for the conversation.  It holds a compact 'record' of what each message
+# contributes to the summary along with the revisions of the schemas the
+# record was built from.  Next time around we only open the messages whose
+# revisions have changed and rebuild the summary from the records.  If there
+# is no state, or most of the messages have changed anyway, we just do a
+# full rebuild.
 import itertools
 
 # keys are the schemas we need, values are the fields from this schema we
@@ -21,6 +30,10 @@ src_msg_schemas = {
     'rd.msg.attachment-summary': None,
 }
 
+# If more than this fraction of the messages in a conversation have changed
+# we don't bother with the previous state and just open everything.
+MAX_CHANGED_FRACTION = 0.5
+
 def build_summaries(to_summarize):
     for msg in to_summarize:
         msg_key = msg['rd.msg.body']['rd_key']
@@ -46,26 +59,115 @@ def build_summaries(to_summarize):
                     continue
         yield summary
 
-def build_summary(conv_id):
-    logger.debug('rebuilding conversation %r', conv_id)
-    # query to determine all messages in this convo.
-    result = open_view(viewId="msg_conversation_id", key=conv_id)
-    # the list of items we want.
+def open_messages(msg_keys):
+    # Returns a dict keyed by the hashable message key, with each value
+    # being a dict of the schemas for that message.
     wanted = []
-    for row in result['rows']:
-        msg_key = row['value']['rd_key']
+    for msg_key in msg_keys:
         for sch_id in src_msg_schemas:
             wanted.append((msg_key, sch_id))
 
     infos = [item for item in open_schemas(wanted) if item is not None]
-    all_msgs = []
+    ret = {}
     # turn them into a nested dictionary.
     for msg_key, item_gen in itertools.groupby(infos, lambda info: info['rd_key']):
         new = {}
         for item in item_gen:
-            if item is not None:
-                new[item['rd_schema_id']] = item
-        all_msgs.append(new)
+            new[item['rd_schema_id']] = item
+        ret[hashable_key(msg_key)] = new
+    return ret
+
+def make_record(msg_key, msg_info):
+    # Build the compact record of what this message contributes to the
+    # summary.
+    try:
+        grouping_tag = msg_info['rd.msg.grouping-tag']['tag']
+    except KeyError:
+        grouping_tag = None
+    record = {'id': msg_key,
+              'revs': dict((sid, info['_rev'])
+                           for sid, info in msg_info.iteritems()),
+              'grouping_tag': grouping_tag,
+              'good': False,
+              }
+    if 'rd.msg.body' not in msg_info:
+        return record
+    if 'rd.msg.deleted' in msg_info and msg_info['rd.msg.deleted']['deleted']:
+        return record
+    if 'rd.msg.archived' in msg_info and msg_info['rd.msg.archived']['archived']:
+        return record
+    # the message is good!
+    body_schema = msg_info['rd.msg.body']
+    identities = []
+    for field in ["to", "cc"]:
+        if field in body_schema:
+            identities.extend(body_schema[field])
+    try:
+        identities.append(body_schema['from'])
+    except KeyError:
+        pass # things like RSS feeds don't have a 'from'
+    record.update({
+        'good': True,
+        'unread': 'rd.msg.seen' not in msg_info or not msg_info['rd.msg.seen']['seen'],
+        'timestamp': body_schema['timestamp'],
+        'identities': identities,
+        # things like RSS feeds don't have a 'from_display'
+        'from_display': body_schema.get('from_display'),
+    })
+    return record
+
+def find_changed(msg_keys, prev_records):
+    # Returns the keys of the messages whose schemas have changed since
+    # the records were built.
+    keys = []
+    for msg_key in msg_keys:
+        for sch_id in src_msg_schemas:
+            keys.append(['key-schema_id', [msg_key, sch_id]])
+    result = open_view(keys=keys, reduce=False)
+    cur_revs = {}
+    for row in result['rows']:
+        val = row['value']
+        this = cur_revs.setdefault(hashable_key(val['rd_key']), {})
+        this[val['rd_schema_id']] = val['_rev']
+
+    changed = []
+    for msg_key in msg_keys:
+        hk = hashable_key(msg_key)
+        try:
+            prev_revs = prev_records[hk]['revs']
+        except KeyError:
+            changed.append(msg_key) # new to this conversation.
+            continue
+        if prev_revs != cur_revs.get(hk, {}):
+            changed.append(msg_key)
+    return changed
+
+def build_summary(conv_id, prev_records=None):
+    # query to determine all messages in this convo.
+    result = open_view(viewId="msg_conversation_id", key=conv_id)
+    msg_keys = [row['value']['rd_key'] for row in result['rows']]
+    to_open = msg_keys
+    if prev_records:
+        changed = find_changed(msg_keys, prev_records)
+        if len(changed) <= len(msg_keys) * MAX_CHANGED_FRACTION:
+            to_open = changed
+    if to_open is msg_keys:
+        logger.debug('rebuilding conversation %r', conv_id)
+    else:
+        logger.debug('updating conversation %r - %d of %d messages changed',
+                     conv_id, len(to_open), len(msg_keys))
+    msgs = open_messages(to_open)
+    opened = set(hashable_key(k) for k in to_open)
+
+    # Use the new record for messages we opened and the previous one for
+    # the rest.  Messages with no schemas at all are skipped.
+    records = []
+    for msg_key in msg_keys:
+        hk = hashable_key(msg_key)
+        if hk in msgs:
+            records.append(make_record(msg_key, msgs[hk]))
+        elif hk not in opened:
+            records.append(prev_records[hk])
 
     identities = set()
     from_display = []
@@ -76,49 +178,30 @@ def build_summary(conv_id):
     subject = None
     groups_with_unread = set()
     groups = set()
-    for msg_info in all_msgs:
-        try:
-            grouping_tag = msg_info['rd.msg.grouping-tag']['tag']
-        except KeyError:
-            grouping_tag = None
+    for record in records:
+        grouping_tag = record['grouping_tag']
         if grouping_tag is not None:
             groups.add(grouping_tag)
-        if 'rd.msg.body' not in msg_info:
+        if not record['good']:
             continue
-        if 'rd.msg.deleted' in msg_info and msg_info['rd.msg.deleted']['deleted']:
-            continue
-        if 'rd.msg.archived' in msg_info and msg_info['rd.msg.archived']['archived']:
-            continue
-        # the message is good!
-        good_msgs.append(msg_info)
-        if 'rd.msg.seen' not in msg_info or not msg_info['rd.msg.seen']['seen']:
-            unread.append(msg_info)
+        good_msgs.append(record)
+        if record['unread']:
+            unread.append(record)
             if grouping_tag is not None:
                 groups_with_unread.add(grouping_tag)
-        body_schema = msg_info['rd.msg.body']            
-        for field in ["to", "cc"]:
-            if field in body_schema:
-                for val in body_schema[field]:
-                    identities.add(tuple(val))
-        try:
-            identities.add(tuple(body_schema['from']))
-        except KeyError:
-            pass # things like RSS feeds don't have a 'from'
-        try:
-            fd = body_schema['from_display']
-            if (not fd in from_display_map):
-                from_display_map[fd] = 1
-                from_display.append(fd)
-        except KeyError:
-            pass # things like RSS feeds don't have a 'from_display'
-        if 'rd.msg.grouping-tag' in msg_info:
-            this_group = msg_info['rd.msg.grouping-tag']['tag']
-            this_ts = msg_info['rd.msg.body']['timestamp']
-            cur_latest = latest_by_recip_target.get(this_group, 0)
+        for val in record['identities']:
+            identities.add(tuple(val))
+        fd = record['from_display']
+        if fd is not None and not fd in from_display_map:
+            from_display_map[fd] = 1
+            from_display.append(fd)
+        if grouping_tag is not None:
+            this_ts = record['timestamp']
+            cur_latest = latest_by_recip_target.get(grouping_tag, 0)
             if this_ts > cur_latest:
-                latest_by_recip_target[this_group] = this_ts
+                latest_by_recip_target[grouping_tag] = this_ts
 
-    logger.debug('conversation has %d messages, %d good', len(all_msgs), len(good_msgs))
+    logger.debug('conversation has %d messages, %d good', len(records), len(good_msgs))
     # build a map of grouping-tag to group ID
     latest_by_grouping = {}
     result = open_view(viewId="grouping_info_tags",
@@ -133,24 +216,30 @@ def build_summary(conv_id):
         logger.debug('grouping-tag %r appears in grouping %r', gtag, gkey)
 
     # sort the messages so we can determine the first
-    good_msgs.sort(key=lambda item: item['rd.msg.body']['timestamp'])
-    unread.sort(key=lambda item: item['rd.msg.body']['timestamp'])
+    good_msgs.sort(key=lambda record: record['timestamp'])
+    unread.sort(key=lambda record: record['timestamp'])
 
     if good_msgs:
-        # We want the subject from the first (topic) message
-        subject = good_msgs[0]['rd.msg.body'].get('subject')
         num_summaries = 2 # not including the first...
         # and the summary to include the first, and prefer the last 2 unread
         # but if not enough unread, use the most recent read.
         # establish this order via sorting.
-        def key_fun(info):
-            is_unread = 'rd.msg.seen' not in info or not info['rd.msg.seen']['seen']
-            return (int(is_unread), info['rd.msg.body']['timestamp'])
+        def key_fun(record):
+            return (int(record['unread']), record['timestamp'])
         to_summarize = sorted(good_msgs[1:], key=key_fun)[-num_summaries:]
         # re-sort again based purely on timestamp.
-        to_summarize.sort(key=lambda info: info['rd.msg.body']['timestamp'])
+        to_summarize.sort(key=lambda record: record['timestamp'])
         # and the convo starter.
         to_summarize.insert(0, good_msgs[0])
+        # We need all the schemas for the messages we summarize - open any
+        # we didn't need to open above.
+        missing = [r['id'] for r in to_summarize
+                   if hashable_key(r['id']) not in msgs]
+        if missing:
+            msgs.update(open_messages(missing))
+        to_summarize = [msgs[hashable_key(r['id'])] for r in to_summarize]
+        # We want the subject from the first (topic) message
+        subject = to_summarize[0]['rd.msg.body'].get('subject')
     else:
         subject = None
         to_summarize = []
@@ -158,8 +247,8 @@ def build_summary(conv_id):
     item = {
         'subject': subject,
         'messages': list(build_summaries(to_summarize)),
-        'message_ids': [i['rd.msg.body']['rd_key'] for i in good_msgs],
-        'unread_ids': [i['rd.msg.body']['rd_key'] for i in unread],
+        'message_ids': [r['id'] for r in good_msgs],
+        'unread_ids': [r['id'] for r in unread],
         'identities': sorted(list(identities)),
         'from_display': from_display,
         'grouping-timestamp': [],
@@ -170,12 +259,16 @@ def build_summary(conv_id):
         item['grouping-timestamp'].append([target, timestamp])
     # our 'dependencies' are *all* messages, not just the "good" ones.
     deps = []
-    for msg in all_msgs:
-        # get the rd_key from any schema which exists
-        msg_key = list(msg.values())[0]['rd_key']
+    for record in records:
         for sid in src_msg_schemas:
-            deps.append((msg_key, sid))
-    return item, deps
+            deps.append((record['id'], sid))
+    return item, deps, records
+
+def open_prev_records(conv_id):
+    state = open_schemas([(conv_id, 'rd.conv.summary-state')])[0]
+    if state is None:
+        return None
+    return dict((hashable_key(r['id']), r) for r in state['messages'])
 
 def handler(doc):
     rd_source = [doc['_id'], doc['_rev']]
@@ -191,6 +284,19 @@ def later_handler(infos):
 
     # now build them.
     for cid, rd_source in cid_src.iteritems():
-        item, deps = build_summary(cid)
-        emit_schema('rd.conv.summary', item, rd_key=cid, rd_source=rd_source,
-                    deps=deps)
+        item, deps, records = build_summary(cid, open_prev_records(cid))
+        if not deps:
+            # no messages refer to this convo any more - it has been merged
+            # into another since we were asked to build it.
+            logger.debug('conversation %r has no messages - skipping', cid)
+            continue
+        summary_id = emit_schema('rd.conv.summary', item, rd_key=cid,
+                                 rd_source=rd_source, deps=deps)
+        # The state's source is the summary rather than a message - the
+        # pipeline deletes the items previously written for a source before
+        # calling us 'later', and the whole point of the state is that it
+        # survives until next time.  (It still needs a source, otherwise
+        # unprocess would leave it behind and reprocess would treat it as a
+        # raw message.)
+        emit_schema('rd.conv.summary-state', {'messages': records},
+                    rd_key=cid, rd_source=[summary_id, None], deps=[])
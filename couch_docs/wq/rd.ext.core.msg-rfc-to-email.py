@@ -24,7 +24,7 @@
 # This is an extension which converts a message/raw/rfc822 to a
 # message/raw/rfc822
 
-from email import message_from_string
+from email import message_from_file
 from email.utils import mktime_tz, parsedate_tz, unquote
 from email.header import decode_header
 import codecs
@@ -131,11 +131,10 @@ def attach_from_msg(attach_id, msg):
             'data': msg.get_payload(decode=True),
             }
     
-# Given a raw rfc822 message stream, return a list of useful schema instances
+# Given a parsed rfc822 message, return a list of useful schema instances
 # describing that message.
 # Returns a list of (schema_id, schema_fields) tuples.
-def doc_from_bytes(docid, rdkey, b):
-    msg = message_from_string(b)
+def doc_from_msg(docid, rdkey, msg):
     doc = {}
     mp = doc['multipart'] = msg.is_multipart()
     headers = doc['headers'] = {}
@@ -204,9 +203,14 @@ def doc_from_bytes(docid, rdkey, b):
 
 
 def handler(doc):
-    # I need the binary attachment.
-    content = open_schema_attachment(doc, "rfc822")
-    items, attachments = doc_from_bytes(doc['_id'], doc['rd_key'], content)
+    # I need the binary attachment - parse it as it is read rather than
+    # holding the raw message in memory as well.
+    stream = open_schema_attachment(doc, "rfc822", stream=True)
+    try:
+        msg = message_from_file(stream)
+    finally:
+        stream.close()
+    items, attachments = doc_from_msg(doc['_id'], doc['rd_key'], msg)
  
     # Get the timestamp for the message.   
     if 'headers' in items and 'date' in items['headers']:
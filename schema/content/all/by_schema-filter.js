@@ -0,0 +1,35 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Raindrop.
+ *
+ * The Initial Developer of the Original Code is
+ * Mozilla Messaging, Inc..
+ * Portions created by the Initial Developer are Copyright (C) 2009
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ * */
+
+// Used by the work queues to have the _changes feed only deliver documents
+// holding one of the schemas named in the (json encoded) 'schemas' param.
+function(doc, req) {
+  if (!doc.rd_schema_id || !req.query.schemas)
+    return false;
+  var schemas = JSON.parse(req.query.schemas);
+  for (var i = 0; i < schemas.length; i++) {
+    if (schemas[i] == doc.rd_schema_id)
+      return true;
+  }
+  return false;
+}
@@ -43,7 +43,9 @@ function(doc) {
                         'rd_key' : doc.rd_key,
                         'rd_schema_id' : doc.rd_schema_id,
                         'rd_ext_id': rd_ext_id,
-                        'rd_source': schema_item.rd_source
+                        'rd_source': schema_item.rd_source,
+                        // the version of the extension which wrote it.
+                        'rd_ext_fingerprint': schema_item.rd_ext_fingerprint
                         };
       emit(['ext_id', rd_ext_id], si_row_val);
       // don't emit the revision from the source in the key.
@@ -33,6 +33,8 @@ import optparse
 
 from raindrop import json
 from raindrop.config import get_config
+from raindrop import memcouch
+from raindrop import model
 from raindrop.proto.imap import MAX_MESSAGES_PER_FETCH
 
 from raindrop.tests import TestCaseWithCorpus, FakeOptions
@@ -62,6 +64,11 @@ class CorpusHelper(TestCaseWithCorpus):
 
 
 def make_corpus_helper(opts, **pipeline_opts):
+    if opts.in_memory:
+        # a fresh in-memory DB for each run - the name is hardcoded by the
+        # test-suite helpers we abuse.
+        memcouch.install('raindrop_test_suite')
+        model._doc_model = None
     tc = CorpusHelper(pipeline_opts)
     tc.setUp()
     if opts.enron_dir:
@@ -136,7 +143,7 @@ def profileit(func, *args):
 def report_db_state(db, opts):
     info = db.infoDB()
     print "DB has %(doc_count)d docs at seq %(update_seq)d in %(disk_size)d bytes" % info
-    if opts.couch_dir:
+    if opts.couch_dir and not opts.in_memory:
         # report what we find on disk about couch.
         dbname = 'raindrop_test_suite' # hardcoded by test-suite helpers we abuse.
         dbsize = os.path.getsize(os.path.join(opts.couch_dir, dbname + ".couch"))
@@ -191,6 +198,57 @@ def run_timings_sync(opts):
     tc.tearDown()
 
 
+def run_key_timings(opts):
+    # A micro-benchmark of building document IDs for schema items - an ID
+    # is asked for a number of times as each item makes its way to couch
+    # (by emit_schema, the queue runner, the writer and create_schema_items)
+    # and many items share an rd_key.
+    dm = model.DocumentModel
+    schemas = ['rd.msg.rfc822', 'rd.msg.email', 'rd.msg.body', 'rd.tags',
+               'rd.msg.flags']
+    keys = []
+    for i in range(1000):
+        keys.append(['email', '<%d.%d@example.com>' % (i, i * 7)])
+        keys.append(['identity', ['email', 'user%d@example.com' % i]])
+    num_items = len(keys) * len(schemas)
+    lookups = 4 # the number of times the ID of each item is needed.
+
+    def make_items():
+        return [{'rd_key': key, 'rd_schema_id': schema_id}
+                for key in keys for schema_id in schemas]
+
+    def encode_all(items):
+        # what every lookup used to cost.
+        for si in items:
+            for i in range(lookups):
+                model.encode_doc_id(si['rd_key'], si['rd_schema_id'])
+
+    def lookup_all(items):
+        for si in items:
+            for i in range(lookups):
+                dm.get_doc_id_for_schema_item(si)
+
+    def hash_all(items):
+        for si in items:
+            for i in range(lookups):
+                dm.hashable_key((si['rd_key'], si['rd_schema_id']))
+
+    print "Building document IDs for %d items, %d times each..." % \
+          (num_items, lookups)
+    for desc, func in (("encoded every time", encode_all),
+                       ("memoized (cold)", lookup_all),
+                       ("memoized (warm)", lookup_all),
+                       ("hashable keys", hash_all)):
+        if desc == "memoized (cold)":
+            dm.doc_id_cache = model.DocIdCache(dm.doc_id_cache.max_size)
+        items = make_items()
+        start = time.clock()
+        func(items)
+        took = time.clock() - start
+        print "  %s: %.3f (%.2fus per item)" % (desc, took,
+                                                took * 1000000 / num_items)
+
+
 def run_api_timings(opts):
     import httplib
     from urllib import urlencode    
@@ -244,8 +302,19 @@ the size on disk of the DB and views will be reported.""")
                       help="don't benchmark async processing")
     parser.add_option("", "--skip-api", action="store_true",
                       help="don't benchmark api processing")
+    parser.add_option("", "--skip-keys", action="store_true",
+                      help="don't benchmark building document IDs")
+    parser.add_option("", "--in-memory", action="store_true",
+                      help=
+"""Use an in-memory database rather than couchdb, so the timings measure
+raindrop itself rather than the couch server.  The API timings need a real
+couch, so are skipped.""")
     opts, args = parser.parse_args()
+    if opts.in_memory:
+        opts.skip_api = True
 
+    if not opts.skip_keys:
+        run_key_timings(opts)
     if not opts.skip_async:
         run_timings_async(opts)
     if not opts.skip_sync:
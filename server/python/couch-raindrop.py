@@ -49,6 +49,9 @@ Restart couch, then:
   ...
   % curl "http://127.0.0.1:5984/raindrop/_raindrop/status
   {"running":{},"finished":{"sync-messages":142}}
+  % curl "http://127.0.0.1:5984/raindrop/_raindrop/metrics
+  raindrop_ext_seen_total{ext="rd.ext.core.msg-rfc-to-email"} 142
+  ...
   % curl "http://127.0.0.1:5984/raindrop/_raindrop/exit
   {"result":"goodbye"}
 
@@ -76,6 +79,7 @@ from twisted.internet import interfaces
 from raindrop import model, opts, config, proto
 from raindrop.pipeline import Pipeline
 import raindrop.sync
+import raindrop.metrics
 
 logger = logging.getLogger('raindrop')
 
@@ -187,9 +191,15 @@ def status(req):
         running[key] = time.time() - started
     ret = {"code": 200, "json": {"running": running,
                                  "finished": finished_tasks,
-                                 "conductor": conductor.get_status_ob()}}
+                                 "conductor": conductor.get_status_ob(),
+                                 "metrics": raindrop.metrics.get_status_ob()}}
     return ret
 
+def metrics(req):
+    """the per-extension and per-view metrics in plain-text"""
+    return {"code": 200, "body": raindrop.metrics.format_text(),
+            "headers": {"Content-Type": "text/plain"}}
+
 
 def process_backlog(req):
     """process the work queues..."""
@@ -366,6 +376,9 @@ def main():
     
     reactor.callWhenRunning(d.callback, None)
     reactor.run()
+    if pipeline is not None:
+        # writes any extension profiles etc.
+        pipeline.finalize()
 
 if __name__ == "__main__":
     main()
@@ -38,6 +38,7 @@ import optparse
 from raindrop import json
 from raindrop import config
 from raindrop import model
+from raindrop import codecache
 
 # -- library code --
 # The short-term intention is to move to javascript based API implementations
@@ -369,10 +370,11 @@ def get_api_handler(options, req):
     if doc.get('content_type') != 'application/x-python' or not doc.get('code'):
         raise APILoadError("document is not a python implemented API (%s)", doc['content_type'])
 
-    # Now dynamically compile the code we loaded.
+    # Now dynamically compile the code we loaded - the compiled code is
+    # cached on disk, so only new or changed end-points are compiled.
     globs = api_globals.copy()
     try:
-        exec doc['code'] in globs
+        exec codecache.compile_source(doc['code'], "<%s>" % doc['_id']) in globs
     except Exception, exc:
         raise APILoadError("Failed to initialize api: %s", exc)
     handler = globs.get('handler')
@@ -593,11 +593,14 @@ def install_views(options, include_tests=False):
     if put_docs:
         get_db().updateDocuments(put_docs)
         # and update the views immediately...
-        get_doc_model()._update_important_views()
+        dm = get_doc_model()
+        dm.view_refresher.forget_views()
+        dm._update_important_views()
 
 
 def _build_views_doc_from_directory(ddir):
     # all we look for is the views.  And the lists.  And the shows :)
+    # And the filters for the _changes feed.
     ret = {}
     fprinter = Fingerprinter()
     ret_views = ret['views'] = {}
@@ -606,6 +609,7 @@ def _build_views_doc_from_directory(ddir):
     ltail = "-list"
     stail = "-show"
     rwtail = "-rewrites"
+    ftail = "-filter"
     optstail = "-options"
     files = os.listdir(ddir)
     for fn in files:
@@ -659,6 +663,19 @@ def _build_views_doc_from_directory(ddir):
                 logger.warning("can't open list file %r - skipping this list", fqf)
                 continue
 
+        tail = ftail + ".js"
+        if fn.endswith(tail):
+            filter_name = fn[:-len(tail)]
+            info = ret.setdefault('filters', {})
+            try:
+                with open(fqf) as f:
+                    data = f.read()
+                    info[filter_name] = data
+                    fprinter.get_finger(filter_name+tail).update(data)
+            except (OSError, IOError):
+                logger.warning("can't open filter file %r - skipping this filter", fqf)
+                continue
+
         tail = rwtail + ".js"
         if fn.endswith(tail):
             rewrite_name = fn[:-len(tail)]
@@ -21,10 +21,16 @@
 # Contributor(s):
 #
 
+from __future__ import with_statement
+
 import httplib
 import socket
 import errno
 import select
+import threading
+import time
+from urllib import quote
+from collections import deque
 from cStringIO import StringIO
 from raindrop import json
 
@@ -43,12 +49,27 @@ class ChangesIterFactory(object):
 
     All this is done from a single _changes feed connection.
     """
+    # The server-side filter used when only some schemas are wanted; it lives
+    # in the same design doc as the megaview.
+    SCHEMA_FILTER = "raindrop!content!all/by_schema"
+    # When include_docs is used, changes whose json is bigger than this have
+    # their doc discarded - the few queues which want it can fetch it, rather
+    # than having every queue's buffer hold it.
+    MAX_INLINE_DOC_SIZE = 64 * 1024
+
     def __init__(self):
         self.stopping = False
         self.current_seq = None
         self.is_waiting = False
         self.connection = None
         self.include_deps = False
+        self.filter_schemas = None
+        self.include_docs = False
+        # src_id -> doc for the docs which arrived with the changes yielded
+        # by the current make_iter.
+        self.inline_docs = {}
+        # called when we are about to block waiting for more changes.
+        self.waiting_callback = None
 
     def stop(self):
         self.stopping = True
@@ -61,8 +82,11 @@ class ChangesIterFactory(object):
             pass
         logger.debug('closed %r', self.connection.sock)
 
-    def initialize(self, doc_model, start_seq, include_deps=False):
+    def initialize(self, doc_model, start_seq, include_deps=False,
+                   filter_schemas=None, include_docs=False):
         self.include_deps = include_deps
+        self.filter_schemas = filter_schemas
+        self.include_docs = include_docs
         self.doc_model = doc_model
         self.current_seq = start_seq or 0
         # it isn't *necessary* to establish the connection yet, but we do
@@ -82,6 +106,31 @@ class ChangesIterFactory(object):
         last_change = change['changes'][-1]
         return change['id'], last_change['rev'], None, change['seq']
 
+    def _change_to_doc(self, change):
+        # The doc which came with the change, if any.
+        if 'error' in change or 'deleted' in change:
+            return None
+        return change.get('doc')
+
+    def _change_to_timestamp(self, change):
+        # The 'timestamp' of the doc which came with the change, even if the
+        # doc itself was too big to keep.
+        if 'doc_timestamp' in change:
+            return change['doc_timestamp']
+        doc = self._change_to_doc(change)
+        if doc is None:
+            return None
+        return doc.get('timestamp')
+
+    def _trim_change(self, change, size):
+        # Drop the doc from a change whose json is too big, keeping just
+        # what we need to know about it.
+        if 'doc' in change and size > self.MAX_INLINE_DOC_SIZE:
+            logger.debug('not inlining doc %r - %d bytes', change['id'], size)
+            change['doc_timestamp'] = change['doc'].get('timestamp')
+            del change['doc']
+        return change
+
     def _make_connection(self):
         db = self.doc_model.db
         # We abuse httplib to establish the connection and read the headers,
@@ -91,6 +140,13 @@ class ChangesIterFactory(object):
         # blank lines we can ignore on every heartbeat period.
         path = "/%s/_changes?feed=continuous&heartbeat=60000&since=%d" % \
                 (db.dbName, self.current_seq)
+        if self.filter_schemas is not None:
+            # have couch discard the changes nobody wants.
+            schemas = json.dumps(sorted(self.filter_schemas))
+            path += "&filter=%s&schemas=%s" % (self.SCHEMA_FILTER,
+                                               quote(schemas))
+        if self.include_docs:
+            path += "&include_docs=true"
         c.request("GET", path)
         self.connection = c
         self.response = c.getresponse()
@@ -140,6 +196,8 @@ class ChangesIterFactory(object):
                         return None
                     # blocking request - use select to work out when we are ready
                     self.is_waiting = True
+                    if self.waiting_callback is not None:
+                        self.waiting_callback()
                     logger.debug('selecting %r', self.connection.sock)
                     socks = [self.connection.sock, self.control_socket]
                     ready, _, _ = select.select(socks, [], [])
@@ -170,7 +228,7 @@ class ChangesIterFactory(object):
                 continue
             # it is good (in theory :)
             assert 'seq' in change, repr(line)
-            return change
+            return self._trim_change(change, len(line))
 
     def make_iter(self, batch_size):
         these_elts = []
@@ -179,9 +237,16 @@ class ChangesIterFactory(object):
         if change is None:
             return
 
+        # Refill the same dict rather than replacing it - our caller took a
+        # reference to it before the first change was read.
+        inline_docs = self.inline_docs
+        inline_docs.clear()
         self.current_seq = change['seq']
         elt = self._change_to_elt(change)
         if elt is not None:
+            doc = self._change_to_doc(change)
+            if doc is not None:
+                inline_docs[elt[0]] = doc
             these_elts.append(elt)
             yield elt
 
@@ -194,32 +259,436 @@ class ChangesIterFactory(object):
             self.current_seq = change['seq']
             elt = self._change_to_elt(change)
             if elt is not None:
+                doc = self._change_to_doc(change)
+                if doc is not None:
+                    inline_docs[elt[0]] = doc
                 these_elts.append(elt)
                 yield elt
 
         # no more _changes waiting or batch size hit.  Do deps.
         if self.include_deps:
-            # find any documents which declare they depend on the documents
-            # in the list, then lookup the "source" of that doc
-            # (ie, the one that "normally" triggers that doc to re-run)
-            # and return that source.
-            all_ids = set()
-            keys = []
-            for elt in these_elts:
-                src_id = elt[0]
-                all_ids.add(src_id)
-                try:
-                    _, rd_key, schema_id = self.doc_model.split_doc_id(src_id)
-                except ValueError:
-                    # not a raindrop document - ignore it.
+            for elt in iter_dependencies(self.doc_model, these_elts,
+                                         self.current_seq):
+                yield elt
+
+
+def iter_dependencies(doc_model, these_elts, current_seq):
+    """Generate the 'source' elements of documents which declare they depend
+    on the documents in these_elts.
+    """
+    # find any documents which declare they depend on the documents
+    # in the list, then lookup the "source" of that doc
+    # (ie, the one that "normally" triggers that doc to re-run)
+    # and return that source.
+    all_ids = set()
+    keys = []
+    for elt in these_elts:
+        src_id = elt[0]
+        all_ids.add(src_id)
+        try:
+            _, rd_key, schema_id = doc_model.split_doc_id(src_id)
+        except ValueError:
+            # not a raindrop document - ignore it.
+            continue
+        keys.append(["dep", [rd_key, schema_id]])
+    if keys:
+        results = doc_model.open_view(keys=keys, reduce=False)
+        rows = results['rows']
+        for row in rows:
+            src_id = row['value']['rd_source'][0]
+            if src_id not in all_ids:
+                yield src_id, None, None, current_seq
+
+
+class ChangesFeedMultiplexer(object):
+    """Fans a single _changes feed out to many ChangesCursor objects.
+
+    A single connection is made to the _changes feed (starting at the lowest
+    sequence any cursor needs) and a dedicated thread reads and parses each
+    change exactly once before appending it to the buffer of every cursor
+    which hasn't already seen it.  Each cursor tracks its own current_seq, so
+    each work queue is still checkpointed independently.
+
+    A cursor which falls too far behind is cut off rather than holding up
+    everyone else; once it has worked through what it was given it reads
+    the changes it missed itself, then rejoins the shared feed.
+    """
+    # The most changes buffered for one cursor.  Past this it stops being
+    # given changes and must refetch them.
+    MAX_BUFFERED = 5000
+
+    def __init__(self):
+        self.cursors = []
+        self.stopping = False
+        self.failure = None
+        self.last_seq = None
+        self.feed = None
+        self.include_docs = False
+        self.thread = None
+        self.doc_model = None
+        self.cond = threading.Condition()
+        # called whenever the feed or a cursor may have become idle.
+        self.idle_callback = None
+        # called when a cursor which had nothing buffered is given a change.
+        self.ready_callback = None
+        # Changes after this sequence (ie, those made since the latest sync
+        # started) and those for documents with a 'timestamp' less than
+        # priority_age seconds old go into each cursor's priority lane.
+        # The timestamps are only known if the feed includes the docs.
+        self.priority_seq = None
+        self.priority_age = None
+
+    def add_cursor(self, start_seq, include_deps=False, schemas=None):
+        """Add a new cursor which will see changes after start_seq.
+
+        If schemas is not None, the cursor only sees changes to documents
+        holding one of those schemas.
+        """
+        assert self.thread is None, "cursors must be added before starting"
+        cursor = ChangesCursor(self, start_seq or 0, include_deps, schemas)
+        self.cursors.append(cursor)
+        return cursor
+
+    def _build_routes(self):
+        # Build an index of schema_id -> cursors so each change is looked at
+        # once rather than once per cursor.  Cursors which want everything
+        # (including those which need every change to find dependencies)
+        # get every change.
+        self.routes = {}
+        self.all_routes = []
+        for cursor in self.cursors:
+            if cursor.schemas is None or cursor.include_deps:
+                self.all_routes.append(cursor)
+            else:
+                for schema_id in cursor.schemas:
+                    self.routes.setdefault(schema_id, []).append(cursor)
+
+    def start(self, doc_model, use_filter=False, include_docs=False):
+        """Start reading the feed.  If use_filter is True and no cursor needs
+        to see every change, a server-side filter is used so couch only sends
+        us changes for schemas some cursor is interested in.  If include_docs
+        is True, the documents come with the changes and are made available
+        via each cursor's inline_docs.
+        """
+        assert self.cursors, "no cursors to feed"
+        self.doc_model = doc_model
+        self._build_routes()
+        filter_schemas = None
+        if use_filter:
+            if self.all_routes:
+                logger.info("not filtering the _changes feed - %d queues need all changes",
+                            len(self.all_routes))
+            else:
+                filter_schemas = self.routes.keys()
+        start_seq = min(c.start_seq for c in self.cursors)
+        self.last_seq = start_seq
+        # a database may supply its own way of reading its changes.
+        feed_class = getattr(doc_model.db, 'ChangesFeed', ChangesIterFactory)
+        self.feed = feed_class()
+        self.include_docs = include_docs
+        self.feed.initialize(doc_model, start_seq,
+                             filter_schemas=filter_schemas,
+                             include_docs=include_docs)
+        self.feed.waiting_callback = self._notify_idle
+        # we see every change, so can keep the document cache honest.
+        doc_model.doc_cache.enable()
+        self.thread = threading.Thread(target=self._reader_thread)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        logger.debug('multiplexed _changes feed started at sequence %s for %d cursors',
+                     start_seq, len(self.cursors))
+
+    def stop(self):
+        if self.doc_model is not None:
+            self.doc_model.doc_cache.disable()
+        with self.cond:
+            self.stopping = True
+            for cursor in self.cursors:
+                cursor.stopping = True
+            self.cond.notifyAll()
+        if self.feed is not None:
+            self.feed.stop()
+
+    def _notify_idle(self):
+        if self.idle_callback is not None:
+            self.idle_callback()
+
+    def idle_seq(self):
+        """Returns the sequence we have read to if the feed has no more
+        changes and every cursor has consumed everything given to it, or None
+        if anyone still has work to do.
+        """
+        with self.cond:
+            if self.feed is None or not self.feed.is_waiting:
+                return None
+            for cursor in self.cursors:
+                if cursor.stopping:
                     continue
-                keys.append(["dep", [rd_key, schema_id]])
-            if keys:
-                results = self.doc_model.open_view(keys=keys, reduce=False)
-                rows = results['rows']
-                # Find all unique IDs.
-                result_seq = set()
-                for row in rows:
-                    src_id = row['value']['rd_source'][0]
-                    if src_id not in all_ids:
-                        yield src_id, None, None, self.current_seq
+                if cursor.num_buffered() or not cursor.is_waiting or \
+                   cursor.refetch_seq is not None:
+                    return None
+            return self.last_seq
+
+    def _is_priority(self, seq, change):
+        if self.priority_seq is not None and seq > self.priority_seq:
+            return True
+        if self.priority_age:
+            # we only know the timestamp if the feed includes the docs.
+            timestamp = self.feed._change_to_timestamp(change)
+            if isinstance(timestamp, (int, long, float)) and \
+               timestamp > time.time() - self.priority_age:
+                return True
+        return False
+
+    def _reader_thread(self):
+        try:
+            self._read_changes()
+        except Exception, exc:
+            logger.exception('multiplexed _changes feed failed')
+            self.failure = exc
+            self.stop()
+            self._notify_idle()
+
+    def _route_change(self, change):
+        # Returns the element and inline doc for the change and the cursors
+        # it should be given to.  The schema is taken from the doc ID exactly once here
+        # rather than once per queue.
+        elt = self.feed._change_to_elt(change)
+        if elt is None:
+            # deleted etc - nobody needs it, but everyone's sequence moves.
+            return None, None, []
+        doc = self.feed._change_to_doc(change)
+        src_id, src_rev, _, seq = elt
+        try:
+            _, _, schema_id = self.doc_model.split_doc_id(src_id,
+                                                          decode_key=False)
+        except ValueError:
+            # not a raindrop document - only those wanting everything get it.
+            return elt, doc, self.all_routes
+        elt = src_id, src_rev, schema_id, seq
+        return elt, doc, self.routes.get(schema_id, []) + self.all_routes
+
+    def _read_changes(self):
+        feed = self.feed
+        cond = self.cond
+        while not self.stopping:
+            change = feed._get_next_change(True)
+            if change is None:
+                break # stopping.
+            seq = change['seq']
+            if 'id' in change:
+                # a cached doc is only good if this is the revision it holds.
+                rev = change['changes'][-1]['rev']
+                self.doc_model.doc_cache.invalidate(change['id'], rev)
+            elt, doc, cursors = self._route_change(change)
+            priority = cursors and self._is_priority(seq, change)
+            woke = False
+            with cond:
+                for cursor in cursors:
+                    if cursor.stopping or cursor.refetch_seq is not None or \
+                       seq <= cursor.fed_seq:
+                        continue
+                    if cursor.num_buffered() >= self.MAX_BUFFERED:
+                        # it is too far behind - it can fetch this (and
+                        # everything after it) itself when it catches up.
+                        logger.debug('cursor for %r is full at sequence %s',
+                                     cursor.schemas, cursor.fed_seq)
+                        cursor.refetch_seq = cursor.fed_seq
+                        continue
+                    if not cursor.num_buffered():
+                        woke = True
+                    if priority:
+                        cursor.priority.append((seq, elt, doc))
+                    else:
+                        cursor.buffer.append((seq, elt, doc))
+                    cursor.fed_seq = seq
+                self.last_seq = seq
+                cond.notifyAll()
+            # callbacks are made without our lock held so they are free to
+            # take their own.
+            if woke and self.ready_callback is not None:
+                self.ready_callback()
+
+
+class ChangesCursor(object):
+    """One consumer's view of a ChangesFeedMultiplexer.
+
+    Has the same interface as a ChangesIterFactory (make_iter, current_seq,
+    is_waiting and stop) so queue runners don't care which they are given,
+    plus poll() for consumers which don't want to block waiting for changes.
+    Changes which aren't routed to a cursor still advance its current_seq
+    once it has consumed everything buffered before them.
+
+    Changes are buffered in two lanes; those in the priority lane are
+    handed out before the backlog.  As changes may then be consumed out of
+    order, current_seq is one less than the lowest sequence still buffered
+    (ie, the sequence it is safe to checkpoint at).
+
+    If the multiplexer cut us off for having too much buffered, refetch_seq
+    is the last sequence we were given; once the buffer is empty we read the
+    changes after it from the database ourselves, a page at a time, until
+    we have caught up with the shared feed.
+    """
+    def __init__(self, mux, start_seq, include_deps, schemas):
+        self.mux = mux
+        self.start_seq = start_seq
+        self.current_seq = start_seq
+        self.include_deps = include_deps
+        if schemas is not None:
+            schemas = set(schemas)
+        self.schemas = schemas
+        self.buffer = deque() # the backlog lane.
+        self.priority = deque()
+        # the highest sequence we have handed out.
+        self.consumed_seq = self.current_seq
+        # the highest sequence put in our buffer.
+        self.fed_seq = self.current_seq
+        self.refetch_seq = None
+        self.stopping = False
+        self.is_waiting = False
+        # src_id -> doc for the docs which arrived with the changes yielded
+        # by the current make_iter.  These are shared with other cursors so
+        # must not be modified.
+        self.inline_docs = {}
+
+    def stop(self):
+        with self.mux.cond:
+            self.stopping = True
+            self.buffer.clear()
+            self.priority.clear()
+            self.mux.cond.notifyAll()
+
+    def num_buffered(self):
+        return len(self.priority) + len(self.buffer)
+
+    def has_changes(self):
+        """Are there changes for us, either buffered or still to refetch?"""
+        return bool(self.priority or self.buffer) or \
+               self.refetch_seq is not None
+
+    def poll(self):
+        """Returns True if changes are buffered for us.  Otherwise we have
+        consumed everything we were given, so are marked as waiting.  This
+        lets a consumer only call make_iter once there is something to do,
+        rather than blocking in it.
+        """
+        mux = self.mux
+        with mux.cond:
+            if self.priority or self.buffer or self.refetch_seq is not None:
+                return True
+            if mux.last_seq > self.current_seq:
+                self.current_seq = mux.last_seq
+            became_idle = not self.is_waiting
+            self.is_waiting = True
+        if became_idle:
+            mux._notify_idle()
+        return False
+
+    def _next(self, blocking, priority_only=False):
+        mux = self.mux
+        while True:
+            with mux.cond:
+                if self.priority or (self.buffer and not priority_only):
+                    self.is_waiting = False
+                    if self.priority:
+                        ret = self.priority.popleft()
+                    else:
+                        ret = self.buffer.popleft()
+                    self.consumed_seq = max(self.consumed_seq, ret[0])
+                    heads = [lane[0][0] for lane in (self.priority, self.buffer)
+                             if lane]
+                    if heads:
+                        self.current_seq = min(heads) - 1
+                    else:
+                        self.current_seq = self.consumed_seq
+                    return ret
+                if priority_only and self.buffer:
+                    return None
+                refetch = self.refetch_seq is not None and not self.stopping
+                if not refetch:
+                    # Everything the reader has seen has been handed to us,
+                    # so we are up-to-date with it.
+                    if mux.last_seq > self.current_seq:
+                        self.current_seq = mux.last_seq
+                    if self.stopping or not blocking:
+                        return None
+                    if self.is_waiting:
+                        mux.cond.wait()
+                        continue
+                    self.is_waiting = True
+            if refetch:
+                # our buffer is empty but we missed some changes.
+                self._refetch()
+                continue
+            # tell people we are idle without holding the lock, as they may
+            # take their own.
+            mux._notify_idle()
+
+    def _refetch(self):
+        # Read the next page of the changes we missed into our buffer.
+        mux = self.mux
+        kw = {'since': self.refetch_seq, 'limit': mux.MAX_BUFFERED}
+        if mux.include_docs:
+            kw['include_docs'] = True
+        results = mux.doc_model.db.listChanges(**kw)['results']
+        logger.debug('cursor for %r refetched %d changes after sequence %s',
+                     self.schemas, len(results), self.refetch_seq)
+        with mux.cond:
+            # The shared feed may have read more changes while we were
+            # fetching these (and skipped us for them), so we have only
+            # caught up once we have seen everything up to where it is.
+            caught_up = False
+            for change in results:
+                seq = change['seq']
+                if seq > mux.last_seq:
+                    # the shared feed hasn't got this far yet - it can
+                    # give it to us.
+                    caught_up = True
+                    break
+                elt, doc, cursors = mux._route_change(change)
+                if self in cursors:
+                    if mux._is_priority(seq, change):
+                        self.priority.append((seq, elt, doc))
+                    else:
+                        self.buffer.append((seq, elt, doc))
+                self.fed_seq = self.refetch_seq = seq
+            if self.refetch_seq >= mux.last_seq:
+                caught_up = True
+            if caught_up:
+                # the shared feed takes it from here.
+                self.fed_seq = max(self.fed_seq, mux.last_seq)
+                self.refetch_seq = None
+
+    def make_iter(self, batch_size):
+        these_elts = []
+        # A batch started from the priority lane ends with it, so the
+        # results are written (and the downstream queues can start on them)
+        # before we get stuck into the backlog.
+        priority_only = bool(self.priority)
+        # block until at least one change is available.
+        got = self._next(True)
+        if got is None:
+            return
+        schemas = self.schemas
+        # Refill the same dict rather than replacing it - our caller took a
+        # reference to it before the first change was read.
+        inline_docs = self.inline_docs
+        inline_docs.clear()
+        while got is not None:
+            seq, elt, doc = got
+            if elt is not None:
+                these_elts.append(elt)
+                # cursors needing dependencies see every change, but only
+                # pass on those they asked for.
+                if schemas is None or elt[2] in schemas:
+                    if doc is not None:
+                        inline_docs[elt[0]] = doc
+                    yield elt
+            if self.stopping or len(these_elts) >= batch_size:
+                break
+            got = self._next(False, priority_only)
+
+        if self.include_deps:
+            for elt in iter_dependencies(self.mux.doc_model, these_elts,
+                                         self.current_seq):
+                yield elt
@@ -0,0 +1,131 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""Periodically saves the position of each work queue.
+
+Rather than each queue writing its own rd.core.workqueue-state document
+after each batch, queues tell the CheckpointService how far they have got
+and it writes all the changed state documents in a single request every
+few seconds, and once more at shutdown.
+
+Queues must only report a sequence once everything they wrote for it has
+been written, so a crash can only ever cause work to be repeated, never
+skipped.
+"""
+from __future__ import with_statement
+
+import copy
+import threading
+
+from raindrop.model import DocumentSaveError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointService(object):
+    def __init__(self, doc_model, interval):
+        self.doc_model = doc_model
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.states = [] # the QueueState objects we manage.
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.num_writes = 0
+
+    def add(self, state):
+        self.states.append(state)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._checkpoint_thread)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the service, writing any outstanding positions."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        logger.debug("checkpointed queue positions %d times", self.num_writes)
+
+    def update(self, state, seq, emitted_schemas=None):
+        """Record that a queue has durably processed everything up to seq."""
+        assert seq is not None
+        with self.lock:
+            items = state.schema_item['items']
+            items['seq'] = seq
+            # remember what the queue writes, so the scheduler knows next time.
+            if emitted_schemas is not None:
+                items['emitted_schemas'] = sorted(emitted_schemas)
+
+    def _checkpoint_thread(self):
+        while not self.stop_event.isSet():
+            self.stop_event.wait(self.interval)
+            if self.stop_event.isSet():
+                break
+            try:
+                self.flush()
+            except Exception:
+                # try again next time - the positions are still in memory.
+                logger.exception("failed to checkpoint queue positions")
+
+    def flush(self):
+        """Write the state docs for all queues whose position has changed."""
+        dm = self.doc_model
+        to_save = []
+        with self.lock:
+            for state in self.states:
+                si = state.schema_item
+                if si['items'] != state.last_saved_items:
+                    to_save.append((state, copy.deepcopy(si)))
+        if not to_save:
+            return
+        logger.debug("checkpointing %d queue positions", len(to_save))
+        try:
+            results = dm.create_schema_items([si for _, si in to_save])
+            failed = {}
+        except DocumentSaveError, exc:
+            # create_schema_items doesn't tell us what worked, so re-read
+            # the revisions of them all.
+            failed = dict((info['id'], info) for info in exc.infos)
+            results = None
+        ids = [dm.get_doc_id_for_schema_item(si) for _, si in to_save]
+        if results is None:
+            docs = dm.open_documents_by_id(ids)
+            revs = dict((did, doc['_rev']) for did, doc in zip(ids, docs)
+                        if doc is not None)
+        else:
+            revs = dict((r['id'], r['rev']) for r in results)
+        with self.lock:
+            for did, (state, saved) in zip(ids, to_save):
+                if did in revs:
+                    state.schema_item['_rev'] = saved['_rev'] = revs[did]
+                if did in failed:
+                    logger.warn("failed to checkpoint queue %r: %s",
+                                saved['rd_ext_id'], failed[did])
+                else:
+                    state.last_saved_items = saved['items']
+        self.num_writes += 1
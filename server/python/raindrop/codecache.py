@@ -0,0 +1,157 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+
+"""A persistent cache of compiled extension code.
+
+Extensions and API end-points live in couch documents as source code, and
+compiling all of them is a noticeable part of the startup cost of short
+runs (eg, 'run-raindrop.py sync-messages' from cron).  compile_source()
+keeps the marshalled code objects in a directory, keyed by a hash of the
+source, so code is only compiled again after it has changed.
+
+The cache is only an optimization - if it can't be read or written we just
+compile the source as normal.
+
+As whatever is in the cache gets executed, it lives in a directory private
+to the user (next to their raindrop config file by default), and a
+directory or file which someone else could have written is ignored.
+"""
+from __future__ import with_statement
+
+import os
+import stat
+import imp
+import marshal
+import hashlib
+import tempfile
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The directory the code is cached in; None means the default.
+cache_dir = None
+
+# Code marshalled by a different version of Python can't be loaded.
+_MAGIC = imp.get_magic()
+
+# None where there are no user ids to check (ie, windows).
+_getuid = getattr(os, 'getuid', None)
+
+
+def get_cache_dir():
+    if cache_dir is not None:
+        return cache_dir
+    # next to the config file, like the up-to-date cache.
+    from raindrop import config
+    if config.CONFIG is not None:
+        base = os.path.dirname(config.CONFIG.filename)
+    else:
+        base = os.path.expanduser('~')
+    return os.path.join(base, '.raindrop-code-cache')
+
+
+def _is_private(st):
+    # Could only the current user have written this?
+    if _getuid is None:
+        return True
+    return st.st_uid == _getuid() and \
+           not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _check_cache_dir(dirname):
+    # Returns True if the directory can be used, creating it if need be.
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname, 0700)
+        except OSError, exc:
+            logger.debug("can't create the code cache %r: %s", dirname, exc)
+            return False
+    if not _is_private(os.stat(dirname)):
+        logger.warn("not using the code cache %r - it isn't private to "
+                    "this user", dirname)
+        return False
+    return True
+
+
+def _get_cache_filename(src, filename):
+    if isinstance(src, unicode):
+        src = src.encode('utf-8')
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    hash = hashlib.sha1(_MAGIC)
+    hash.update(filename)
+    hash.update('\0')
+    hash.update(src)
+    return os.path.join(get_cache_dir(), hash.hexdigest() + '.code')
+
+
+def _write_cache(cache_name, co):
+    dirname = os.path.dirname(cache_name)
+    # write to a temp file and rename it, so other processes (eg, the
+    # extension worker processes) never see a partial file.  mkstemp
+    # makes it readable only by us.
+    fd, temp_name = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(co, f)
+        try:
+            os.rename(temp_name, cache_name)
+        except OSError:
+            # windows won't rename over an existing file - someone else
+            # must have just written it.
+            os.remove(temp_name)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def compile_source(src, filename):
+    """Equivalent to compile(src, filename, "exec"), but using the code
+    cached from a previous compilation of the same source if possible.
+    """
+    cache_name = _get_cache_filename(src, filename)
+    if not _check_cache_dir(os.path.dirname(cache_name)):
+        return compile(src, filename, "exec")
+    try:
+        with open(cache_name, 'rb') as f:
+            if _is_private(os.fstat(f.fileno())):
+                return marshal.load(f)
+            logger.warn("ignoring code cache file %r - it isn't private to "
+                        "this user", cache_name)
+    except IOError:
+        pass # not cached.
+    except (EOFError, ValueError, TypeError), exc:
+        logger.warn("ignoring corrupt code cache file %r: %s", cache_name,
+                    exc)
+
+    co = compile(src, filename, "exec")
+    try:
+        _write_cache(cache_name, co)
+    except (IOError, OSError), exc:
+        logger.debug("failed to cache the code for %r: %s", filename, exc)
+    else:
+        logger.debug("cached the code for %r in %r", filename, cache_name)
+    return co
@@ -95,6 +95,7 @@ def get_ext_env(doc_model, context, src_doc, ext):
         if ext.category != ext.EXTENDER:
             ni['rd_schema_provider'] = ext.id
         new_items.append(ni)
+        return doc_model.get_doc_id_for_schema_item(ni)
 
     def emit_related_identities(identity_ids, def_contact_props):
         logger.debug("emit_related_identities for %r", ext.id)
@@ -120,18 +121,22 @@ def get_ext_env(doc_model, context, src_doc, ext):
                      ext.id, len(new_items))
 
     def open_schema_attachment(src, attachment, **kw):
-        "A function to abstract document storage requirements away..."
+        """A function to abstract document storage requirements away...
+
+        Pass stream=True to get a file-like object, which must be closed,
+        instead of a string.
+        """
         doc_id = src['_id']
         dm = doc_model
         found, info = dm.get_schema_attachment_info(src, attachment)
         logger.debug("attempting to open attachment %s/%s", doc_id, found)
         return dm.db.openDoc(dm.quote_id(doc_id), attachment=found, **kw)
 
-    def open_attachment(doc_id, attach_id):
+    def open_attachment(doc_id, attach_id, **kw):
         "A function to abstract document storage requirements away..."
         dm = doc_model
         logger.debug("attempting to open attachment %s/%s", doc_id, attach_id)
-        return dm.db.openDoc(dm.quote_id(doc_id), attachment=attach_id)
+        return dm.db.openDoc(dm.quote_id(doc_id), attachment=attach_id, **kw)
 
     def open_view(*args, **kw):
         context['did_query'] = True
@@ -0,0 +1,759 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""An in-process, in-memory stand-in for a couchdb database.
+
+MemoryCouchDB implements the parts of the wetpaisley.CouchDB interface the
+DocumentModel and the work queues use - documents with
+revisions and conflicts, attachments, _all_docs, _changes and the views in
+schema/content, which have been ported to Python below.  It lets the
+pipeline be run (and benchmarked) without a couch server, so the numbers
+reflect raindrop's own overhead rather than the server and the network.
+
+Documents are stored as json strings, so callers always get their own copy
+and can't store anything couch couldn't.
+
+Use install() so get_db() (and therefore the DocumentModel) uses one.
+"""
+from __future__ import with_statement
+
+import base64
+import bisect
+import threading
+import uuid
+from urllib import unquote
+from cStringIO import StringIO
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from raindrop import json
+from raindrop.wetpaisley import CouchDB
+from raindrop.changesiter import ChangesIterFactory
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def collation_key(value):
+    """Returns an object which sorts in couch's view collation order -
+    null, false, true, numbers, strings, arrays then objects.  Strings are
+    compared by code point rather than using ICU's rules.
+    """
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(collation_key(v) for v in value))
+    if isinstance(value, dict):
+        return (6, tuple((k, collation_key(v)) for k, v in sorted(value.items())))
+    raise TypeError("can't collate %r" % (value,))
+
+
+# The views in schema/content ported to Python.  Each map function is a
+# generator of (key, value) tuples for a document.
+def _each(value):
+    # javascript's 'for each (var x in value)'
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        return value.values()
+    return ()
+
+def _megaview_map(doc):
+    if not doc.get('rd_schema_id') or doc.get('rd_megaview_ignore_doc'):
+        return
+    row_val = {'_rev': doc['_rev'],
+               'rd_key': doc.get('rd_key'),
+               'rd_schema_id': doc['rd_schema_id'],
+               }
+    yield ['key', doc.get('rd_key')], row_val
+    yield ['schema_id', doc['rd_schema_id']], row_val
+    yield ['key-schema_id', [doc.get('rd_key'), doc['rd_schema_id']]], row_val
+    for rd_ext_id, schema_item in (doc.get('rd_schema_items') or {}).iteritems():
+        rd_source = schema_item.get('rd_source')
+        si_row_val = {'_rev': doc['_rev'],
+                      'rd_key': doc.get('rd_key'),
+                      'rd_schema_id': doc['rd_schema_id'],
+                      'rd_ext_id': rd_ext_id,
+                      'rd_source': rd_source,
+                      }
+        if 'rd_ext_fingerprint' in schema_item:
+            si_row_val['rd_ext_fingerprint'] = schema_item['rd_ext_fingerprint']
+        yield ['ext_id', rd_ext_id], si_row_val
+        if rd_source:
+            src_val = rd_source[0]
+        else:
+            src_val = None
+        yield ['source', src_val], si_row_val
+        yield ['ext_id-source', [rd_ext_id, src_val]], si_row_val
+        for dep in schema_item.get('rd_deps') or ():
+            yield ['dep', dep], si_row_val
+
+def _acct_identities_map(doc):
+    if doc.get('rd_schema_id') == 'rd.account':
+        for idty in _each(doc.get('identities')):
+            yield [idty], None
+
+def _acct_protocols_map(doc):
+    if doc.get('rd_schema_id') == 'rd.account':
+        yield doc.get('proto'), {'rd_key': doc.get('rd_key')}
+
+def _api_endpoints_map(doc):
+    if doc.get('rd_schema_id') == 'rd.ext.api' and doc.get('endpoints'):
+        for ep in _each(doc['endpoints']):
+            yield ep, None
+
+def _attach_by_owned_key_map(doc):
+    rd_key = doc.get('rd_key')
+    if rd_key and rd_key[0] == 'attach':
+        yield rd_key[1][0], {'rd_schema_id': doc.get('rd_schema_id'),
+                             'rd_key': rd_key}
+
+def _contact_name_map(doc):
+    if doc.get('rd_schema_id') == 'rd.contact' and doc.get('displayName'):
+        yield doc['displayName'], {'rd_key': doc['rd_key'], '_rev': doc['_rev']}
+
+def _contacts_by_identity_map(doc):
+    if doc.get('rd_schema_id') == 'rd.identity.contacts':
+        for cid in _each(doc.get('contacts')):
+            yield doc['rd_key'], cid
+
+def _conv_groupings_with_unread_map(doc):
+    if doc.get('rd_schema_id') == 'rd.conv.summary':
+        for grouptag in _each(doc.get('unread_grouping_tags')):
+            yield grouptag, doc['rd_key']
+
+def _conv_summary_by_grouping_timestamp_map(doc):
+    if doc.get('rd_schema_id') == 'rd.conv.summary':
+        for gt in _each(doc.get('grouping-timestamp')):
+            yield gt, None
+
+def _conv_summary_by_identity_map(doc):
+    if doc.get('rd_schema_id') == 'rd.conv.summary':
+        for idid in _each(doc.get('identities')):
+            yield idid, None
+
+def _grouping_info_tags_map(doc):
+    if doc.get('rd_schema_id') == 'rd.grouping.info':
+        for gt in _each(doc.get('grouping_tags')):
+            yield gt, doc['rd_key']
+
+def _identities_by_contact_map(doc):
+    if doc.get('rd_schema_id') == 'rd.identity.contacts':
+        for cid in _each(doc.get('contacts')):
+            yield cid, {'rd_key': doc['rd_key'], '_rev': doc['_rev']}
+
+def _mailing_list_id_map(doc):
+    if doc.get('rd_schema_id') == 'rd.mailing-list' and doc.get('id'):
+        yield doc['id'], {'rd_key': doc['rd_key'], '_rev': doc['_rev']}
+
+def _msg_seen_flag_map(doc):
+    if doc.get('rd_schema_id') == 'rd.msg.seen' and 'seen' in doc:
+        yield doc['rd_key'], {'seen': doc['seen'], '_rev': doc['_rev'],
+                              'outgoing_state': doc.get('outgoing_state')}
+
+def _msg_by_mailinglist_map(doc):
+    if doc.get('rd_schema_id') == 'rd.msg.email.mailing-list' and \
+       doc.get('list_id'):
+        yield doc['list_id'], {'rd_key': doc['rd_key'], '_rev': doc['_rev']}
+
+def _msg_conversation_id_map(doc):
+    if doc.get('rd_schema_id') == 'rd.msg.conversation':
+        yield doc.get('conversation_id'), {'rd_key': doc['rd_key'],
+                                           '_rev': doc['_rev']}
+
+def _msg_location_map(doc):
+    if doc.get('rd_schema_id') == 'rd.msg.imap-location':
+        for location in _each(doc.get('locations')):
+            yield location.get('folder_name'), {'rd_key': doc['rd_key'],
+                                                '_rev': doc['_rev']}
+
+def _msg_location_by_source_map(doc):
+    if doc.get('rd_schema_id') == 'rd.msg.imap-locations':
+        for location in _each(doc.get('locations')):
+            key = [location.get('account'), location.get('folder_name')]
+            yield key, {'rd_key': doc['rd_key'], '_rev': doc['_rev'],
+                        'location': location}
+
+def _outgoing_by_schema_map(doc):
+    if doc.get('rd_schema_id') and doc.get('outgoing_state'):
+        yield [doc['rd_schema_id'], doc['outgoing_state']], {'_rev': doc['_rev']}
+
+def _outgoing_by_state_map(doc):
+    if doc.get('rd_schema_id') and doc.get('outgoing_state'):
+        yield doc['outgoing_state'], {'_rev': doc['_rev']}
+
+# schema/content/tests
+def _grouping_info_by_title_map(doc):
+    if doc.get('rd_schema_id') == 'rd.grouping.info':
+        yield doc.get('title'), None
+
+def _msg_body_recipients_map(doc):
+    if doc.get('rd_schema_id') == 'rd.msg.body':
+        val = {'rd_key': doc['rd_key'], '_rev': doc['_rev']}
+        if doc.get('from'):
+            yield ['from', doc['from']], val
+        if doc.get('from_display'):
+            yield ['from_display', doc['from_display']], val
+        for name in ('to', 'to_display', 'cc', 'cc_display'):
+            for recip in _each(doc.get(name) or []):
+                yield [name, recip], val
+
+def _count(values):
+    return len(values)
+
+# design doc -> view name -> (map function, reduce function or None)
+VIEWS = {
+    'raindrop!content!all': {
+        'megaview': (_megaview_map, _count),
+        'acct_identities': (_acct_identities_map, _count),
+        'acct_protocols': (_acct_protocols_map, None),
+        'api_endpoints': (_api_endpoints_map, None),
+        'attach_by_owned_key': (_attach_by_owned_key_map, None),
+        'contact_name': (_contact_name_map, None),
+        'contacts_by_identity': (_contacts_by_identity_map, None),
+        'conv-groupings-with-unread': (_conv_groupings_with_unread_map, None),
+        'conv_summary_by_grouping_timestamp':
+                            (_conv_summary_by_grouping_timestamp_map, None),
+        'conv_summary_by_identity': (_conv_summary_by_identity_map, None),
+        'grouping_info_tags': (_grouping_info_tags_map, None),
+        'identities_by_contact': (_identities_by_contact_map, None),
+        'mailing_list_id': (_mailing_list_id_map, _count),
+        'msg-seen-flag': (_msg_seen_flag_map, None),
+        'msg_by_mailinglist': (_msg_by_mailinglist_map, None),
+        'msg_conversation_id': (_msg_conversation_id_map, None),
+        'msg_location': (_msg_location_map, _count),
+        'msg_location_by_source': (_msg_location_by_source_map, None),
+        'outgoing_by_schema': (_outgoing_by_schema_map, None),
+        'outgoing_by_state': (_outgoing_by_state_map, None),
+    },
+    'raindrop!content!tests': {
+        'grouping_info_by_title': (_grouping_info_by_title_map, None),
+        'msg_body_recipients': (_msg_body_recipients_map, None),
+    },
+}
+
+def _by_schema_filter(doc, schemas):
+    # schema/content/all/by_schema-filter.js
+    return doc.get('rd_schema_id') in schemas
+
+
+class _Doc(object):
+    """The current revision of a document"""
+    __slots__ = ['rev', 'seq', 'deleted', 'body', 'attachments']
+    def __init__(self, rev, seq, deleted, body, attachments):
+        self.rev = rev
+        self.seq = seq
+        self.deleted = deleted
+        self.body = body # the json, less _id, _rev and _attachments.
+        self.attachments = attachments # name -> (content_type, data)
+
+
+class _ViewIndex(object):
+    """The rows a view has emitted, brought up-to-date as it is queried."""
+    def __init__(self, map_func, reduce_func):
+        self.map_func = map_func
+        self.reduce_func = reduce_func
+        self.log_pos = 0 # how far through the db's change log we are.
+        self.emitted = {} # doc id -> [(key, value), ...]
+        self.rows = [] # sorted list of (collation key, doc id, key, value)
+        self.collation_keys = [] # parallel with rows, for bisecting.
+
+    def update(self, db):
+        log = db.change_log
+        if self.log_pos == len(log):
+            return
+        emitted = self.emitted
+        for seq, doc_id in log[self.log_pos:]:
+            info = db.docs[doc_id]
+            if info.seq != seq:
+                continue # superseded by a later change.
+            if info.deleted:
+                emitted.pop(doc_id, None)
+                continue
+            doc = db._make_doc(doc_id, info)
+            try:
+                emitted[doc_id] = list(self.map_func(doc))
+            except Exception:
+                # couch just logs and skips docs which break a view.
+                logger.exception("view failed to map document %r", doc_id)
+                emitted.pop(doc_id, None)
+        self.log_pos = len(log)
+        rows = []
+        for doc_id, kvs in emitted.iteritems():
+            for key, value in kvs:
+                rows.append((collation_key(key), doc_id, key, value))
+        rows.sort()
+        self.rows = rows
+        self.collation_keys = [row[0] for row in rows]
+
+
+class MemoryChangesFeed(ChangesIterFactory):
+    """A ChangesIterFactory reading the _changes of a MemoryCouchDB."""
+    def initialize(self, doc_model, start_seq, include_deps=False,
+                   filter_schemas=None, include_docs=False):
+        self.include_deps = include_deps
+        self.filter_schemas = filter_schemas
+        self.include_docs = include_docs
+        self.doc_model = doc_model
+        self.db = doc_model.db
+        self.current_seq = start_seq or 0
+        # where _get_next_change is up to.
+        self.read_seq = self.current_seq
+
+    def stop(self):
+        with self.db.cond:
+            self.stopping = True
+            self.db.cond.notifyAll()
+
+    def _get_next_change(self, blocking):
+        db = self.db
+        while not self.stopping:
+            with db.cond:
+                changes, self.read_seq = db._get_changes(self.read_seq,
+                                                         self.filter_schemas,
+                                                         self.include_docs,
+                                                         limit=1)
+                if changes:
+                    self.is_waiting = False
+                    return changes[0]
+                if not blocking:
+                    return None
+                if self.is_waiting:
+                    db.cond.wait()
+                    continue
+                self.is_waiting = True
+            # like the real thing, tell people we are waiting without our
+            # lock held.
+            if self.waiting_callback is not None:
+                self.waiting_callback()
+        return None
+
+
+class MemoryCouchDB(CouchDB):
+    # The old _all_docs_by_seq API isn't supported - use _changes.
+    _has_adbs = False
+    # The class the changes multiplexer uses to read our _changes feed.
+    ChangesFeed = MemoryChangesFeed
+
+    def __init__(self, dbName='raindrop'):
+        CouchDB.__init__(self, None, None, dbName)
+        self.cond = threading.Condition()
+        self.exists = True
+        self._reset()
+
+    def _reset(self):
+        self.docs = {} # doc id -> _Doc
+        self.seq = 0
+        # (seq, doc id) for each change in order - entries for docs which
+        # have changed again since are skipped when read.
+        self.change_log = []
+        self.views = {} # (design doc, view name) -> _ViewIndex
+
+    def _not_found(self, reason="missing"):
+        body = json.dumps({'error': 'not_found', 'reason': reason})
+        return self.NotFoundError(404, 'Object Not Found', body)
+
+    def _conflict(self):
+        body = json.dumps({'error': 'conflict',
+                           'reason': 'Document update conflict.'})
+        return self.Error(409, 'Conflict', body)
+
+    def _make_doc(self, doc_id, info, attachments=False):
+        doc = json.loads(info.body)
+        doc['_id'] = doc_id
+        doc['_rev'] = info.rev
+        if info.attachments:
+            atts = doc['_attachments'] = {}
+            for name, (content_type, data) in info.attachments.iteritems():
+                if attachments:
+                    atts[name] = {'content_type': content_type,
+                                  'data': base64.b64encode(data)}
+                else:
+                    atts[name] = {'content_type': content_type,
+                                  'length': len(data),
+                                  'stub': True}
+        return doc
+
+    def _new_rev(self, info, body):
+        if info is None:
+            num = 1
+        else:
+            num = int(info.rev.split('-', 1)[0]) + 1
+        return "%d-%s" % (num, md5(body + str(self.seq)).hexdigest())
+
+    def _write(self, doc_id, info, deleted, body, attachments):
+        # caller holds the lock and has checked the revision.
+        self.seq += 1
+        rev = self._new_rev(info, body)
+        self.docs[doc_id] = _Doc(rev, self.seq, deleted, body, attachments)
+        self.change_log.append((self.seq, doc_id))
+        self.cond.notifyAll()
+        return rev
+
+    def _update_one(self, doc):
+        doc_id = doc.get('_id') or uuid.uuid4().hex
+        info = self.docs.get(doc_id)
+        rev = doc.get('_rev')
+        if info is None or info.deleted:
+            # creating - a _rev is only ok if it is that of the deleted doc.
+            if rev is not None and (info is None or rev != info.rev):
+                return {'id': doc_id, 'error': 'conflict',
+                        'reason': 'Document update conflict.'}
+        elif rev != info.rev:
+            return {'id': doc_id, 'error': 'conflict',
+                    'reason': 'Document update conflict.'}
+        deleted = bool(doc.get('_deleted'))
+        attachments = {}
+        if not deleted:
+            for name, ainfo in (doc.get('_attachments') or {}).iteritems():
+                if ainfo.get('_deleted'):
+                    continue
+                if ainfo.get('stub'):
+                    if info is None or name not in info.attachments:
+                        return {'id': doc_id, 'error': 'missing_stub',
+                                'reason': 'no attachment %r' % (name,)}
+                    attachments[name] = info.attachments[name]
+                else:
+                    attachments[name] = (ainfo.get('content_type'),
+                                         base64.b64decode(ainfo['data']))
+        body = dict((n, v) for n, v in doc.iteritems()
+                    if n not in ('_id', '_rev', '_attachments', '_deleted'))
+        if deleted:
+            body = {}
+        rev = self._write(doc_id, info, deleted, json.dumps(body), attachments)
+        return {'id': doc_id, 'rev': rev}
+
+    def _get_changes(self, since, filter_schemas=None, include_docs=False,
+                     limit=None, descending=False):
+        # Returns (changes, last_seq); caller holds the lock.
+        log = self.change_log
+        if descending:
+            entries = reversed(log)
+        else:
+            # seqs are 1..n with no gaps, so since is an index.
+            entries = log[since:]
+        changes = []
+        last_seq = since
+        for seq, doc_id in entries:
+            if not descending:
+                last_seq = seq
+            if limit is not None and len(changes) >= limit:
+                if not descending:
+                    last_seq = seq - 1
+                break
+            info = self.docs[doc_id]
+            if info.seq != seq:
+                continue
+            doc = None
+            if filter_schemas is not None or include_docs:
+                if info.deleted:
+                    # couch gives the tombstone
+                    doc = {'_id': doc_id, '_rev': info.rev, '_deleted': True}
+                else:
+                    doc = self._make_doc(doc_id, info)
+                if filter_schemas is not None and \
+                   not _by_schema_filter(doc, filter_schemas):
+                    continue
+            change = {'seq': seq, 'id': doc_id,
+                      'changes': [{'rev': info.rev}]}
+            if info.deleted:
+                change['deleted'] = True
+            if include_docs:
+                change['doc'] = doc
+            changes.append(change)
+        return changes, last_seq
+
+    # The wetpaisley.CouchDB interface.
+    def infoDB(self):
+        with self.cond:
+            if not self.exists:
+                raise self._not_found("no_db_file")
+            ndeleted = len([i for i in self.docs.itervalues() if i.deleted])
+            size = sum(len(i.body) for i in self.docs.itervalues())
+            return {'db_name': self.dbName,
+                    'doc_count': len(self.docs) - ndeleted,
+                    'doc_del_count': ndeleted,
+                    'update_seq': self.seq,
+                    'disk_size': size,
+                    }
+
+    def infoDesignDoc(self, docId):
+        with self.cond:
+            try:
+                view_names = VIEWS[docId]
+            except KeyError:
+                raise self._not_found()
+            # our views have an index each - the design doc is as up-to-date
+            # as the oldest of them.  seqs have no gaps, so an index's
+            # position in the change log is its seq.
+            seq = min(self.views[docId, vn].log_pos
+                      if (docId, vn) in self.views else 0
+                      for vn in view_names)
+            return {'name': docId, 'view_index': {'update_seq': seq}}
+
+    def createDB(self):
+        with self.cond:
+            if self.exists:
+                body = json.dumps({'error': 'file_exists',
+                                   'reason': 'The database could not be created, the file already exists.'})
+                raise self.Error(412, 'Precondition Failed', body)
+            self.exists = True
+
+    def deleteDB(self):
+        with self.cond:
+            self._reset()
+            self.exists = False
+            self.cond.notifyAll()
+
+    def openDoc(self, docId, revision=None, full=False, attachment="",
+                attachments=False, stream=False):
+        doc_id = unquote(docId)
+        with self.cond:
+            info = self.docs.get(doc_id)
+            if attachment:
+                if info is None or info.deleted or \
+                   unquote(attachment) not in info.attachments:
+                    raise self._not_found()
+                data = info.attachments[unquote(attachment)][1]
+                if stream:
+                    return StringIO(data)
+                return data
+            if info is None or info.deleted:
+                return {}
+            return self._make_doc(doc_id, info, attachments)
+
+    def saveAttachment(self, docId, name, data,
+                       content_type="application/octet-stream",
+                       revision=None):
+        doc_id = unquote(docId)
+        if hasattr(data, 'read'):
+            data = data.read()
+        with self.cond:
+            info = self.docs.get(doc_id)
+            if info is None or info.deleted:
+                if revision is not None:
+                    raise self._conflict()
+                body = '{}'
+                attachments = {}
+            else:
+                if revision != info.rev:
+                    raise self._conflict()
+                body = info.body
+                attachments = info.attachments.copy()
+            attachments[unquote(name)] = (content_type, data)
+            rev = self._write(doc_id, info, False, body, attachments)
+            return {'ok': True, 'id': doc_id, 'rev': rev}
+
+    def updateDocuments(self, user_docs):
+        with self.cond:
+            return [self._update_one(doc) for doc in user_docs]
+
+    def listDoc(self, **kw):
+        include_docs = kw.get('include_docs')
+        rows = []
+        with self.cond:
+            if 'keys' in kw:
+                for doc_id in kw['keys']:
+                    info = self.docs.get(doc_id)
+                    if info is None:
+                        rows.append({'key': doc_id, 'error': 'not_found'})
+                        continue
+                    row = {'id': doc_id, 'key': doc_id,
+                           'value': {'rev': info.rev}}
+                    if info.deleted:
+                        row['value']['deleted'] = True
+                    if include_docs:
+                        if info.deleted:
+                            row['doc'] = None
+                        else:
+                            row['doc'] = self._make_doc(doc_id, info)
+                    rows.append(row)
+                return {'total_rows': len(self.docs), 'offset': 0,
+                        'rows': rows}
+            ids = sorted(doc_id for doc_id, info in self.docs.iteritems()
+                         if not info.deleted)
+            start, end = self._get_range(ids, kw, lambda x: x)
+            for doc_id in self._slice(ids, start, end, kw):
+                info = self.docs[doc_id]
+                row = {'id': doc_id, 'key': doc_id, 'value': {'rev': info.rev}}
+                if include_docs:
+                    row['doc'] = self._make_doc(doc_id, info)
+                rows.append(row)
+            return {'total_rows': len(ids), 'offset': start, 'rows': rows}
+
+    def _get_range(self, keys, kw, keyfunc):
+        # Returns the (start, end) indexes into the sorted keys for the
+        # startkey/endkey options.
+        descending = kw.get('descending')
+        lo_name, hi_name = 'startkey', 'endkey'
+        if descending:
+            lo_name, hi_name = hi_name, lo_name
+        if lo_name in kw:
+            start = bisect.bisect_left(keys, keyfunc(kw[lo_name]))
+        else:
+            start = 0
+        if hi_name in kw:
+            hi = keyfunc(kw[hi_name])
+            if kw.get('inclusive_end', True) or descending:
+                end = bisect.bisect_right(keys, hi)
+            else:
+                end = bisect.bisect_left(keys, hi)
+        else:
+            end = len(keys)
+        return start, end
+
+    def _slice(self, items, start, end, kw):
+        items = items[start:end]
+        if kw.get('descending'):
+            items = items[::-1]
+        skip = kw.get('skip', 0)
+        limit = kw.get('limit')
+        if limit is not None:
+            return items[skip:skip+limit]
+        return items[skip:]
+
+    def openView(self, docId, viewId, **kwargs):
+        with self.cond:
+            try:
+                index = self.views.get((docId, viewId))
+                if index is None:
+                    map_func, reduce_func = VIEWS[docId][viewId]
+                    index = _ViewIndex(map_func, reduce_func)
+                    self.views[docId, viewId] = index
+            except KeyError:
+                if kwargs.get('limit') == 0:
+                    # just a request to bring the view up-to-date.
+                    return {'total_rows': 0, 'offset': 0, 'rows': []}
+                raise self._not_found("view %s/%s isn't available in memory"
+                                      % (docId, viewId))
+            index.update(self)
+            rows, offset = self._query_view(index, kwargs)
+            if kwargs.get('include_docs'):
+                for row in rows:
+                    doc_id = row['id']
+                    if isinstance(row['value'], dict) and '_id' in row['value']:
+                        doc_id = row['value']['_id']
+                    info = self.docs.get(doc_id)
+                    if info is None or info.deleted:
+                        row['doc'] = None
+                    else:
+                        row['doc'] = self._make_doc(doc_id, info)
+            if index.reduce_func is not None and kwargs.get('reduce', True):
+                return {'rows': rows}
+            return {'total_rows': len(index.rows), 'offset': offset,
+                    'rows': rows}
+
+    def _query_view(self, index, kw):
+        # Returns (rows, offset) for a view query; the values are shared
+        # with the index, so are copied via json.
+        all_rows = index.rows
+        cks = index.collation_keys
+        if 'keys' in kw:
+            selected = []
+            for key in kw['keys']:
+                ck = collation_key(key)
+                lo = bisect.bisect_left(cks, ck)
+                hi = bisect.bisect_right(cks, ck)
+                selected.append((key, all_rows[lo:hi]))
+            offset = 0
+        else:
+            if 'key' in kw:
+                kw = kw.copy()
+                kw['startkey'] = kw['endkey'] = kw.pop('key')
+                kw.pop('descending', None)
+            start, end = self._get_range(cks, kw, collation_key)
+            if 'startkey_docid' in kw and not kw.get('descending'):
+                # rows with the same key are sorted by doc id.
+                pos = (collation_key(kw['startkey']), kw['startkey_docid'])
+                start = max(start, bisect.bisect_left(all_rows, pos))
+            selected = [(None, all_rows[start:end])]
+            offset = start
+
+        if index.reduce_func is not None and kw.get('reduce', True):
+            group_level = kw.get('group_level')
+            if group_level is None and kw.get('group'):
+                group_level = 'exact'
+            groups = []
+            for key, rows in selected:
+                if 'keys' in kw:
+                    # multi-key reduce queries are always grouped by key.
+                    if rows:
+                        groups.append((key, [r[3] for r in rows]))
+                elif group_level is None:
+                    if rows:
+                        groups.append((None, [r[3] for r in rows]))
+                else:
+                    for row in rows:
+                        gkey = row[2]
+                        if group_level != 'exact' and isinstance(gkey, list):
+                            gkey = gkey[:group_level]
+                        if groups and groups[-1][0] == gkey:
+                            groups[-1][1].append(row[3])
+                        else:
+                            groups.append((gkey, [row[3]]))
+            result = [{'key': gkey, 'value': index.reduce_func(values)}
+                      for gkey, values in groups]
+            return self._slice(result, 0, len(result), kw), 0
+
+        rows = []
+        for key, these in selected:
+            if 'keys' not in kw:
+                these = self._slice(these, 0, len(these), kw)
+            for ck, doc_id, key, value in these:
+                rows.append({'id': doc_id, 'key': key,
+                             'value': json.loads(json.dumps(value))})
+        if 'keys' in kw:
+            rows = self._slice(rows, 0, len(rows), kw)
+        return rows, offset
+
+    def listChanges(self, **kw):
+        since = kw.get('since', 0)
+        with self.cond:
+            changes, last_seq = self._get_changes(since,
+                                    include_docs=kw.get('include_docs'),
+                                    limit=kw.get('limit'),
+                                    descending=kw.get('descending'))
+        if kw.get('descending'):
+            last_seq = changes[-1]['seq'] if changes else 0
+        return {'results': changes, 'last_seq': last_seq}
+
+
+def install(dbname, couchname='local'):
+    """Have get_db() return an in-memory database for the named couch and
+    database, returning it.
+    """
+    from raindrop import model
+    db = MemoryCouchDB(dbname)
+    model.DBs[couchname, dbname] = db
+    return db
@@ -0,0 +1,242 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""Counters and histograms describing what the pipeline is doing.
+
+Each extension (or more accurately, each work queue) has an
+ExtensionMetrics object holding how many documents it has seen, skipped
+as up-to-date (and how many of those the up-to-date cache knew about),
+processed and failed on, how long its handler and the couch
+requests made on its behalf take, and how far behind the _changes feed it
+is.  Similarly, each design document has a ViewMetrics object holding how
+long refreshing each of its views takes and how far behind the database
+its index was when last checked.
+
+The numbers are kept in memory for the life of the process; they are
+exposed via the 'status' request of couch-raindrop.py and, in plain-text,
+via its 'metrics' request and the optional --metrics-port HTTP server.
+"""
+from __future__ import with_statement
+
+import threading
+import BaseHTTPServer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, num=1):
+        with self.lock:
+            self.value += num
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    # The upper bounds, in seconds, of each bucket; a final bucket holds
+    # everything larger.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(self.BUCKETS)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def as_dict(self):
+        with self.lock:
+            buckets = []
+            cumulative = 0
+            for bound, num in zip(self.BUCKETS + ('+Inf',), self.counts):
+                cumulative += num
+                buckets.append([bound, cumulative])
+            return {'count': self.count,
+                    'total': self.total,
+                    'max': self.max,
+                    'buckets': buckets,
+                    }
+
+
+class ExtensionMetrics(object):
+    COUNTERS = ('seen', 'skipped', 'cached', 'processed', 'errors')
+    HISTOGRAMS = ('handler_time', 'couch_time')
+
+    def __init__(self, ext_id):
+        self.ext_id = ext_id
+        for name in self.COUNTERS:
+            setattr(self, name, Counter())
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+        # the number of sequences the queue is behind the _changes feed.
+        self.lag = Gauge()
+
+    def as_dict(self):
+        ret = {'lag': self.lag.value}
+        for name in self.COUNTERS:
+            ret[name] = getattr(self, name).value
+        for name in self.HISTOGRAMS:
+            ret[name] = getattr(self, name).as_dict()
+        return ret
+
+
+class ViewMetrics(object):
+    def __init__(self, design_doc):
+        self.design_doc = design_doc
+        self.lock = threading.Lock()
+        self.refresh_times = {} # Histogram keyed by view name.
+        # the number of sequences the index is behind the database.
+        self.lag = Gauge()
+
+    def get_refresh_time(self, view_name):
+        try:
+            return self.refresh_times[view_name]
+        except KeyError:
+            with self.lock:
+                return self.refresh_times.setdefault(view_name, Histogram())
+
+    def as_dict(self):
+        with self.lock:
+            times = self.refresh_times.items()
+        return {'lag': self.lag.value,
+                'refresh_time': dict((vn, h.as_dict()) for vn, h in times),
+                }
+
+
+_metrics = {} # keyed by extension id.
+_view_metrics = {} # keyed by design doc.
+_metrics_lock = threading.Lock()
+
+def get_extension_metrics(ext_id):
+    """Get the ExtensionMetrics for an extension, creating it if necessary"""
+    try:
+        return _metrics[ext_id]
+    except KeyError:
+        with _metrics_lock:
+            return _metrics.setdefault(ext_id, ExtensionMetrics(ext_id))
+
+def get_view_metrics(design_doc):
+    """Get the ViewMetrics for a design doc, creating it if necessary"""
+    try:
+        return _view_metrics[design_doc]
+    except KeyError:
+        with _metrics_lock:
+            return _view_metrics.setdefault(design_doc,
+                                            ViewMetrics(design_doc))
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+        _view_metrics.clear()
+
+def get_status_ob():
+    """Returns a json-able object with the metrics for every extension and
+    design doc.
+    """
+    return {'extensions': dict((ext_id, m.as_dict())
+                               for ext_id, m in _metrics.items()),
+            'views': dict((did, m.as_dict())
+                          for did, m in _view_metrics.items()),
+            }
+
+def _format_histogram(lines, prefix, label, histogram):
+    info = histogram.as_dict()
+    for bound, num in info['buckets']:
+        lines.append('%s_bucket{%s,le="%s"} %d' % (prefix, label, bound, num))
+    lines.append('%s_sum{%s} %f' % (prefix, label, info['total']))
+    lines.append('%s_count{%s} %d' % (prefix, label, info['count']))
+
+def format_text():
+    """Returns the metrics in a plain-text format, one value per line in the
+    style understood by prometheus and friends.
+    """
+    lines = []
+    for ext_id, m in sorted(_metrics.items()):
+        label = 'ext="%s"' % (ext_id,)
+        for name in m.COUNTERS:
+            lines.append('raindrop_ext_%s_total{%s} %d' %
+                         (name, label, getattr(m, name).value))
+        if m.lag.value is not None:
+            lines.append('raindrop_ext_lag{%s} %d' % (label, m.lag.value))
+        for name in m.HISTOGRAMS:
+            prefix = 'raindrop_ext_%s_seconds' % name[:-len('_time')]
+            _format_histogram(lines, prefix, label, getattr(m, name))
+    for did, m in sorted(_view_metrics.items()):
+        label = 'ddoc="%s"' % (did,)
+        if m.lag.value is not None:
+            lines.append('raindrop_view_lag{%s} %d' % (label, m.lag.value))
+        with m.lock:
+            times = sorted(m.refresh_times.items())
+        for vn, histogram in times:
+            _format_histogram(lines, 'raindrop_view_refresh_seconds',
+                              '%s,view="%s"' % (label, vn), histogram)
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = format_text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format, *args)
+
+def start_http_server(port, host=''):
+    """Serve the metrics in plain-text on the specified port from a daemon
+    thread, so it goes away with the process.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsRequestHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    logger.info("serving metrics on port %d", server.server_port)
+    return server
@@ -21,14 +21,18 @@
 # Contributor(s):
 #
 
+from __future__ import with_statement
+
 import logging
-import time
 from urllib import quote
 import base64
 import itertools
+import copy
+import threading
 
 from .config import get_config
 from .wetpaisley import CouchDB, CouchError
+from .viewrefresh import ViewRefresher
 from raindrop import json
 
 logger = logging.getLogger('model')
@@ -43,17 +47,165 @@ class DocumentSaveError(Exception):
 class DocumentOpenError(Exception):
     pass
 
+def encode_doc_id(rd_key, schema_id):
+    """Build the (unquoted) ID of the document holding the schema for the
+    rd_key.  DocumentModel.get_doc_id_for_schema_item() memoizes this.
+    """
+    key_type, key_val = rd_key
+    enc_key_val = encode_provider_id(json.dumps(key_val))
+    key_part = "%s.%s" % (key_type, enc_key_val)
+    return "!".join(['rc', key_part, schema_id])
+
 def encode_provider_id(proto_id):
     # a 'protocol' gives us a 'blob' used to identify the document; we create
     # a real docid from that protocol_id; we base64-encode what was given to
     # us to avoid the possibility of a '!' char, and also to better accomodate
     # truly binary strings (eg, a pickle or something bizarre)
-    return base64.encodestring(proto_id).replace('\n', '')
+    # (b64encode is encodestring without the line breaks.)
+    return base64.b64encode(proto_id)
 
 
 class _NotSpecified:
     pass
 
+
+def _memo_key(val):
+    # A hashable version of an rd_key value, or None if it can't be
+    # memoized.  Only strings and (nested) lists of them are - other values
+    # may compare equal while encoding differently (eg, 1, 1.0 and True).
+    if isinstance(val, basestring):
+        return val
+    if isinstance(val, list):
+        ret = []
+        for item in val:
+            if not isinstance(item, basestring):
+                item = _memo_key(item)
+                if item is None:
+                    return None
+            ret.append(item)
+        return tuple(ret)
+    return None
+
+
+class DocIdCache(object):
+    """A bounded, thread-safe LRU cache of document IDs keyed by the
+    (rd_key, rd_schema_id) they encode.
+
+    Building a document ID means json-encoding and base64-encoding the
+    rd_key, and the ID of an item is needed many times on its way to the
+    database.  As a bonus, every item with the same key shares the one ID
+    string.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.ids = {} # (key_type, memo_key, schema_id) -> [doc_id, tick]
+        self.tick = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Returns None if we don't have it.  No lock - the GIL keeps the
+        # lookup safe, and all a race with another thread costs is an entry
+        # looking a little older than it is when we next drop some.
+        entry = self.ids.get(key)
+        if entry is None:
+            return None
+        self.tick += 1
+        entry[1] = self.tick
+        return entry[0]
+
+    def put(self, key, doc_id):
+        with self.lock:
+            self.tick += 1
+            self.ids[key] = [doc_id, self.tick]
+            if len(self.ids) > self.max_size:
+                # drop the least recently used quarter.
+                by_age = sorted(self.ids.iteritems(), key=lambda i: i[1][1])
+                for key, _ in by_age[:len(by_age)//4 or 1]:
+                    del self.ids[key]
+
+
+class DocumentCache(object):
+    """A bounded, thread-safe LRU cache of documents keyed by their ID.
+
+    Each entry is the document as it exists in the database at its _rev;
+    None means we know the document doesn't exist.  Copies are made going
+    in and out so callers can modify what they get.  Documents with
+    attachments aren't cached as what we wrote (inline data) isn't what
+    couch holds (stubs).
+
+    The cache is only enabled while something (ie, the pipeline's _changes
+    reader) is invalidating entries as other processes change documents.
+    """
+    def __init__(self, max_size):
+        self.enabled = False
+        self.max_size = max_size
+        self.docs = {} # doc_id -> [doc, last-used tick]
+        self.tick = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, doc_id, rev=None):
+        """Returns a copy of the cached doc (or None if it is known to not
+        exist).  Raises KeyError if not cached, or if rev is specified and
+        the cached doc isn't at that revision.
+        """
+        with self.lock:
+            if not self.enabled:
+                raise KeyError(doc_id)
+            try:
+                entry = self.docs[doc_id]
+            except KeyError:
+                self.misses += 1
+                raise
+            doc = entry[0]
+            if rev is not None and (doc is None or doc['_rev'] != rev):
+                self.misses += 1
+                raise KeyError(doc_id)
+            self.hits += 1
+            self.tick += 1
+            entry[1] = self.tick
+        return copy.deepcopy(doc)
+
+    def put(self, doc_id, doc):
+        if not self.enabled:
+            return
+        if doc is not None and '_attachments' in doc:
+            self.invalidate(doc_id)
+            return
+        doc = copy.deepcopy(doc)
+        with self.lock:
+            self.tick += 1
+            self.docs[doc_id] = [doc, self.tick]
+            if len(self.docs) > self.max_size:
+                # drop the least recently used quarter.
+                by_age = sorted(self.docs.iteritems(), key=lambda i: i[1][1])
+                for did, _ in by_age[:len(by_age)//4 or 1]:
+                    del self.docs[did]
+
+    def invalidate(self, doc_id, rev=None):
+        """Forget a document - if rev is specified only if the cached
+        document isn't at that revision."""
+        with self.lock:
+            entry = self.docs.get(doc_id)
+            if entry is None:
+                return
+            if rev is not None and entry[0] is not None and \
+               entry[0]['_rev'] == rev:
+                return
+            del self.docs[doc_id]
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            self.docs.clear()
+        logger.debug("document cache had %d hits and %d misses", self.hits,
+                     self.misses)
+
+
 # XXX - get_db should die as a global/singleton - only our DocumentModel
 # instance should care about that.  Sadly, bootstrap.py is a (small; later)
 # problem here...
@@ -79,9 +231,12 @@ class DocumentModel(object):
        for fetching documents based on an ID, etc
     """
     MAX_INLINE_ATTACH_SIZE = 100000 # pulled from a hat!
+    # The number of documents we remember having written or read.
+    DOC_CACHE_SIZE = 5000
     def __init__(self, db):
         self.db = db
-        self._important_views = None # views we update periodically
+        self.doc_cache = DocumentCache(self.DOC_CACHE_SIZE)
+        self.view_refresher = ViewRefresher(self)
         self._extension_confidences = {}
 
     def set_extension_confidences(self, conf):
@@ -165,6 +320,38 @@ class DocumentModel(object):
                      docId, viewId, args, kwargs)
         return self.db.openView(docId, viewId, *args, **kwargs)
 
+    def open_view_pages(self, startkey, endkey, page_size, start=None,
+                        docId='raindrop!content!all', viewId='megaview',
+                        **kwargs):
+        """Generate the rows of a view between startkey and endkey a page
+        at a time, so huge results needn't be held in memory.  Yields
+        (rows, next_start) tuples, where rows has at most page_size rows and
+        next_start is the position of the next page (or None after the last
+        page) - pass it as 'start' to resume from there.
+
+        Each page is fetched using startkey and startkey_docid, so it is a
+        seek into the index rather than an ever-growing 'skip', and rows
+        already returned may be deleted without upsetting the paging.
+        """
+        while True:
+            opts = kwargs.copy()
+            opts['endkey'] = endkey
+            # an extra row tells us where the next page starts.
+            opts['limit'] = page_size + 1
+            if start is None:
+                opts['startkey'] = startkey
+            else:
+                opts['startkey'], opts['startkey_docid'] = start
+            rows = self.open_view(docId, viewId, **opts)['rows']
+            if len(rows) > page_size:
+                next_row = rows.pop()
+                start = [next_row['key'], next_row['id']]
+            else:
+                start = None
+            yield rows, start
+            if start is None:
+                break
+
     def open_documents_by_id(self, doc_ids, **kw):
         """Open documents by the already constructed docid"""
         logger.debug("attempting to open documents %r", doc_ids)
@@ -200,6 +387,9 @@ class DocumentModel(object):
                     ret.append({'_id': row['id']})
         return ret
 
+    # the IDs of recently seen keys.
+    doc_id_cache = DocIdCache(10000)
+
     @classmethod
     def get_doc_id_for_schema_item(cls, si):
         """Returns an *unquoted* version of the doc ID"""
@@ -209,16 +399,26 @@ class DocumentModel(object):
             assert '_deleted' in si or \
                    cls._calc_doc_id_for_schema_item(si)==si['_id'], si
             return si['_id']
+        # (memoized by the doc_id_cache - the caller's item is left alone.)
         return cls._calc_doc_id_for_schema_item(si)
 
     @classmethod
     def _calc_doc_id_for_schema_item(cls, si):
         key_type, key_val = si['rd_key']
-        enc_key_val = encode_provider_id(json.dumps(key_val))
-        key_part = "%s.%s" % (key_type, enc_key_val)
         sch_id = si['rd_schema_id']
-        bits = ['rc', key_part, sch_id]
-        return "!".join(bits)
+        # most keys are a simple string - save a call for them.
+        if isinstance(key_val, basestring):
+            memo_key = key_val
+        else:
+            memo_key = _memo_key(key_val)
+        if memo_key is None:
+            return encode_doc_id(si['rd_key'], sch_id)
+        memo_key = (key_type, memo_key, sch_id)
+        ret = cls.doc_id_cache.get(memo_key)
+        if ret is None:
+            ret = encode_doc_id(si['rd_key'], sch_id)
+            cls.doc_id_cache.put(memo_key, ret)
+        return ret
 
     @classmethod
     def split_doc_id(cls, doc_id, decode_key=True):
@@ -237,6 +437,7 @@ class DocumentModel(object):
     def delete_documents(self, docs):
         for doc in docs:
             doc['_deleted'] = True
+            self.doc_cache.invalidate(doc['_id'])
         results = self.db.updateDocuments(docs)
         # XXX - this error handling is also duplicated below.
         errors = []
@@ -251,6 +452,10 @@ class DocumentModel(object):
     def update_documents(self, docs):
         assert docs, "don't call me when you have no docs!"
         logger.debug("attempting to update %d documents", len(docs))
+        # we don't know what these docs will look like once saved.
+        for doc in docs:
+            if '_id' in doc:
+                self.doc_cache.invalidate(doc['_id'])
 
         attachments = self._prepare_attachments(docs)
         results = self.db.updateDocuments(docs)
@@ -272,6 +477,12 @@ class DocumentModel(object):
                              self.quote_id(name), info['data'],
                              content_type=info['content_type'],
                              revision=revision)
+                    # the doc now has a stub for it, like the doc in couch
+                    # (which also keeps it out of the doc cache.)
+                    doc.setdefault('_attachments', {})[name] = {
+                        'stub': True,
+                        'content_type': info['content_type'],
+                        }
 
                 real_ret.append(dinfo)
         if errors:
@@ -418,6 +629,7 @@ class DocumentModel(object):
                 # turn be caught and handled.)
                 if mname in item and \
                    mname != '_rev' and \
+                   doc[mname] != item[mname] and \
                    self.hashable_key(doc[mname]) != self.hashable_key(item[mname]):
                     raise RuntimeError("doc confused about %s - %s vs %s\ndoc=%s\nitem=%s" %
                                        (mname, doc[mname], item[mname], doc, item))
@@ -438,6 +650,11 @@ class DocumentModel(object):
             doc['rd_schema_provider'] = item['rd_schema_provider']
         if 'rd_deps' in item:
             si[ext_id]['rd_deps'] = item['rd_deps']
+        # the version of the extension which wrote the item.
+        if 'rd_ext_fingerprint' in item:
+            si[ext_id]['rd_ext_fingerprint'] = item['rd_ext_fingerprint']
+        else:
+            si[ext_id].pop('rd_ext_fingerprint', None)
         self._aggregate_doc(doc)
 
     def create_schema_items(self, item_defs):
@@ -453,9 +670,10 @@ class DocumentModel(object):
         # existed, but the item_def doesn't have a _rev.
         assert item_defs, "don't call me when you have no docs!"
         # first build a map of all doc IDs we care about
-        ids = set(self.get_doc_id_for_schema_item(si) for si in item_defs)
-        # open any docs which already exist.
-        docs = self.open_documents_by_id(list(ids))
+        ids = list(set(self.get_doc_id_for_schema_item(si) for si in item_defs))
+        # open any docs which already exist - those we recently wrote or read
+        # come from our cache.
+        docs = self._open_documents_for_update(ids)
         # map them based on the ID
         doc_map = {}
         orig_doc_map = {}
@@ -463,7 +681,11 @@ class DocumentModel(object):
             if doc is None:
                 doc = {}
             doc_map[did] = doc
-            orig_doc_map[did] = doc.copy()
+            orig = orig_doc_map[did] = doc.copy()
+            # the schema metadata is updated in-place, so needs a copy of
+            # its own for us to notice it changed.
+            if 'rd_schema_items' in doc:
+                orig['rd_schema_items'] = copy.deepcopy(doc['rd_schema_items'])
             if '_id' in doc:
                 assert doc['_id']==did, doc
             else:
@@ -490,18 +712,29 @@ class DocumentModel(object):
             if orig_doc_map[doc['_id']] == doc:
                 logger.debug("skipping update of doc %(_id)s - it is unchanged",
                              doc)
+                if '_rev' in doc:
+                    self.doc_cache.put(doc['_id'], doc)
             else:
                 to_up.append(doc)
 
         # and update the docs - but even though we must have been called with
         # schema items, we may have detected duplicates and removed them...
         if to_up:
+            # update_documents drops the docs from our cache, so a failure
+            # means we will re-read them next time.
             updated_docs = self.update_documents(to_up)
+            for doc, dinfo in zip(to_up, updated_docs):
+                if '_deleted' in doc:
+                    continue
+                doc['_rev'] = dinfo['rev']
+                self.doc_cache.put(doc['_id'], doc)
         else:
             updated_docs = []
         logger.debug("create_schema_items made %r", updated_docs)
         if conflicts:
-            logger.debug("create_schema_items has %d conflicts")
+            logger.debug("create_schema_items has %d conflicts", len(conflicts))
+            for did in conflicts:
+                self.doc_cache.invalidate(did)
             # convert to a 'real' conflict error
             exc_info = [{'error': 'conflict',
                          'id': did,
@@ -511,6 +744,25 @@ class DocumentModel(object):
             raise DocumentSaveError(exc_info)
         return updated_docs
 
+    def _open_documents_for_update(self, doc_ids):
+        # Like open_documents_by_id, but uses our cache of recently written
+        # and read documents.  Docs we fetch are added to the cache once they
+        # are written (or found to not need writing).
+        ret = [None] * len(doc_ids)
+        need = []
+        for i, did in enumerate(doc_ids):
+            try:
+                ret[i] = self.doc_cache.get(did)
+            except KeyError:
+                need.append(i)
+        if need:
+            docs = self.open_documents_by_id([doc_ids[i] for i in need])
+            for i, doc in zip(need, docs):
+                ret[i] = doc
+        logger.debug("opened %d docs for update - %d from the cache",
+                     len(doc_ids), len(doc_ids)-len(need))
+        return ret
+
     def open_schemas(self, wanted, **kw):
         dids = []
         for (rd_key, schema_id) in wanted:
@@ -527,11 +779,13 @@ class DocumentModel(object):
         # a http connection.  For now though we just do all attachments
         # separately.
 
-        # attachment processing still need more thought - ultimately we need
-        # to be able to 'push' them via a generator or similar to avoid
-        # reading them entirely in memory. Further, we need some way of the
-        # document knowing if the attachment failed (or vice-versa) given we
-        # have no transactional semantics.
+        # The data for an attachment may be a file-like object rather than a
+        # string, in which case it is always saved separately and streamed
+        # to couch rather than being read entirely into memory.
+
+        # attachment processing still need more thought - we need some way
+        # of the document knowing if the attachment failed (or vice-versa)
+        # given we have no transactional semantics.
         all_attachments = []
         for doc in docs:
             assert '_id' in doc, doc
@@ -552,8 +806,14 @@ class DocumentModel(object):
             else:
                 total_bytes = 0
                 for a in this_attach.values():
-                    total_bytes += len(a.get('data', []))
-                if total_bytes > self.MAX_INLINE_ATTACH_SIZE:
+                    data = a.get('data', '')
+                    if hasattr(data, 'read'):
+                        # a stream - it can't be inlined.
+                        total_bytes = None
+                        break
+                    total_bytes += len(data)
+                if total_bytes is None or \
+                   total_bytes > self.MAX_INLINE_ATTACH_SIZE:
                     # nuke non-deleted attachments specified
                     split_attachments = {}
                     for name, a in this_attach.items():
@@ -605,49 +865,9 @@ class DocumentModel(object):
         return found, infos[found]
 
     def _update_important_views(self):
-        # Something else periodically updates our important views.
-        if not self._important_views:
-            # these keys come from jquery.couch.js
-            docs = self.db.listDoc(startkey="_design", endkey="_design0",
-                                   include_docs=True,
-                                   )
-            return self._do_update_views(docs)
-        return self._do_update_views(None)
-
-    def _do_update_views(self, result):
-        if result is not None:
-            self._important_views = []
-            for row in result['rows']:
-                if 'error' in row or 'deleted' in row['value']:
-                    continue
-                doc_id = row['id'][len('_design/'):]
-                self._important_views.append((doc_id, row['doc']['views']))
-
-        # We could use a DeferredList to run them all in parallel, but
-        # it might make more sense to run them sequentially so we don't
-        # overload the couch while we are still feeding it docs...
-        # (However, each view update can run in parallel - so if we have
-        # lotsa cores, doing more than 1 at a time makes sense...)
-        # As the views are slow we keep some timings and log them at the end...
-        logger.info("important view updates starting.")
-        slowest = 0
-        slowest_info = None, None
-        st = time.time()
-        for did, vns in self._important_views:
-            logger.debug("updating views in %s", did)
-            tst = time.time()
-            # limit=0 updates without giving us rows.
-            for vn in vns:
-                self.open_view(did, vn, limit=0)
-            took = time.time() - tst
-            if took > slowest:
-                slowest = took
-                slowest_info = did, vn
-            logger.debug("View in %s updated in %d sec(s)", did, took)
-        all_took = int(time.time() - st)
-        if all_took:
-            logger.info("updated %d view docs in %d secs - slowest was '%s' at %d secs.",
-                        len(self._important_views), all_took, slowest_info[0], slowest)
+        # Refresh all our views now - otherwise the view_refresher keeps
+        # them up-to-date in the background.
+        self.view_refresher.refresh()
 
 _doc_model = None
 
@@ -659,12 +879,8 @@ def get_doc_model():
 
 def fab_db():
     couch_name = 'local'
-    db = get_db(couch_name, None)
-    dbinfo = get_config().couches[couch_name]
-
     try:
-        server = CouchDB(dbinfo['host'], dbinfo['port'], dbinfo['name'])
-        server.createDB()
+        get_db(couch_name).createDB()
     except CouchError, exc:
         if exc.status != 412: # precondition failed...
             raise
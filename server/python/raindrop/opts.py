@@ -116,6 +116,91 @@ def get_request_options():
     yield Option("", "--continuous", action="store_true",
                 help="Wait for more changes once the queue is complete.")
 
+    yield Option("", "--changes-filter", action="store_true",
+                help="Use a server-side filter so the _changes feed only "
+                     "delivers documents the loaded extensions care about.")
+
+    yield Option("", "--inline-docs", action="store_true",
+                help="Have the _changes feed include the documents, saving "
+                     "a request to fetch each one before processing.  This "
+                     "also lets --priority-age see their timestamps.")
+
+    yield Option("", "--page-size", type="int", default=500,
+                help="The number of documents the unprocess, reprocess and "
+                     "retry-errors commands work on at a time.  If "
+                     "interrupted, running the same command again carries "
+                     "on from where it got to.")
+
+    yield Option("", "--reprocess-stale", action="store_true",
+                help="While processing, reprocess in the background the "
+                     "documents an older version of an extension processed. "
+                     "This work gives way to new changes.")
+
+    yield Option("", "--checkpoint-interval", type="float", default=5,
+                help="How often, in seconds, the position of each work queue "
+                     "is saved.")
+
+    yield Option("", "--queue-workers", type="int", default=4,
+                help="The number of threads used to process the work "
+                     "queues; each queue is processed by at most one "
+                     "thread at a time.")
+
+    yield Option("", "--pending-window", type="float", default=5,
+                help="Extensions which ask for work to be done later (eg, "
+                     "rebuilding a conversation summary) have it done once "
+                     "no more has been asked for in this many seconds, so "
+                     "repeated requests are coalesced.")
+
+    yield Option("", "--pending-max-delay", type="float", default=60,
+                help="The longest, in seconds, work asked to be done later "
+                     "is held while waiting for the --pending-window.")
+
+    yield Option("", "--view-refresh-workers", type="int", default=2,
+                help="The number of design documents whose views are "
+                     "refreshed in parallel.")
+
+    yield Option("", "--view-refresh-lag", type="int", default=1000,
+                help="The views are refreshed in the background when the "
+                     "pipeline is idle, or when they are more than this "
+                     "many changes behind the database.")
+
+    yield NumSecondsOption("", "--priority-age", default="1day",
+                help="Documents with a timestamp newer than this are "
+                     "processed ahead of any backlog, as are documents "
+                     "written since the latest sync started.  eg, "
+                     "'2hours'.  The timestamps are only seen with "
+                     "--inline-docs.")
+
+    yield Option("", "--profile-ext", action="append", dest='profile_exts',
+                help="Profile the specified extension; the profiles are "
+                     "written to --profile-dir at shutdown.")
+
+    yield Option("", "--profile-dir",
+                help="The directory extension profiles are written to.  "
+                     "Defaults to the temp directory.")
+
+    yield Option("", "--code-cache-dir",
+                help="The directory the compiled code of extensions is "
+                     "cached in; it must be private to the user.  Defaults "
+                     "to a directory beside the config file.")
+
+    yield Option("", "--uptodate-cache",
+                help="The file recording which documents each extension "
+                     "has processed, so they needn't be checked again.  "
+                     "Defaults to a file beside the config file.")
+
+    yield Option("", "--no-uptodate-cache", action="store_true",
+                help="Don't use the cache of up-to-date documents.")
+
+    yield Option("", "--metrics-port", type="int",
+                help="Serve the pipeline metrics in plain-text over HTTP "
+                     "on this port.")
+
+    yield Option("", "--process-pool-size", type="int",
+                help="The number of worker processes used to run extensions "
+                     "which ask for process execution.  Defaults to the "
+                     "number of CPUs.")
+
     yield NumSecondsOption("", "--max-age", type="int",
                 help="Maximum age of an item to fetch.  eg, '30 seconds', "
                      "'2weeks'.")
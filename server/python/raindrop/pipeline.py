@@ -24,21 +24,44 @@
 """ This is the raindrop pipeline; it moves messages from their most raw
 form to their most useful form.
 """
+from __future__ import with_statement
+
+import os
 import sys
 import time
+import hashlib
 import itertools
+import copy
+import random
 import threading
 
+from raindrop.config import get_config
 from raindrop.model import DocumentSaveError
-from raindrop.changesiter import ChangesIterFactory
+from raindrop.changesiter import ChangesFeedMultiplexer
 
+import codecache
 import extenv
+import metrics
+import procpool
+import profiler
+import scheduler
+import uptodate
+from checkpoint import CheckpointService
+from writer import SchemaItemWriter
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class ExtensionInitError(Exception):
+    """An extension's code failed to initialize, so the extension has been
+    disabled.  Unlike a failure to process a document, this stops the
+    extension's queue rather than writing an error record for every doc.
+    """
+    pass
+
+
 class Extension(object):
     SMART = "smart" # a "smart" extension - handles dependencies etc itself.
     # a 'provider' of schema items; a schema is "complete" once a single
@@ -52,9 +75,23 @@ class Extension(object):
 
     ALL_CATEGORIES = (SMART, PROVIDER, EXTENDER)
 
-    def __init__(self, id, doc, globs):
+    # How the handler is executed - in a queue runner thread, or in one of
+    # a pool of worker processes (for CPU-bound extensions)
+    EXEC_THREAD = "thread"
+    EXEC_PROCESS = "process"
+    ALL_EXECUTIONS = (EXEC_THREAD, EXEC_PROCESS)
+
+    def __init__(self, id, doc, globs=None, code=None):
         self.id = id
         self.doc = doc
+        self.code = code
+        # A fingerprint of the source code, recorded with every item the
+        # extension writes, so we can find the items written by an older
+        # version of it.
+        src = doc.get('code') or ''
+        if isinstance(src, unicode):
+            src = src.encode('utf-8')
+        self.fingerprint = hashlib.md5(src).hexdigest()
         # make the source schemas more convenient to use...
         # XXX - source_schema is deprecated
         if 'source_schemas' in doc:
@@ -62,8 +99,36 @@ class Extension(object):
         else:
             self.source_schemas = [doc['source_schema']]
         self.confidence = doc.get('confidence')
-        self.globs = globs
-        self.running = False # for reentrancy testing...
+        self.execution = doc.get('execution', self.EXEC_THREAD)
+        if self.execution not in self.ALL_EXECUTIONS:
+            logger.error("extension %r has invalid execution %r (must be one of %s)",
+                         id, self.execution, self.ALL_EXECUTIONS)
+            self.execution = self.EXEC_THREAD
+        # How many documents this extension may process at once.  Each
+        # concurrent call gets its own module namespace, as the namespace
+        # is patched with the environment before each call.  Extensions run
+        # in worker processes default to keeping every worker busy.
+        if self.execution == self.EXEC_PROCESS:
+            def_concurrency = procpool.get_default_pool_size()
+        else:
+            def_concurrency = 1
+        self.concurrency = max(1, int(doc.get('concurrency', def_concurrency)))
+        if self.concurrency > 1 and code is None and \
+           self.execution == self.EXEC_THREAD:
+            logger.error("extension %r has no code so can't be run concurrently",
+                         id)
+            self.concurrency = 1
+        self.running = 0 # number of namespaces in use, for reentrancy testing.
+        # If we weren't given a namespace, the code isn't executed until
+        # one is first needed - many runs only use a few extensions.
+        if globs is None:
+            self.free_namespaces = []
+        else:
+            self.free_namespaces = [globs]
+        self.namespace_lock = threading.Lock()
+        self.filter_globs = globs
+        # Why the extension's code couldn't be initialized, or None.
+        self.disabled = None
         # the category - for now we have a default, but later should not!
         self.category = doc.get('category', self.PROVIDER)
         self.uses_dependencies = doc.get('uses_dependencies', False)
@@ -71,18 +136,82 @@ class Extension(object):
             logger.error("extension %r has invalid category %r (must be one of %s)",
                          id, self.category, self.ALL_CATEGORIES)
 
-        self.handler = globs.get('handler')
-        self.later_handler = globs.get('later_handler')
         if self.source_schemas is None:
-            self.filter = globs.get('filter')
-            if not self.filter:
-                logger.error("extension %r has null source_schemas but doesn't"
-                             " provide a filter function")
+            self.filter = self._filter_from_code
         else:
             # a default filter which checks the schema id is one we want.
             self.filter = lambda src_id, src_rev, schema_id: schema_id in self.source_schemas
 
+    def acquire_namespace(self):
+        """Return a module namespace for the extension not currently in use
+        by anyone else.  New namespaces are made on demand up to our
+        concurrency level by executing the extension code again.
+        """
+        with self.namespace_lock:
+            if self.running >= self.concurrency:
+                raise RuntimeError, "%r is already running" % self.id
+            self.running += 1
+            try:
+                return self.free_namespaces.pop()
+            except IndexError:
+                pass
+        try:
+            globs = self._make_namespace()
+        except:
+            self.release_namespace(None)
+            raise
+        logger.debug("created namespace %d for extension %r", self.running,
+                     self.id)
+        return globs
+
+    def _make_namespace(self):
+        if self.disabled is not None:
+            raise ExtensionInitError(self.disabled)
+        globs = {}
+        try:
+            exec self.code in globs
+        except Exception, exc:
+            self.disable("Failed to initialize extension %r: %s"
+                         % (self.id, exc))
+        handler = globs.get('handler')
+        if handler is None or not callable(handler):
+            self.disable("source-code in extension %r doesn't have a "
+                         "'handler' function" % self.id)
+        if self.source_schemas is None and not globs.get('filter'):
+            self.disable("extension %r has null source_schemas but doesn't "
+                         "provide a filter function" % self.id)
+        return globs
+
+    def disable(self, reason):
+        """Called when the extension's code can't be initialized; nothing
+        will be run by this extension again.
+        """
+        if self.disabled is None:
+            logger.error("%s - the extension is disabled", reason)
+            self.disabled = reason
+        raise ExtensionInitError(reason)
+
+    def _filter_from_code(self, src_id, src_rev, schema_id):
+        # Extensions with null source_schemas provide a filter function,
+        # which is called from a namespace of its own.
+        if self.filter_globs is None:
+            with self.namespace_lock:
+                if self.filter_globs is None:
+                    self.filter_globs = self._make_namespace()
+        return self.filter_globs['filter'](src_id, src_rev, schema_id)
+
+    def release_namespace(self, globs):
+        with self.namespace_lock:
+            assert self.running
+            self.running -= 1
+            if globs is not None:
+                self.free_namespaces.append(globs)
+
 def load_extensions(doc_model):
+    """Load the extensions from the database.  The code for each is compiled
+    (via the code cache) but isn't executed until the extension is first
+    used.
+    """
     extensions = {}
     # now try the DB - load everything with a rd.ext.workqueue schema
     key = ["schema_id", "rd.ext.workqueue"]
@@ -98,23 +227,17 @@ def load_extensions(doc_model):
             logger.error("Content-type of %r is not supported", ct)
             continue
         try:
-            co = compile(src, "<%s>" % ext_id, "exec")
+            co = codecache.compile_source(src, "<%s>" % ext_id)
         except SyntaxError, exc:
             logger.error("Failed to compile %r: %s", ext_id, exc)
             continue
-        globs = {}
-        try:
-            exec co in globs
-        except Exception, exc:
-            logger.error("Failed to initialize extension %r: %s", ext_id, exc)
+        # The code isn't run yet, but we can see if it defines a handler.
+        if 'handler' not in co.co_names:
+            logger.error("source-code in extension %r doesn't have a "
+                         "'handler' function", ext_id)
             continue
         assert ext_id not in extensions, ext_id # another with this ID??
-        ext = Extension(ext_id, doc, globs)
-        if ext.handler is None or not callable(ext.handler):
-            logger.error("source-code in extension %r doesn't have a 'handler' function",
-                         ext_id)
-            continue
-        extensions[ext_id] = ext
+        extensions[ext_id] = Extension(ext_id, doc, code=co)
     return extensions
 
 
@@ -122,17 +245,49 @@ class Pipeline(object):
     """A manager for running items through the pipeline using various
     different strategies.
     """
+    # How often background work checks if the queues have caught up.
+    THROTTLE_INTERVAL = 1
     def __init__(self, doc_model, options):
         self.doc_model = doc_model
         self.options = options
         self.runner = None
         self._additional_processors = {}
+        # changes after this sequence are processed ahead of the backlog.
+        self.priority_seq = None
+        # the documents extensions have already processed, or None.
+        self.uptodate = None
 
     def initialize(self):
-        pass
+        if self.options.code_cache_dir:
+            codecache.cache_dir = self.options.code_cache_dir
+        # The extension worker processes must be forked before we start
+        # any threads (see procpool).
+        spec_exts = self.options.exts
+        for ext in self.get_extensions():
+            if ext.execution == ext.EXEC_PROCESS and \
+               (spec_exts is None or ext.id in spec_exts):
+                procpool.start_pool(self.options.process_pool_size)
+                break
+        if not self.options.no_uptodate_cache:
+            filename = self.options.uptodate_cache
+            if not filename:
+                # beside the config file, and named for the database.
+                config_dir = os.path.dirname(get_config().filename)
+                filename = os.path.join(config_dir, ".%s-uptodate.sqlite"
+                                        % self.doc_model.db.dbName)
+            self.uptodate = uptodate.open_cache(filename)
+        refresher = self.doc_model.view_refresher
+        refresher.num_workers = self.options.view_refresh_workers
+        refresher.max_lag = self.options.view_refresh_lag
+        refresher.start()
 
     def finalize(self):
-        pass
+        self.doc_model.view_refresher.stop()
+        procpool.shutdown_pool()
+        profiler.dump_all(self.options.profile_dir)
+        if self.uptodate is not None:
+            self.uptodate.close()
+            self.uptodate = None
 
     def add_processor(self, proc):
         proc_id = proc.ext.id
@@ -142,6 +297,16 @@ class Pipeline(object):
                         proc_id)
         self._additional_processors[proc_id] = proc
 
+    def prioritize_new_changes(self):
+        """Called as a sync starts - any changes made from now on (ie, the
+        new items it finds and everything derived from them) are processed
+        ahead of any backlog the queues are working through.
+        """
+        self.priority_seq = self.doc_model.db.infoDB()['update_seq']
+        runner = self.runner
+        if runner is not None:
+            runner.set_priority_seq(self.priority_seq)
+
     def provide_schema_items(self, items):
         """The main entry-point for 'providers' - mainly so we can do
         something smart as the provider finds new items - although what
@@ -167,10 +332,12 @@ class Pipeline(object):
         if spec_exts is None:
             spec_exts = self.options.exts
         ret = []
-        for ext in self.get_extensions():
+        # in a consistent order, so interrupted bulk operations can resume.
+        for ext in sorted(self.get_extensions(), key=lambda ext: ext.id):
             qid = ext.id
             if spec_exts is None or qid in spec_exts:
-                proc = ExtensionProcessor(self.doc_model, ext, self.options)
+                proc = ExtensionProcessor(self.doc_model, ext, self.options,
+                                          self.uptodate)
                 qr = ProcessingQueueRunner(self.doc_model, proc, qid)
                 ret.append(qr)
         # and the non-extension based ones.
@@ -186,8 +353,21 @@ class Pipeline(object):
 
         self.runner = StatefulQueueManager(self.doc_model, pqrs,
                                            self.options)
+        self.runner.set_priority_seq(self.priority_seq)
+        if self.options.reprocess_stale:
+            stale_thread = threading.Thread(target=self._reprocess_stale_safe)
+            stale_thread.setDaemon(True)
+            stale_thread.start()
+            # We aren't finished until the items it writes are processed.
+            def stable_callback(seq):
+                if stale_thread.isAlive():
+                    return False
+                return cont_stable_callback is None or \
+                       cont_stable_callback(seq)
+        else:
+            stable_callback = cont_stable_callback
         try:
-            self.runner.run(cont_stable_callback)
+            self.runner.run(stable_callback)
         finally:
             self.runner = None
         # count the number of errors - mainly for the test suite.
@@ -196,50 +376,161 @@ class Pipeline(object):
         # as it is what is doing the items created by the queue
         return nerr
 
+    def _load_bulk_op_state(self, name):
+        # The state of a (possibly interrupted) bulk operation such as
+        # 'unprocess'.  It has no rd_source, so unprocess doesn't delete it.
+        rd_key = ["raindrop", "bulk-op-" + name]
+        si = {'rd_key': rd_key,
+              'rd_schema_id': 'rd.core.bulk-op-state',
+              'rd_ext_id': 'rd.core',
+              'rd_source': None,
+              }
+        doc = self.doc_model.open_schemas([(rd_key, si['rd_schema_id'])])[0]
+        if doc is None:
+            si['items'] = {}
+        else:
+            si['_rev'] = doc['_rev']
+            _, si['items'] = self.doc_model.split_meta_from_items(doc)
+        return si
+
+    def _save_bulk_op_state(self, si):
+        result = self.doc_model.create_schema_items([si])
+        if result: # not written if it is unchanged.
+            si['_rev'] = result[0]['rev']
+
+    def _delete_bulk_op_state(self, si):
+        if '_rev' in si:
+            self.doc_model.create_schema_items([{
+                'rd_key': si['rd_key'],
+                'rd_schema_id': si['rd_schema_id'],
+                'rd_ext_id': si['rd_ext_id'],
+                '_rev': si['_rev'],
+                '_deleted': True,
+                }])
+
+    def _count_rows(self, startkey, endkey, start=None):
+        # The megaview's reduce tells us how many rows there are.
+        kw = {}
+        if start is not None:
+            startkey, kw['startkey_docid'] = start
+        rows = self.doc_model.open_view(startkey=startkey, endkey=endkey,
+                                        **kw)['rows']
+        return sum(row['value'] for row in rows)
+
+    def _run_bulk_op(self, name, spec, ranges, action, **view_kw):
+        """Call action(context, rows) for the megaview rows in each of
+        ranges (a list of (startkey, endkey, context) tuples), --page-size
+        rows at a time, so we never hold the entire result in memory.
+
+        Where we are up to is saved after each page; if the operation is
+        interrupted, running it again with the same spec (which must be
+        json-able) carries on from where it left off.  Returns the number
+        of rows processed.
+        """
+        page_size = self.options.page_size
+        state = self._load_bulk_op_state(name)
+        saved = state['items']
+        if saved.get('spec') == spec:
+            first, start, done = saved['range'], saved['start'], saved['done']
+            logger.info("%s: resuming an interrupted run after %d rows",
+                        name, done)
+        else:
+            first, start, done = 0, None, 0
+        todo = 0
+        for i, (startkey, endkey, _) in enumerate(ranges[first:]):
+            todo += self._count_rows(startkey, endkey, start if i==0 else None)
+        logger.info("%s: %d rows to process", name, todo)
+        num = 0
+        for index in range(first, len(ranges)):
+            startkey, endkey, context = ranges[index]
+            pages = self.doc_model.open_view_pages(startkey, endkey, page_size,
+                                                   start=start, reduce=False,
+                                                   **view_kw)
+            for rows, start in pages:
+                if rows:
+                    action(context, rows)
+                num += len(rows)
+                if start is None:
+                    # on to the next range.
+                    state['items'] = {'spec': spec, 'range': index + 1,
+                                      'start': None, 'done': done + num}
+                else:
+                    state['items'] = {'spec': spec, 'range': index,
+                                      'start': start, 'done': done + num}
+                self._save_bulk_op_state(state)
+                logger.info("%s: processed %d of %d rows (%d%%)", name, num,
+                            todo, num * 100 / max(todo, 1))
+        self._delete_bulk_op_state(state)
+        logger.info("%s: finished after %d rows", name, done + num)
+        return num
+
+    def _delete_schema_items(self, items):
+        dm = self.doc_model
+        try:
+            dm.create_schema_items(items)
+        except DocumentSaveError, exc:
+            # A doc holds the schemas from every extension providing it, so
+            # a previous page may have already changed it.  Try again with
+            # the current revision of those.
+            conflicts = set(info['id'] for info in exc.infos
+                            if info.get('error') == 'conflict')
+            if not conflicts:
+                raise
+            ids = list(conflicts)
+            docs = dict(zip(ids, dm.open_documents_by_id(ids)))
+            retry = []
+            for item in items:
+                doc = docs.get(item['_id'])
+                if doc is None or \
+                   item['rd_ext_id'] not in doc.get('rd_schema_items', {}):
+                    continue # not conflicting, or already gone.
+                item['_rev'] = doc['_rev']
+                retry.append(item)
+            logger.debug("retrying the deletion of %d conflicting schemas",
+                         len(retry))
+            if retry:
+                dm.create_schema_items(retry)
+
     def unprocess(self):
         # Just nuke all items that have a 'rd_source' specified...
-        # XXX - should do this in a loop with a limit to avoid chewing
-        # all mem...
         if self.options.exts:
-            runners = self.get_queue_runners()
-            keys = [['ext_id', r.queue_id] for r in runners]
-            result = self.doc_model.open_view(keys=keys, reduce=False)
-            to_up = [{'_id': row['id'],
-                      '_rev': row['value']['_rev'],
-                      'rd_key': row['value']['rd_key'],
-                      'rd_schema_id': row['value']['rd_schema_id'],
-                      'rd_ext_id': row['key'][-1],
-                      '_deleted': True
-                      } for row in result['rows']]
+            ranges = []
+            for r in self.get_queue_runners():
+                key = ['ext_id', r.queue_id]
+                ranges.append((key, key, None))
+                if self.uptodate is not None:
+                    self.uptodate.forget(r.queue_id)
         else:
-            result = self.doc_model.open_view(
-                                # skip NULL rows.
-                                startkey=['source', ""],
-                                endkey=['source', {}],
-                                reduce=False)
+            # skip NULL rows.
+            ranges = [(['source', ""], ['source', {}], None)]
+            if self.uptodate is not None:
+                self.uptodate.forget()
 
+        def delete_rows(context, rows):
             to_up = [{'_id': row['id'],
                       '_rev': row['value']['_rev'],
                       'rd_key': row['value']['rd_key'],
                       'rd_schema_id': row['value']['rd_schema_id'],
                       'rd_ext_id': row['value']['rd_ext_id'],
                       '_deleted': True
-                      } for row in result['rows']]
-        logger.info('deleting %d schemas', len(to_up))
-        if to_up:
-            self.doc_model.create_schema_items(to_up)
+                      } for row in rows]
+            self._delete_schema_items(to_up)
+
+        spec = {'exts': self.options.exts}
+        num = self._run_bulk_op('unprocess', spec, ranges, delete_rows)
+        logger.info('deleted %d schemas', num)
 
         # and rebuild our views
         logger.info("rebuilding all views...")
         self.doc_model._update_important_views()
 
-    def _reprocess_items(self, item_gen_factory, *factory_args):
+    def _reprocess_items(self, runners, item_gen_factory, *factory_args):
         self.options.force = True # evil!
-        runners = self.get_queue_runners()
         results = [r.process_queue(item_gen_factory(*factory_args)) 
                    for r in runners]
         num = sum(results)
         logger.info("reprocess made %d new docs", num)
+        return num
 
     def reprocess(self):
         # We can't just reset all work-queues as there will be a race
@@ -250,21 +541,18 @@ class Pipeline(object):
         # first wave of extensions to re-run, which will trigger the next
         # etc.
         # However, if extensions are named, only those are reprocessed
-        dm = self.doc_model
-        def gen_em(this_result):
-            to_proc = ((row['id'], row['value']['_rev'])
-                       for row in this_result['rows'])
-            for id, rev in to_proc:
-                yield id, rev, None, None
+        def gen_em(rows):
+            for row in rows:
+                yield row['id'], row['value']['_rev'], None, None
 
+        def reprocess_rows(runners, rows):
+            self._reprocess_items(runners, gen_em, rows)
+
+        ranges = []
         if not self.options.exts and not self.options.keys:
-            # fetch all items with a null 'rd_source'
-            result = dm.open_view(
-                            key=['source', None],
-                            reduce=False)
-            logger.info("reprocess found %d source documents",
-                        len(result['rows']))
-            self._reprocess_items(gen_em, result)
+            # all items with a null 'rd_source'
+            key = ['source', None]
+            ranges.append((key, key, self.get_queue_runners()))
         else:
             # do each specified extension one at a time to avoid the races
             # if extensions depend on each other...
@@ -274,17 +562,15 @@ class Pipeline(object):
                     # But only for the specified rd_keys
                     keys = []
                     for k in self.options.keys:
-                        for sch_id in qr.schema_ids:
+                        for sch_id in qr.processor.ext.source_schemas:
                             keys.append(['key-schema_id', [k, sch_id]])
                 else:
                     # all rd_keys...
                     keys=[['schema_id', sch_id] for sch_id in qr.processor.ext.source_schemas]
-                result = dm.open_view(keys=keys,
-                                            reduce=False)
-                logger.info("reprocessing %s - %d docs", qr.queue_id,
-                            len(result['rows']))
-                self._reprocess_items(gen_em, result)
-
+                for key in keys:
+                    ranges.append((key, key, [qr]))
+        spec = {'exts': self.options.exts, 'keys': self.options.keys}
+        self._run_bulk_op('reprocess', spec, ranges, reprocess_rows)
 
     def start_retry_errors(self):
         """Attempt to re-process all messages for which our previous
@@ -296,17 +582,80 @@ class Pipeline(object):
         # It does have the bad side-effect of re-running all extensions which
         # also ran against the source of the error - that can be fixed, but
         # later...
-        key = ["schema_id", "rd.core.error"]
-        result = self.doc_model.open_view(key=key, reduce=False,
-                                          include_docs=True)
-        logger.info("found %d error records", len(result['rows']))
-        def gen_em():
-            for row in result['rows']:
+        def gen_em(rows):
+            for row in rows:
+                if row['doc'] is None:
+                    continue # deleted as an earlier page was reprocessed.
                 for ext_info in row['doc']['rd_schema_items'].itervalues():
                     src_id, src_rev = ext_info['rd_source']
                     yield src_id, src_rev, None, None
 
-        self._reprocess_items(gen_em)
+        def retry_rows(runners, rows):
+            self._reprocess_items(runners, gen_em, rows)
+
+        key = ["schema_id", "rd.core.error"]
+        ranges = [(key, key, self.get_queue_runners())]
+        spec = {'exts': self.options.exts}
+        num = self._run_bulk_op('retry-errors', spec, ranges, retry_rows,
+                                include_docs=True)
+        logger.info("found %d error records", num)
+
+    def _wait_for_queues(self):
+        # Background work gives way to the queues while they have changes
+        # to process.
+        while True:
+            runner = self.runner
+            if runner is None or runner.is_idle():
+                break
+            time.sleep(self.THROTTLE_INTERVAL)
+
+    def _reprocess_stale_safe(self):
+        try:
+            self.reprocess_stale(throttle=True)
+        except Exception:
+            logger.exception("reprocessing stale items failed")
+
+    def reprocess_stale(self, throttle=False):
+        """Reprocess the documents an extension processed using a different
+        version of its code - ie, the fingerprint recorded with the items it
+        wrote isn't the current one.  Items written before fingerprints were
+        recorded are considered stale.
+
+        If throttle is True, we only work while the queues being run by
+        start_processing() have nothing else to do.
+        """
+        runners = [qr for qr in self.get_queue_runners()
+                   if hasattr(qr.processor.ext, 'fingerprint')]
+        def reprocess_rows(qr, rows):
+            fingerprint = qr.processor.ext.fingerprint
+            stale = []
+            seen = set()
+            for row in rows:
+                value = row['value']
+                src = value['rd_source']
+                if src is None or \
+                   value['rd_schema_id'] == 'rd.core.workqueue-state' or \
+                   value.get('rd_ext_fingerprint') == fingerprint or \
+                   src[0] in seen:
+                    continue
+                seen.add(src[0])
+                stale.append((src[0], src[1], None, None))
+            if not stale:
+                return
+            if throttle:
+                self._wait_for_queues()
+            logger.debug("reprocessing %d stale documents for %r",
+                         len(stale), qr.queue_id)
+            qr.process_queue(iter(stale))
+
+        ranges = []
+        fingerprints = {}
+        for qr in runners:
+            key = ['ext_id', qr.queue_id]
+            ranges.append((key, key, qr))
+            fingerprints[qr.queue_id] = qr.processor.ext.fingerprint
+        spec = {'fingerprints': fingerprints}
+        self._run_bulk_op('reprocess-stale', spec, ranges, reprocess_rows)
 
 
 # Used by the 'process' operation - runs all of the 'stateful work queues';
@@ -318,18 +667,48 @@ class QueueState:
     """helper object to remember the state of each queue"""
     def __init__(self):
         self.schema_item = None
-        self.last_saved_seq = 0
+        self.last_saved_items = None # what the checkpoint last wrote.
         self.failure = None
-        self.running = False
+        self.running = False # is a worker processing a batch for us?
 
 
 class StatefulQueueManager(object):
+    """Runs the queues using a fixed number of worker threads.
+
+    Queues with changes buffered are 'ready'; each idle worker takes a ready
+    queue (which the scheduler says may run), processes one batch from it,
+    then hands it back.  A queue is only ever processed by one worker at a
+    time.  Queues with changes in their priority lane (see
+    ChangesFeedMultiplexer) are taken ahead of the others, and don't wait
+    for their upstream queues.
+    """
+    # How often we log the status of the queues.
+    STATUS_INTERVAL = 10
+    # How often we re-ask the stable_callback if it said to keep going while
+    # everything was idle (it may be waiting on something else, eg, a sync)
+    STABLE_RECHECK_INTERVAL = 1
+    # How often idle workers look for queues the scheduler was holding back.
+    READY_RECHECK_INTERVAL = 1
+
     def __init__(self, dm, q_runners, options):
         assert q_runners, "nothing to do?"
         self.doc_model = dm
         self.queues = q_runners
         self.queue_states = None # a list, parallel with self.queues.
         self.options = options
+        self.changes_feed = None
+        self.scheduler = None
+        self.writer = None
+        self.checkpoints = None
+        # set whenever a queue or the feed changes state.
+        self.state_changed = threading.Event()
+        # workers wait on this for a queue to become ready.
+        self.ready_cond = threading.Condition()
+        self.stopping = False
+        # set once everything is idle and we want to finish, so items
+        # queues are holding for later are processed without waiting.
+        self.flush_pending_now = False
+        self.priority_seq = None
         self.status_msg_last = None
 
     def _q_status(self):
@@ -342,6 +721,7 @@ class StatefulQueueManager(object):
                 nfailed += 1
                 continue
             cs = qstate.feed.current_seq
+            qlook.metrics.lag.set(current_end - cs)
             this = cs, qlook.queue_id
             if this < lowest:
                 lowest = this
@@ -388,112 +768,260 @@ class StatefulQueueManager(object):
             state_info['_id'] = doc['_id']
             state_info['_rev'] = doc['_rev']
             state_info['items'] = {'seq' : doc.get('seq', 0)}
+            if 'emitted_schemas' in doc:
+                state_info['items']['emitted_schemas'] = doc['emitted_schemas']
         else:
             state_info['items'] = {'seq': 0}
+            # The queue is starting from scratch (eg, the database is new),
+            # so whatever we remember it processing is meaningless.
+            cache = getattr(qr.processor, 'uptodate', None)
+            if cache is not None:
+                cache.forget(qr.queue_id)
         ret = QueueState()
         ret.schema_item = state_info
-        ret.last_saved_seq = state_info['items']['seq']
+        ret.last_saved_items = state_info['items'].copy()
         return ret
 
-    def _save_queue_state(self, state, current_seq, num_created):
-        assert current_seq is not None
-        si = state.schema_item
-        seq = si['items']['seq'] = current_seq
-        # We can chew 1000 'nothing to do' docs quickly next time...
-        last_saved = state.last_saved_seq
-        if num_created or (seq-last_saved) > 1000:
-            logger.debug("flushing state doc at end of run...")
-            docs = self.doc_model.create_schema_items([si])
-            assert len(docs)==1, docs # only asked to save 1
-            si['_rev'] = docs[0]['rev']
-            state.last_saved_seq = seq
-        else:
-            logger.debug("no need to flush state doc")
-
-    def _run_queue(self, q, qstate, batch_size=2000):
-        logger.debug("initializing queue %r at sequence %s", q.queue_id, qstate.feed.current_seq)
-        qstate.running = True
-        qstate.failure = None
-        while qstate.running:
+    def _run_batch(self, q, qstate, batch_size=2000):
+        # We may have been chosen just because our pending items are due.
+        if qstate.feed.has_changes():
             batchiter = qstate.feed.make_iter(batch_size)
             logger.debug("starting batch for queue %r at sequence %s", q.queue_id, qstate.feed.current_seq)
-            num_created = q.process_queue(batchiter)
+            num_created = q.process_queue(batchiter,
+                                          qstate.feed.inline_docs,
+                                          defer_pending=True)
             logger.debug("Work queue %r finished batch at sequence %s",
                          q.queue_id, qstate.feed.current_seq)
-            self._save_queue_state(qstate, qstate.feed.current_seq, 0)
-
-    def _worker_thread(self, q, qs):
-        try:
-            self._run_queue(q, qs)
-        except Exception, exc:
-            logger.exception('queue %r failed', q.queue_id)
-            qs.failure = exc
-        qs.running = False
+        if self._pending_due(q):
+            q.flush_pending()
+        q.metrics.lag.set(self.changes_feed.last_seq - qstate.feed.current_seq)
+        # everything in the batch has been written, so the next
+        # checkpoint can record we are done with it - except for anything
+        # still pending.
+        seq = qstate.feed.current_seq
+        if q.pending_seq is not None:
+            seq = min(seq, q.pending_seq - 1)
+        self.checkpoints.update(qstate, seq, q.schemas_emitted)
+
+    def _pending_due(self, q):
+        # Should the items the queue has been asked to process later be
+        # processed now?  Waiting a while lets the same work requested by
+        # many batches be done once.
+        return q.pending_due(0 if self.flush_pending_now else
+                                  self.options.pending_window,
+                             self.options.pending_max_delay)
+
+    def _choose_queue(self, ready):
+        # A lottery weighted by how far each queue is behind the feed (ie,
+        # the update_seq as far as we have read), so the biggest backlogs
+        # get most of the workers without the small ones being starved.
+        last_seq = self.changes_feed.last_seq
+        weights = [max(last_seq - qs.feed.current_seq, 1)
+                   for q, qs in ready]
+        pick = random.uniform(0, sum(weights))
+        for (q, qs), weight in zip(ready, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        return q, qs
+
+    def _get_ready_queue(self):
+        # Blocks until a queue is ready and claims it for the caller;
+        # returns (None, None) once we are stopping.
+        with self.ready_cond:
+            while not self.stopping:
+                ready = []
+                urgent = []
+                for q, qs in zip(self.queues, self.queue_states):
+                    if qs.running or qs.failure is not None:
+                        continue
+                    # poll() also tells the feed when this queue is idle.
+                    if not qs.feed.poll():
+                        if self._pending_due(q) and \
+                           self.scheduler.can_run(q.queue_id):
+                            ready.append((q, qs))
+                        continue
+                    # Even urgent work waits for the upstream queues - they
+                    # may still be writing what it needs.
+                    if not self.scheduler.can_run(q.queue_id):
+                        continue
+                    if qs.feed.priority:
+                        urgent.append((q, qs))
+                    else:
+                        ready.append((q, qs))
+                if urgent or ready:
+                    q, qs = self._choose_queue(urgent or ready)
+                    qs.running = True
+                    return q, qs
+                self.ready_cond.wait(self.READY_RECHECK_INTERVAL)
+        return None, None
+
+    def _worker_thread(self):
+        while True:
+            q, qs = self._get_ready_queue()
+            if q is None:
+                break
+            try:
+                self._run_batch(q, qs)
+            except Exception, exc:
+                logger.exception('queue %r failed', q.queue_id)
+                qs.failure = exc
+                # stop our cursor so the shared feed doesn't buffer for us.
+                qs.feed.stop()
+            qs.running = False
+            self._notify_state_changed()
 
     def _stop_all(self):
-        for qs in self.queue_states:
-            qs.feed.stop()
-            qs.running = False
+        self.changes_feed.stop()
+        with self.ready_cond:
+            self.stopping = True
+            self.ready_cond.notifyAll()
+
+    def _stop_writer(self):
+        # only once the workers are done, so nothing more is submitted.
+        self.writer.stop()
+        for q in self.queues:
+            q.writer = None
+
+    def _notify_state_changed(self):
+        # A queue may have become ready, or a queue or the feed may have
+        # become idle (which may let a downstream queue run) - wake anyone
+        # waiting for that.
+        with self.ready_cond:
+            self.ready_cond.notifyAll()
+        self.state_changed.set()
+
+    def _is_queue_idle(self, queue_id):
+        # Items a queue holds to process later don't count - its downstream
+        # queues would otherwise wait for the whole pending window.
+        qs = self.queue_states[self.queue_index[queue_id]]
+        return qs.failure is not None or \
+               (not qs.running and not qs.feed.has_changes())
+
+    def _is_holding_work(self):
+        # Is any queue mid-batch or holding items to process later?
+        for q, qs in zip(self.queues, self.queue_states):
+            if qs.failure is None and (qs.running or q.pending):
+                return True
+        return False
+
+    def is_idle(self):
+        """Has every queue caught up with the changes feed?"""
+        feed = self.changes_feed
+        if feed is None or self.queue_states is None:
+            return False # still starting up.
+        return feed.idle_seq() is not None and not self._is_holding_work()
+
+    def set_priority_seq(self, seq):
+        self.priority_seq = seq
+        if self.changes_feed is not None:
+            self.changes_feed.priority_seq = seq
+
+    def _make_scheduler(self):
+        sources = {}
+        emitted = {}
+        for q, qs in zip(self.queues, self.queue_states):
+            sources[q.queue_id] = getattr(q.processor.ext, 'source_schemas', None)
+            known = qs.schema_item['items'].get('emitted_schemas')
+            if known is None:
+                known = scheduler.get_emitted_schemas(self.doc_model,
+                                                      q.queue_id)
+            q.schemas_emitted.update(known)
+            emitted[q.queue_id] = set(q.schemas_emitted)
+        upstream = scheduler.build_graph(sources, emitted)
+        return scheduler.QueueScheduler(upstream, self._is_queue_idle)
 
     def run(self, stable_callback):
         dm = self.doc_model
         # load our queue states.
         assert self.queue_states is None
         self.queue_states = []
+        # All queues share a single _changes connection; each gets its own
+        # cursor into it.
+        self.changes_feed = ChangesFeedMultiplexer()
         for q in self.queues:
             qs = self._load_queue_state(q)
             self.queue_states.append(qs)
-            qs.feed = ChangesIterFactory()
             start_seq = qs.schema_item['items']['seq']
             # There is quite a performance penalty involved in getting the
             # dependencies for extensions which don't need them...
             include_deps = q.processor.ext.uses_dependencies
-            qs.feed.initialize(self.doc_model, start_seq, include_deps=include_deps)
+            # Only route changes for the schemas the extension wants; a
+            # null source_schemas means it uses its own filter function.
+            schemas = getattr(q.processor.ext, 'source_schemas', None)
+            qs.feed = self.changes_feed.add_cursor(start_seq,
+                                                   include_deps=include_deps,
+                                                   schemas=schemas)
+        self.queue_index = dict((q.queue_id, i)
+                                for i, q in enumerate(self.queues))
+        self.checkpoints = CheckpointService(self.doc_model,
+                                             self.options.checkpoint_interval)
+        for qs in self.queue_states:
+            self.checkpoints.add(qs)
+        self.checkpoints.start()
+        # All queues write via a single writer.
+        self.writer = SchemaItemWriter(self.doc_model)
+        self.writer.start()
+        for q in self.queues:
+            q.writer = self.writer
+        self.scheduler = self._make_scheduler()
+        self.changes_feed.idle_callback = self._notify_state_changed
+        self.changes_feed.ready_callback = self._notify_state_changed
+        self.changes_feed.priority_seq = self.priority_seq
+        self.changes_feed.priority_age = self.options.priority_age
+        self.changes_feed.start(self.doc_model,
+                                use_filter=self.options.changes_filter,
+                                include_docs=self.options.inline_docs)
 
         last_status_tick = time.time()
 
-        # we get a large perf increase by setting the check interval high;
-        # as we are heavily IO bound this doesn't affect thread switching
-        # as it happens on each couch request anyway...
-        old_check_interval = sys.getcheckinterval()
-        sys.setcheckinterval(5000)
-
+        num_workers = min(self.options.queue_workers, len(self.queues))
+        logger.debug("processing %d queues with %d workers",
+                     len(self.queues), num_workers)
         workers = []
-        for q, qs in zip(self.queues, self.queue_states):
-            t = threading.Thread(target=self._worker_thread,
-                                 args=(q, qs))
+        for i in range(num_workers):
+            t = threading.Thread(target=self._worker_thread)
             t.setDaemon(True) # incase one gets truly stuck...
             t.start()
             workers.append(t)
 
         finished = False
+        timeout = self.STATUS_INTERVAL
         try:
             while not finished:
-                # wake up once per second to check status etc.
-                time.sleep(1)
-                if time.time()-10 > last_status_tick:
+                # Sleep until a queue or the feed changes state (or it is
+                # time to report our status).
+                self.state_changed.wait(timeout)
+                self.state_changed.clear()
+                if self.changes_feed.failure is not None:
+                    raise self.changes_feed.failure
+                # workers are only forked from this thread (see procpool).
+                procpool.replace_dead_workers()
+                if time.time()-self.STATUS_INTERVAL > last_status_tick:
                     self._q_status()
                     last_status_tick = time.time()
 
-                # See if each of the changes feeds are blocked at the same
-                # sequence number.
-                all_seqs = set()
-                for q, qs in zip(self.queues, self.queue_states):
-                    if qs.running:
-                        if not qs.feed.is_waiting:
-                            break
-                        all_seqs.add(qs.feed.current_seq)
-                else:
-                    # didn't break, so all are blocked somewhere.  Check all
-                    # at the same point.
-                    all_at_end = len(all_seqs)==1
-                    if all_at_end:
-                        end_seq = all_seqs.pop()
-                        logger.debug('all queues are paused at seq %s', end_seq)
-                        if stable_callback is None:
-                            finished = True
-                        else:
-                            finished = stable_callback(end_seq)
+                # We are stable once the feed has nothing more for us and
+                # every queue has consumed all it was given.
+                timeout = self.STATUS_INTERVAL
+                end_seq = self.changes_feed.idle_seq()
+                if end_seq is not None and self._is_holding_work():
+                    # not done until the items held for later are.
+                    if stable_callback is None:
+                        # no point waiting for more changes to coalesce
+                        # with - there won't be any.
+                        self.flush_pending_now = True
+                        with self.ready_cond:
+                            self.ready_cond.notifyAll()
+                    end_seq = None
+                    timeout = self.STABLE_RECHECK_INTERVAL
+                if end_seq is not None:
+                    logger.debug('all queues are paused at seq %s', end_seq)
+                    if stable_callback is None:
+                        finished = True
+                    else:
+                        finished = stable_callback(end_seq)
+                        timeout = self.STABLE_RECHECK_INTERVAL
         finally:
             logger.debug('queue processing complete - stopping workers')
             # kill the worker threads.
@@ -502,10 +1030,64 @@ class StatefulQueueManager(object):
                 w.join(10)
                 if w.isAlive():
                     logger.warn("failed to wait for worker thread to complete")
-            sys.setcheckinterval(old_check_interval)
+            self._stop_writer()
+            self.checkpoints.stop()
 
-        # update the views now...
-        self.doc_model._update_important_views()
+        # have the views brought up-to-date in the background.
+        self.doc_model.view_refresher.notify_idle()
+
+
+def _min_seq(a, b):
+    # the lower of 2 seqs, either of which may be None.
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _raise_non_conflicts(infos, exc=None):
+    # Only a 409 conflict is worth retrying - anything else (a forbidden
+    # doc, a server error...) is raised as couch reported it.
+    errors = [info for info in infos if info.get('error') != 'conflict']
+    if errors:
+        if exc is not None:
+            raise exc
+        raise DocumentSaveError(errors)
+
+
+class _BatchResults(object):
+    # The state accumulated while processing (part of) a batch; each
+    # thread processing a slice of the batch has its own.
+    def __init__(self):
+        self.num_created = 0
+        self.first_seq = None
+        self.last_seq = None
+        self.pending = []
+        # the first seq which asked for something to be processed later;
+        # pending_unsequenced is set if a dependency row asked.
+        self.pending_seq = None
+        self.pending_unsequenced = False
+        self.conflicts = []
+        self.conflict_sources = {} # key is created doc id, value is source.
+        self.schemas = set() # the schema ids written.
+        self.writes = [] # WriteFutures we are yet to wait for.
+        self.doc_items = {} # doc id -> schema items written to it.
+
+    def merge(self, other):
+        self.num_created += other.num_created
+        if other.last_seq is not None and other.last_seq > self.last_seq:
+            self.last_seq = other.last_seq
+        self.first_seq = _min_seq(self.first_seq, other.first_seq)
+        self.pending.extend(other.pending)
+        self.pending_seq = _min_seq(self.pending_seq, other.pending_seq)
+        self.pending_unsequenced |= other.pending_unsequenced
+        self.conflicts.extend(other.conflicts)
+        self.conflict_sources.update(other.conflict_sources)
+        self.schemas.update(other.schemas)
+        self.writes.extend(other.writes)
+        for did, items in other.doc_items.iteritems():
+            self.doc_items.setdefault(did, []).extend(items)
 
 
 class ProcessingQueueRunner(object):
@@ -513,22 +1095,61 @@ class ProcessingQueueRunner(object):
     of couch documents and run any of the extension objects which process the
     documents.
     """
+    # The number of changes we ask the processor to prefetch at once.  This
+    # is also the batch split between threads for concurrent extensions.
+    prefetch_batch_size = 100
+
     def __init__(self, doc_model, processor, queue_id):
         self.doc_model = doc_model
         self.processor = processor
         self.queue_id = queue_id
-
-    def process_queue(self, src_gen):
-        """processes a number of items in a work-queue.
-        """
+        # every schema id this queue has been seen to write.
+        self.schemas_emitted = set()
+        # a SchemaItemWriter shared with other queues, or None to write
+        # directly.
+        self.writer = None
+        self.metrics = metrics.get_extension_metrics(queue_id)
+        # Items passed to process_later() which are yet to be processed -
+        # these may be carried over several batches (see process_queue).
+        self.pending = []
+        # the first seq the pending items came from - until they are done
+        # the queue can't checkpoint beyond the seq before it.
+        self.pending_seq = None
+        # when the first and latest pending items were added.
+        self.pending_first = self.pending_last = None
+
+    def _gen_batches(self, src_gen, inline_docs):
+        # Read-ahead a batch of changes and give the processor a chance to
+        # fetch everything it needs for them in bulk before yielding them.
+        # inline_docs is filled by src_gen as it goes, so has the docs for
+        # the batch by the time we prefetch.
+        prefetch = getattr(self.processor, 'prefetch', None)
+        batch_size = self.prefetch_batch_size
+        doc_model = self.doc_model
+        batch = []
+        for src_id, src_rev, schema_id, seq in src_gen:
+            if schema_id is None:
+                try:
+                    _, _, schema_id = doc_model.split_doc_id(src_id, decode_key=False)
+                except ValueError:
+                    pass # _process_elts logs and skips it.
+            batch.append((src_id, src_rev, schema_id, seq))
+            if len(batch) >= batch_size:
+                if prefetch is not None:
+                    prefetch([e[:3] for e in batch if e[2] is not None],
+                             inline_docs)
+                yield batch
+                batch = []
+        if batch:
+            if prefetch is not None:
+                prefetch([e[:3] for e in batch if e[2] is not None],
+                         inline_docs)
+            yield batch
+
+    def _process_elts(self, elts, results):
         doc_model = self.doc_model
-        num_created = 0
         processor = self.processor
         queue_id = self.queue_id
-
-        logger.debug("starting processing %r", queue_id)
-        items = []
-        pending = []
         # Given multiple extensions may write to the same document (as all
         # instances of the same schema are stored in the same document),
         # conflicts are inevitable.  When we see conflicts we simply retry a
@@ -536,13 +1157,12 @@ class ProcessingQueueRunner(object):
         # themselves.
         # This is more complicated than it need be due to our 'buffered
         # writing' - but performance really sucks without it...
-        conflicts = []
-        conflict_sources = {} # key is src_id, value is created doc id.
-        # process until we run out.
-        last_seq = None
-        for src_id, src_rev, schema_id, seq in src_gen:
+        items = []
+        for src_id, src_rev, schema_id, seq in elts:
             if seq is not None: # 'dependency' rows have no seq...
-                last_seq = seq
+                results.last_seq = seq
+                if results.first_seq is None:
+                    results.first_seq = seq
             if schema_id is None:
                 try:
                     _, _, schema_id = doc_model.split_doc_id(src_id, decode_key=False)
@@ -557,33 +1177,167 @@ class ProcessingQueueRunner(object):
                 # end of the batch - presumably to save doing duplicate work.
                 logger.debug("queue %r asked for document %r/%s to be processed later (state=%r)",
                              queue_id, src_id, src_rev, exc.value)
-                pending.append(exc.value)
+                results.pending.append(exc.value)
+                if seq is None:
+                    results.pending_unsequenced = True
+                elif results.pending_seq is None:
+                    results.pending_seq = seq
                 continue
 
             if not got:
                 continue
-            num_created += len(got)
+            results.num_created += len(got)
             # note which src caused an item to be generated, incase we
             # conflict as we write them (see above - our 'buffering' makes
             # this necessary...)
             for si in got:
                 doc_model.check_schema_item(si)
                 did = doc_model.get_doc_id_for_schema_item(si)
-                conflict_sources[did] = (src_id, src_rev)
+                results.conflict_sources[did] = (src_id, src_rev, schema_id)
+                results.doc_items.setdefault(did, []).append(si)
+                results.schemas.add(si['rd_schema_id'])
             items.extend(got)
             if must_save or len(items)>20:
-                try:
-                    doc_model.create_schema_items(items)
-                except DocumentSaveError, exc:
-                    conflicts.extend(exc.infos)
+                self._write_items(items, must_save, results)
                 items = []
         if items:
+            self._write_items(items, False, results)
+
+    def _write_items(self, items, must_save, results):
+        # If must_save is set the items must be written before we return,
+        # otherwise the shared writer may write them whenever it likes (but
+        # before the batch is complete.)
+        if self.writer is None:
+            start = time.time()
+            try:
+                self.doc_model.create_schema_items(items)
+            except DocumentSaveError, exc:
+                results.conflicts.extend(exc.infos)
+            self.metrics.couch_time.observe(time.time() - start)
+            return
+        future = self.writer.submit(items, urgent=must_save)
+        if must_save:
+            self._wait_write(future, results)
+        else:
+            results.writes.append(future)
+
+    def _merge_conflicts(self, conflicts, doc_items, max_tries=3):
+        """Handle conflicts by re-applying the schema items to the current
+        version of the conflicting documents and writing them in bulk.
+
+        Returns the conflicts which can't be handled this way - those for
+        documents with items pinned to a specific _rev (ie, deleting a
+        previous item).  Any failure other than a conflict can't be fixed
+        by trying again, so is raised as it was reported.
+        """
+        _raise_non_conflicts(conflicts)
+        unmergeable = []
+        mergeable = {}
+        for cinfo in conflicts:
+            did = cinfo['id']
+            items = doc_items.get(did)
+            if not items or [si for si in items if '_rev' in si]:
+                unmergeable.append(cinfo)
+            else:
+                mergeable[did] = cinfo
+        for i in range(max_tries):
+            if not mergeable:
+                break
+            logger.debug("merging %d conflicting documents", len(mergeable))
+            items = []
+            for did in mergeable:
+                items.extend(doc_items[did])
             try:
-                doc_model.create_schema_items(items)
+                # this re-reads the docs (the cache dropped them when they
+                # conflicted) and re-applies the items to them.
+                self.doc_model.create_schema_items(items)
+                mergeable = {}
             except DocumentSaveError, exc:
-                conflicts.extend(exc.infos)
+                _raise_non_conflicts(exc.infos, exc)
+                mergeable = dict((cinfo['id'], cinfo) for cinfo in exc.infos)
+        if mergeable:
+            logger.info("failed to merge %d conflicting documents",
+                        len(mergeable))
+            unmergeable.extend(mergeable.itervalues())
+        return unmergeable
+
+    def _wait_write(self, future, results):
+        # the time we are blocked waiting for couch to write for us.
+        start = time.time()
+        try:
+            future.result()
+        except DocumentSaveError, exc:
+            results.conflicts.extend(exc.infos)
+        self.metrics.couch_time.observe(time.time() - start)
+
+    def _process_concurrently(self, elts, concurrency, results):
+        # Split the batch into disjoint slices and process each in its own
+        # thread.  All changes for a single document go to the same slice,
+        # so we never process the same document concurrently.
+        slices = [[] for i in range(concurrency)]
+        for elt in elts:
+            slices[hash(elt[0]) % concurrency].append(elt)
+        failures = []
+        def process_slice(slice, slice_results):
+            try:
+                self._process_elts(slice, slice_results)
+            except:
+                failures.append(sys.exc_info())
+
+        threads = []
+        for slice in slices:
+            if not slice:
+                continue
+            slice_results = _BatchResults()
+            t = threading.Thread(target=process_slice,
+                                 args=(slice, slice_results))
+            t.start()
+            threads.append((t, slice_results))
+        for t, slice_results in threads:
+            t.join()
+            results.merge(slice_results)
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+
+    def process_queue(self, src_gen, inline_docs=None, defer_pending=False):
+        """processes a number of items in a work-queue.
+
+        inline_docs is an optional dict of src_id -> doc for the docs
+        delivered along with the changes.
+
+        If defer_pending is True, items passed to process_later() are left
+        in self.pending for the caller to flush_pending() when it sees fit,
+        so the work they represent can be coalesced over many batches.
+        """
+        doc_model = self.doc_model
+        processor = self.processor
+        queue_id = self.queue_id
+        concurrency = getattr(processor.ext, 'concurrency', 1)
 
-        # retry conflicts 3 times (yet another magic number)
+        logger.debug("starting processing %r", queue_id)
+        results = _BatchResults()
+        start_batch = getattr(processor, 'start_batch', None)
+        if start_batch is not None:
+            start_batch()
+        # process until we run out.
+        for batch in self._gen_batches(src_gen, inline_docs):
+            if concurrency > 1 and len(batch) > 1:
+                self._process_concurrently(batch, concurrency, results)
+            else:
+                self._process_elts(batch, results)
+
+        # the batch isn't done until everything is written.
+        for future in results.writes:
+            self._wait_write(future, results)
+        results.writes = []
+
+        # Most conflicts are just another extension adding its schema to
+        # the same doc - those we simply apply again to the current doc.
+        conflicts = self._merge_conflicts(results.conflicts, results.doc_items)
+
+        # The rest were pinned to a _rev which has since changed, so the
+        # extension must work out what to do given the new doc - retry those
+        # 3 times (yet another magic number)
         for i in range(3):
             if not conflicts:
                 break
@@ -591,16 +1345,20 @@ class ProcessingQueueRunner(object):
             new_conflicts = []
             for cinfo in conflicts:
                 # find the src which created the conflicting item.
-                src_id, src_rev = conflict_sources[cinfo['id']]
+                src_id, src_rev, schema_id = results.conflict_sources[cinfo['id']]
                 logger.debug("redoing conflict when processing %r,%r", src_id,
                              src_rev)
                 # and ask it to go again...
                 got, _ = processor(src_id, src_rev, schema_id)
                 if got:
+                    for si in got:
+                        did = doc_model.get_doc_id_for_schema_item(si)
+                        results.conflict_sources[did] = (src_id, src_rev, schema_id)
                     # don't bother batching when handling conflicts...
                     try:
                         doc_model.create_schema_items(got)
                     except DocumentSaveError, exc:
+                        _raise_non_conflicts(exc.infos, exc)
                         new_conflicts.extend(exc.infos)
             logger.debug("handling the %d conflicts created %d new conflicts",
                          len(conflicts), len(new_conflicts))
@@ -610,48 +1368,112 @@ class ProcessingQueueRunner(object):
             if conflicts:
                 raise DocumentSaveError(conflicts)
 
-        if pending:
+        # everything is written, so what was processed is now up-to-date.
+        finish_batch = getattr(processor, 'finish_batch', None)
+        if finish_batch is not None:
+            finish_batch()
+
+        num_created = results.num_created
+        if results.pending:
+            pending_seq = results.pending_seq
+            if results.pending_unsequenced:
+                pending_seq = _min_seq(pending_seq, results.first_seq)
+            now = time.time()
+            if not self.pending:
+                self.pending_first = now
+            self.pending_last = now
+            self.pending.extend(results.pending)
+            self.pending_seq = _min_seq(self.pending_seq, pending_seq)
+
+        self.schemas_emitted.update(results.schemas)
+        if not defer_pending:
             # If the extension asked for stuff to be done later, then now
-            # is later!  We must do it per-batch, so the backlog processor
-            # doesn't think we are done with this batch before we actually are.
-            logger.debug("queue %r starting to process %d pending items",
-                         queue_id, len(pending))
-            got = self.processor.process_pending(pending)
-            logger.debug("queue %r pending processing made %d items",
-                         queue_id, len(got))
-            if got:
-                doc_model.create_schema_items(got)
-                num_created += len(got)
-
+            # is later!
+            num_created += self.flush_pending()
         logger.debug("finished processing %r to %r - %d processed",
-                     queue_id, last_seq, num_created)
+                     queue_id, results.last_seq, num_created)
         return num_created
 
+    def flush_pending(self):
+        """Process the items passed to process_later() by previous batches.
+        Returns the number of items created.
+        """
+        pending = self.pending
+        if not pending:
+            return 0
+        logger.debug("queue %r starting to process %d pending items",
+                     self.queue_id, len(pending))
+        got = self.processor.process_pending(pending)
+        logger.debug("queue %r pending processing made %d items",
+                     self.queue_id, len(got))
+        if got:
+            self.doc_model.create_schema_items(got)
+            self.schemas_emitted.update(si['rd_schema_id'] for si in got)
+        # only now is the work done.
+        self.pending = []
+        self.pending_seq = None
+        self.pending_first = self.pending_last = None
+        return len(got)
+
+    def pending_due(self, window, max_delay):
+        """Are the pending items due to be processed?  They are once no
+        more have been added for window seconds, or the first was added
+        max_delay seconds ago.
+        """
+        if not self.pending:
+            return False
+        now = time.time()
+        return now - self.pending_last >= window or \
+               now - self.pending_first >= max_delay
+
 
 class ExtensionProcessor(object):
     """A class which manages the execution of a single extension over
     documents holding raindrop schemas"""
-    def __init__(self, doc_model, ext, options):
+    def __init__(self, doc_model, ext, options, uptodate=None):
         self.doc_model = doc_model
         self.ext = ext
         self.options = options
+        # An UpToDateCache, or None.  It can't be used by extensions which
+        # use dependencies, as they are never up-to-date.
+        if ext.uses_dependencies or \
+           ext.category not in (ext.PROVIDER, ext.EXTENDER):
+            uptodate = None
+        self.uptodate = uptodate
+        # the (src_id, src_rev) docs processed by the current batch; they
+        # are only added to the cache once the batch has been written.
+        self.processed = []
         self.num_errors = 0
+        self.metrics = metrics.get_extension_metrics(ext.id)
+        self.profiler = None
+        if options.profile_exts and ext.id in options.profile_exts:
+            self.profiler = profiler.get_profiler(ext.id)
+        # results of prefetch() for the current batch.
+        self.prefetched_rows = {}
+        self.prefetched_docs = {}
 
     def _get_ext_env(self, context, src_doc):
-        # Each ext has a single 'globals' which is updated before it is run;
-        # therefore it is critical we don't accidently run the same extension
-        # more than once concurrently
-        if self.ext.running:
-            raise RuntimeError, "%r is already running" % self.ext.id
-        self.ext.running = True
+        # Each ext namespace has a single 'globals' which is updated before
+        # it is run; therefore it is critical we don't accidently run the
+        # same namespace more than once concurrently.  The extension hands
+        # out a different namespace to each concurrent caller.
+        globs = self.ext.acquire_namespace()
         new_globs = extenv.get_ext_env(self.doc_model, context, src_doc,
                                        self.ext)
-        self.ext.globs.update(new_globs)
-        return self.ext.handler
+        globs.update(new_globs)
+        return globs
 
-    def _release_ext_env(self):
-        assert self.ext.running
-        self.ext.running = False
+    def _release_ext_env(self, globs):
+        self.ext.release_namespace(globs)
+
+    def _stamp_items(self, new_items):
+        # Record the version of the extension which wrote the items.  Items
+        # written on behalf of other extensions (eg, 'rd.core') are left
+        # alone.
+        ext = self.ext
+        for item in new_items:
+            if item['rd_ext_id'] == ext.id and '_deleted' not in item:
+                item['rd_ext_fingerprint'] = ext.fingerprint
 
     def _merge_new_with_previous(self, new_items, docs_previous):
         # check the new items created against the 'source' documents created
@@ -677,20 +1499,199 @@ class ExtensionProcessor(object):
                 logger.debug('deleting previous schema item %(rd_schema_id)r'
                              ' by %(rd_ext_id)r for key %(rd_key)r', si)
 
+    def _is_dirty(self, src_id, src_rev, rows, is_provider):
+        # Returns True if the extension needs to be run against the source
+        # doc, False if the previous output is up-to-date, or None if the
+        # doc must be skipped entirely.
+        ext = self.ext
+        if not rows:
+            return True
+        if ext.uses_dependencies:
+            # we can't just check the source doc - assume the worst.
+            return True
+        for row in rows:
+            assert 'error' not in row, row # views don't give error records!
+            prev_src = row['value']['rd_source']
+            # a hack to prevent us cycling to death - if our previous
+            # run of the extension created this document, just skip
+            # it.
+            # This might be an issue in the 'reprocess' case.
+            if prev_src is not None and prev_src[0] == src_id and \
+               row['value']['rd_schema_id'] in ext.source_schemas:
+                # This is illegal for a provider.
+                if is_provider:
+                    raise ValueError("extension %r is configured to depend on schemas it previously wrote" %
+                                     ext.id)
+                # must be an extender, which is OK (see above)
+                logger.debug("skipping document %r - it depends on itself",
+                             src_id)
+                return None
+
+            if prev_src != [src_id, src_rev]:
+                return True
+            # error rows are considered 'dirty'
+            cur_schema = row['value']['rd_schema_id']
+            if cur_schema == 'rd.core.error':
+                logger.debug('document %r generated previous error '
+                             'records - re-running', src_id)
+                return True
+            # and so are items written by a different version of the code.
+            if row['value'].get('rd_ext_fingerprint') != ext.fingerprint:
+                logger.debug('document %r was processed by a different '
+                             'version of the extension - re-running', src_id)
+                return True
+        return False
+
+    def _is_cached_up_to_date(self, src_id, src_rev):
+        return self.uptodate is not None and src_rev is not None and \
+               not self.options.force and \
+               self.uptodate.is_up_to_date(self.ext.id, self.ext.fingerprint,
+                                           src_id, src_rev)
+
+    def start_batch(self):
+        self.processed = []
+
+    def finish_batch(self):
+        """Called once everything the batch made has been written."""
+        if self.uptodate is not None:
+            self.uptodate.add(self.ext.id, self.ext.fingerprint,
+                              self.processed)
+        self.processed = []
+
+    def _get_previous_rows(self, src_id):
+        # Items prefetched for the batch are used once only - if we are
+        # called again for the same doc (eg, to resolve a conflict) the
+        # extension may have written new items, so we must ask again.
+        try:
+            return self.prefetched_rows.pop(src_id)
+        except KeyError:
+            key = ['ext_id-source', [self.ext.id, src_id]]
+            start = time.time()
+            rows = self.doc_model.open_view(key=key, reduce=False)['rows']
+            self.metrics.couch_time.observe(time.time() - start)
+            return rows
+
+    def _get_source_doc(self, src_id, src_rev):
+        try:
+            return self.prefetched_docs.pop(src_id)
+        except KeyError:
+            pass
+        try:
+            return self.doc_model.doc_cache.get(src_id, src_rev)
+        except KeyError:
+            start = time.time()
+            doc = self.doc_model.open_documents_by_id([src_id])[0]
+            self.metrics.couch_time.observe(time.time() - start)
+            return doc
+
+    def prefetch(self, elts, inline_docs=None):
+        """Fetch everything needed to process a batch of (src_id, src_rev,
+        schema_id) elements in as few requests as possible.
+
+        One multi-key request to the megaview fetches the previous output
+        for every source doc, then one _all_docs request fetches the source
+        docs which need processing.  __call__ then uses these results rather
+        than making 2 requests per document.  Docs in inline_docs at the
+        revision we are processing are used rather than being fetched.
+        """
+        self.prefetched_rows = {}
+        self.prefetched_docs = {}
+        ext = self.ext
+        wanted = []
+        seen = set()
+        for src_id, src_rev, schema_id in elts:
+            if src_id not in seen and ext.filter(src_id, src_rev, schema_id) \
+               and not self._is_cached_up_to_date(src_id, src_rev):
+                seen.add(src_id)
+                wanted.append((src_id, src_rev))
+        if not wanted:
+            return
+
+        dm = self.doc_model
+        if ext.category in [ext.PROVIDER, ext.EXTENDER]:
+            is_provider = ext.category!=ext.EXTENDER
+            keys = [['ext_id-source', [ext.id, src_id]] for src_id, _ in wanted]
+            start = time.time()
+            result = dm.open_view(keys=keys, reduce=False)
+            self.metrics.couch_time.observe(time.time() - start)
+            all_rows = self.prefetched_rows
+            for src_id, _ in wanted:
+                all_rows[src_id] = []
+            for row in result['rows']:
+                all_rows[row['key'][1][1]].append(row)
+            # only fetch the docs we will actually need.
+            if not self.options.force:
+                need = []
+                for src_id, src_rev in wanted:
+                    try:
+                        dirty = self._is_dirty(src_id, src_rev,
+                                               all_rows[src_id], is_provider)
+                    except ValueError:
+                        # let the error be reported when the doc is processed.
+                        dirty = True
+                    if dirty:
+                        need.append((src_id, src_rev))
+                wanted = need
+        if wanted and inline_docs:
+            need = []
+            for src_id, src_rev in wanted:
+                doc = inline_docs.get(src_id)
+                if doc is not None and doc['_rev'] == src_rev:
+                    # the inline docs are shared with the other queues, so
+                    # the extension gets its own copy to play with.
+                    self.prefetched_docs[src_id] = copy.deepcopy(doc)
+                else:
+                    # not inlined or it has changed since - go get it.
+                    need.append((src_id, src_rev))
+            wanted = need
+        if wanted:
+            # we may have just written or read the doc ourselves.
+            need = []
+            for src_id, src_rev in wanted:
+                try:
+                    self.prefetched_docs[src_id] = dm.doc_cache.get(src_id,
+                                                                    src_rev)
+                except KeyError:
+                    need.append((src_id, src_rev))
+            wanted = need
+        if wanted:
+            doc_ids = [src_id for src_id, _ in wanted]
+            start = time.time()
+            docs = dm.open_documents_by_id(doc_ids)
+            self.metrics.couch_time.observe(time.time() - start)
+            for doc_id, doc in zip(doc_ids, docs):
+                self.prefetched_docs[doc_id] = doc
+                if doc is not None:
+                    dm.doc_cache.put(doc_id, doc)
+        logger.debug("%r prefetched previous items for %d documents and %d source docs",
+                     ext.id, len(self.prefetched_rows), len(self.prefetched_docs))
+
     def process_pending(self, pending):
+        if self.profiler is not None:
+            return self.profiler.runcall(self._process_pending, pending)
+        return self._process_pending(pending)
+
+    def _process_pending(self, pending):
         new_items = []
         context = {'new_items': new_items}
-        self._get_ext_env(context, None)
-        func = self.ext.later_handler
+        globs = self._get_ext_env(context, None)
+        func = globs['later_handler']
         # Note we don't catch exceptions - failure stops this queue!
         try:
             func(pending)
         finally:
-            self._release_ext_env()
+            self._release_ext_env(globs)
+        self._stamp_items(new_items)
         return new_items
 
     def __call__(self, src_id, src_rev, schema_id):
         """The "real" entry-point to this processor"""
+        if self.profiler is not None:
+            return self.profiler.runcall(self._process, src_id, src_rev,
+                                         schema_id)
+        return self._process(src_id, src_rev, schema_id)
+
+    def _process(self, src_id, src_rev, schema_id):
         ext = self.ext
         if not ext.filter(src_id, src_rev, schema_id):
             return [], False
@@ -698,6 +1699,7 @@ class ExtensionProcessor(object):
         dm = self.doc_model
         ext_id = ext.id
         force = self.options.force
+        self.metrics.seen.inc()
 
         # some extensions declare themselves as 'smart updaters' - they
         # are more efficiently able to deal with updating the records it
@@ -710,49 +1712,22 @@ class ExtensionProcessor(object):
             pass
         elif ext.category in [ext.PROVIDER, ext.EXTENDER]:
             is_provider = ext.category!=ext.EXTENDER
+            if self._is_cached_up_to_date(src_id, src_rev):
+                logger.debug("document %r is up-to-date (cached)", src_id)
+                self.metrics.skipped.inc()
+                self.metrics.cached.inc()
+                return (None, None)
             # We need to find *all* items previously written by this extension
             # so we can manage updating/removal of the old items.
-            key = ['ext_id-source', [ext_id, src_id]]
-            result = dm.open_view(key=key, reduce=False)
-            rows = result['rows']
-            if rows:
-                if ext.uses_dependencies:
-                    # we can't just check the source doc - assume the worst.
-                    dirty = True
-                else:
-                    dirty = False
-                    for row in rows:
-                        assert 'error' not in row, row # views don't give error records!
-                        prev_src = row['value']['rd_source']
-                        # a hack to prevent us cycling to death - if our previous
-                        # run of the extension created this document, just skip
-                        # it.
-                        # This might be an issue in the 'reprocess' case.
-                        if prev_src is not None and prev_src[0] == src_id and \
-                           row['value']['rd_schema_id'] in ext.source_schemas:
-                            # This is illegal for a provider.
-                            if is_provider:
-                                raise ValueError("extension %r is configured to depend on schemas it previously wrote" %
-                                                 ext_id)
-                            # must be an extender, which is OK (see above)
-                            logger.debug("skipping document %r - it depends on itself",
-                                         src_id)
-                            return (None, None)
-
-                        if prev_src != [src_id, src_rev]:
-                            dirty = True
-                            break
-                        # error rows are considered 'dirty'
-                        cur_schema = row['value']['rd_schema_id']
-                        if cur_schema == 'rd.core.error':
-                            logger.debug('document %r generated previous error '
-                                         'records - re-running', src_id)
-                            dirty = True
-                            break
-            else:
-                dirty = True
+            rows = self._get_previous_rows(src_id)
+            dirty = self._is_dirty(src_id, src_rev, rows, is_provider)
+            if dirty is None:
+                return (None, None)
             if not dirty and not force:
                 logger.debug("document %r is up-to-date", src_id)
+                self.metrics.skipped.inc()
+                if src_rev is not None:
+                    self.processed.append((src_id, src_rev))
                 return (None, None)
 
             for row in rows:
@@ -766,7 +1741,7 @@ class ExtensionProcessor(object):
                                (ext_id, ext.category))
 
         # Get the source-doc and process it.
-        src_doc = dm.open_documents_by_id([src_id])[0]
+        src_doc = self._get_source_doc(src_id, src_rev)
         # Although we got this doc id directly from the _all_docs_by_seq view,
         # it is quite possible that the doc was deleted since we read that
         # view.  It could even have been updated - so if its not the exact
@@ -799,12 +1774,28 @@ class ExtensionProcessor(object):
         logger.debug("calling %r with doc %r, rev %s", ext_id,
                      src_doc['_id'], src_doc['_rev'])
 
+        start = time.time()
         try:
-            func = self._get_ext_env(context, src_doc)
             try:
-                result = func(src_doc)
+                if ext.execution == ext.EXEC_PROCESS:
+                    pool = procpool.get_pool()
+                else:
+                    pool = None
+                if pool is not None:
+                    result = pool.run(ext, self.doc_model, context, src_doc)
+                else:
+                    # (an extension asking for a process which was
+                    # installed after we started runs in our thread.)
+                    globs = self._get_ext_env(context, src_doc)
+                    try:
+                        result = globs['handler'](src_doc)
+                    finally:
+                        self._release_ext_env(globs)
             finally:
-                self._release_ext_env()
+                self.metrics.handler_time.observe(time.time() - start)
+        except ExtensionInitError:
+            # not the document's fault - stop the queue.
+            raise
         except extenv.ProcessLaterException, exc:
             assert not new_items, "extensions can't do now and later!"
             # we still need to delete the older ones created last time.
@@ -816,6 +1807,8 @@ class ExtensionProcessor(object):
             # handle_ext_failure may put error records into new_items.
             self._handle_ext_failure(sys.exc_info(), src_doc, new_items)
         else:
+            self.metrics.processed.inc()
+            self.processed.append((src_doc['_id'], src_doc['_rev']))
             if result is not None:
                 # an extension returning a value implies they may be
                 # confused?
@@ -823,6 +1816,7 @@ class ExtensionProcessor(object):
                             ext, result)
 
 
+        self._stamp_items(new_items)
         self._merge_new_with_previous(new_items, docs_previous)
         # We try hard to batch writes; we earlier just checked to see if
         # only the same key was written, but that still failed.  Last
@@ -852,6 +1846,7 @@ class ExtensionProcessor(object):
         logger.warn("Extension %r failed to process document %r",
                     self.ext.id, src_doc['_id'], exc_info=exc_info)
         self.num_errors += 1
+        self.metrics.errors.inc()
         if self.options.stop_on_error:
             logger.info("--stop-on-error specified - stopping queue")
             # Throw away any records emitted by *this* failure.
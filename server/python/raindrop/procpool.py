@@ -0,0 +1,297 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""Runs CPU-bound extensions in a pool of worker processes.
+
+Extensions which declare '"execution": "process"' have their handler run in
+a worker process so parsing etc isn't serialized by the GIL.  The worker
+runs the handler with a normal extension environment, but only the calls
+which don't touch couch (emit_schema, process_later, hashable_key etc) are
+done in the worker - everything else (open_view, open_schema_attachment,
+update_documents etc) is proxied back to the parent over the worker's pipe,
+so all couch I/O stays in the parent process.
+
+The workers are forked by start_pool(), which the pipeline calls before it
+starts any threads - a forked child only gets the thread which forked it,
+and any lock another thread happened to hold (eg, the logging module's)
+would stay held in the child forever.  For the same reason a worker which
+dies isn't replaced by the queue thread which noticed; the pipeline's main
+thread calls replace_dead_workers().
+"""
+from __future__ import with_statement
+
+import sys
+import threading
+import traceback
+import Queue
+import multiprocessing
+import cPickle
+from cStringIO import StringIO
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The extension environment functions which must run in the parent process.
+PROXIED_FUNCTIONS = [
+    'emit_related_identities',
+    'find_and_emit_conversation',
+    'get_my_identities',
+    'init_grouping_tag',
+    'open_attachment',
+    'open_schema_attachment',
+    'open_schemas',
+    'open_view',
+    'update_documents',
+]
+
+def get_default_pool_size():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+
+class ExtensionWorkerError(Exception):
+    """An extension failed in a worker process; the value is the formatted
+    traceback from the worker."""
+    pass
+
+
+# The worker side.
+class _WorkerExtension(object):
+    # Just enough of an Extension for extenv.get_ext_env
+    def __init__(self, ext_id, category, uses_dependencies):
+        from raindrop.pipeline import Extension
+        self.EXTENDER = Extension.EXTENDER
+        self.id = ext_id
+        self.category = category
+        self.uses_dependencies = uses_dependencies
+
+
+def _make_proxy(conn, name):
+    def proxy(*args, **kw):
+        conn.send(('call', name, args, kw))
+        kind, value = conn.recv()
+        if kind == 'error':
+            raise value
+        if kind == 'stream':
+            value = StringIO(value)
+        return value
+    proxy.__name__ = name
+    return proxy
+
+
+def _worker_main(conn):
+    from raindrop import codecache, extenv
+    from raindrop.model import DocumentModel
+    exts = {} # (ext_id, ext_rev) -> (extension, globs)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if msg is None:
+            break
+        ext_info, src_doc = msg
+        ext_id, ext_rev = key = ext_info[:2]
+        new_items = []
+        try:
+            ext, globs = exts[key]
+        except KeyError:
+            code, category, uses_dependencies = ext_info[2:]
+            ext = _WorkerExtension(ext_id, category, uses_dependencies)
+            globs = {}
+            try:
+                exec codecache.compile_source(code, "<%s>" % ext_id) in globs
+                if not callable(globs.get('handler')):
+                    raise RuntimeError("no 'handler' function")
+            except Exception, exc:
+                # the parent disables the extension.
+                conn.send(('init-failed', str(exc), None))
+                continue
+            exts[key] = ext, globs
+        try:
+            context = {'new_items': new_items}
+            # The class methods of the doc model are all emit_schema etc
+            # need; anything wanting a real doc model is proxied.
+            env = extenv.get_ext_env(DocumentModel, context, src_doc, ext)
+            for name in PROXIED_FUNCTIONS:
+                env[name] = _make_proxy(conn, name)
+            globs.update(env)
+            globs['handler'](src_doc)
+        except extenv.ProcessLaterException, exc:
+            conn.send(('later', exc.value, new_items))
+        except Exception:
+            conn.send(('failed', traceback.format_exc(), None))
+        else:
+            conn.send(('done', new_items, 'did_query' in context))
+
+
+# The parent side.
+class _Worker(object):
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+
+
+class ProcessPool(object):
+    """A fixed number of worker processes, each running one extension call
+    at a time.  Callers block until a worker is free.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.num_dead = 0
+        for i in range(size):
+            self.idle.put(_Worker())
+        logger.info("started %d extension worker processes", size)
+
+    def close(self):
+        with self.lock:
+            num_alive = self.size - self.num_dead
+        for i in range(num_alive):
+            self.idle.get().close()
+
+    def replace_dead_workers(self):
+        """Start new workers in place of any which have died.  Only call
+        this from the thread which started the pool.
+        """
+        with self.lock:
+            num, self.num_dead = self.num_dead, 0
+        for i in range(num):
+            self.idle.put(_Worker())
+        if num:
+            logger.info("replaced %d dead extension worker processes", num)
+
+    def run(self, ext, doc_model, context, src_doc):
+        """Run the extension's handler on src_doc in a worker process,
+        adding the items it emits to context['new_items'].
+        """
+        from raindrop import extenv
+        from raindrop.pipeline import ExtensionInitError
+        if ext.disabled is not None:
+            raise ExtensionInitError(ext.disabled)
+        # The parent's environment services the proxied calls; note items
+        # emitted by them (eg, find_and_emit_conversation) end up directly in
+        # context['new_items'].
+        env = extenv.get_ext_env(doc_model, context, src_doc, ext)
+        ext_info = (ext.id, ext.doc.get('_rev'), ext.doc['code'],
+                    ext.category, ext.uses_dependencies)
+        worker = self.idle.get()
+        try:
+            worker.conn.send((ext_info, src_doc))
+            while True:
+                msg = worker.conn.recv()
+                kind = msg[0]
+                if kind == 'call':
+                    self._do_call(worker, env, *msg[1:])
+                elif kind == 'done':
+                    _, items, did_query = msg
+                    context['new_items'].extend(items)
+                    if did_query:
+                        context['did_query'] = True
+                    return
+                elif kind == 'later':
+                    _, value, items = msg
+                    context['new_items'].extend(items)
+                    raise extenv.ProcessLaterException(value)
+                elif kind == 'failed':
+                    raise ExtensionWorkerError(msg[1])
+                elif kind == 'init-failed':
+                    ext.disable("Failed to initialize extension %r: %s"
+                                % (ext.id, msg[1]))
+                else:
+                    raise RuntimeError("unexpected worker message %r" % (msg,))
+        except (EOFError, IOError, OSError), exc:
+            # the worker is dead or confused - it is replaced later.
+            logger.error("extension worker process for %r failed: %s",
+                         ext.id, exc)
+            worker.close()
+            worker = None
+            with self.lock:
+                self.num_dead += 1
+            raise ExtensionWorkerError("worker process failed: %s" % (exc,))
+        finally:
+            if worker is not None:
+                self.idle.put(worker)
+
+    def _do_call(self, worker, env, name, args, kw):
+        try:
+            ret = ('result', env[name](*args, **kw))
+            if hasattr(ret[1], 'read'):
+                # an attachment stream can't cross the pipe - send its
+                # contents and the worker gets a file-like object again.
+                stream = ret[1]
+                try:
+                    ret = ('stream', stream.read())
+                finally:
+                    stream.close()
+        except Exception, exc:
+            ret = ('error', exc)
+        try:
+            worker.conn.send(ret)
+        except cPickle.PicklingError:
+            # the exception (or less likely the result) can't be sent.
+            worker.conn.send(('error', RuntimeError(repr(ret[1]))))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_pool(size=None):
+    """Start the process pool, if it isn't already.  Call this before
+    starting any threads.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPool(size or get_default_pool_size())
+        return _pool
+
+def get_pool():
+    """Return the process pool, or None if it hasn't been started."""
+    return _pool
+
+def replace_dead_workers():
+    pool = _pool
+    if pool is not None:
+        pool.replace_dead_workers()
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
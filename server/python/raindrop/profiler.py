@@ -0,0 +1,170 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""Opt-in profiling of individual extensions.
+
+Extensions named by --profile-ext are run under both cProfile and a
+sampling profiler.  Each call gets its own cProfile.Profile (they only see
+the thread they are enabled in) and the results are aggregated per
+extension, so concurrent calls and other queues don't pollute each other.
+The sampler periodically looks at the stack of each thread currently
+running a profiled extension, which gives the call stacks cProfile can't.
+
+At shutdown dump_all() writes, for each extension, <ext_id>.pstats (load it
+with the pstats module) and <ext_id>.collapsed (one 'frame;frame;frame
+count' line per stack, as consumed by flamegraph.pl and friends).
+
+Note that extensions executed in the process pool only show the time spent
+waiting for the worker process.
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import cProfile
+import pstats
+import tempfile
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ExtensionProfiler(object):
+    def __init__(self, ext_id):
+        self.ext_id = ext_id
+        self.lock = threading.Lock()
+        self.stats = None # a pstats.Stats once we have profiled a call.
+        self.num_calls = 0
+        self.stacks = {} # collapsed stack -> number of samples.
+
+    def runcall(self, func, *args, **kw):
+        profile = cProfile.Profile()
+        _sampler.enter(self, sys._getframe())
+        try:
+            return profile.runcall(func, *args, **kw)
+        finally:
+            _sampler.leave()
+            with self.lock:
+                self.num_calls += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def add_sample(self, stack):
+        with self.lock:
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def dump(self, dirname):
+        base = os.path.join(dirname, self.ext_id)
+        with self.lock:
+            if self.stats is None:
+                logger.info("extension %r was never called - no profile written",
+                            self.ext_id)
+                return
+            self.stats.dump_stats(base + ".pstats")
+            f = open(base + ".collapsed", "w")
+            try:
+                for stack, count in sorted(self.stacks.iteritems()):
+                    f.write("%s %d\n" % (stack, count))
+            finally:
+                f.close()
+        logger.info("wrote profile of %d calls to extension %r to %s.*",
+                    self.num_calls, self.ext_id, base)
+
+
+# the python wrapper cProfile puts between us and the profiled function.
+_RUNCALL_CODE = getattr(cProfile.Profile.runcall, 'func_code', None)
+
+def _describe_frame(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+class _Sampler(object):
+    # How often, in seconds, we look at the threads.
+    INTERVAL = 0.005
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # thread id -> (ExtensionProfiler, the frame which started it)
+        self.active = {}
+        self.thread = None
+
+    def enter(self, profiler, base_frame):
+        with self.lock:
+            self.active[threading._get_ident()] = profiler, base_frame
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sample_thread)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def leave(self):
+        with self.lock:
+            del self.active[threading._get_ident()]
+
+    def _sample_thread(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            with self.lock:
+                active = self.active.items()
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for tid, (profiler, base_frame) in active:
+                frame = frames.get(tid)
+                names = []
+                # only the frames beneath the profiled call are interesting.
+                while frame is not None and frame is not base_frame:
+                    if frame.f_code is not _RUNCALL_CODE:
+                        names.append(_describe_frame(frame))
+                    frame = frame.f_back
+                if frame is None:
+                    continue # the call finished as we looked.
+                names.reverse()
+                profiler.add_sample(";".join(names))
+            del frames
+
+_sampler = _Sampler()
+
+_profilers = {} # keyed by extension id.
+
+def get_profiler(ext_id):
+    try:
+        return _profilers[ext_id]
+    except KeyError:
+        return _profilers.setdefault(ext_id, ExtensionProfiler(ext_id))
+
+def dump_all(dirname=None):
+    """Write the profiles of all extensions profiled so far"""
+    if not _profilers:
+        return
+    if dirname is None:
+        dirname = tempfile.gettempdir()
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    for profiler in _profilers.itervalues():
+        profiler.dump(dirname)
@@ -29,6 +29,7 @@ import threading
 import socket
 import errno
 import Queue
+import tempfile
 
 import sys
 import imapclient
@@ -52,6 +53,9 @@ NUM_FETCHERS = 3
 # we fetch this many bytes or this many messages, whichever we hit first.
 MAX_BYTES_PER_FETCH = 500000
 MAX_MESSAGES_PER_FETCH = 30
+# messages bigger than this are spooled to a temp file and streamed to couch
+# from there, rather than being held in memory until the batch is written.
+SPOOL_MESSAGE_SIZE = 100000
 
 from imapclient.imap_utf7 import encode as encode_imap_utf7
 from imapclient.imap_utf7 import decode as decode_imap_utf7
@@ -708,13 +712,22 @@ class ImapProvider(object):
       #results = conn.fetchMessage(to_fetch, uid=True)
       # Run over the results stashing in our by_uid dict.
       infos = []
-      for uid, info in results.iteritems():
+      spools = []
+      # pop the results so each message body can be released once spooled.
+      while results:
+        uid, info = results.popitem()
         flags = by_uid[uid]['FLAGS']
         rdkey = by_uid[uid]['RAINDROP_KEY']
-        content = info['BODY[]']
+        content = info.pop('BODY[]')
         mid = rdkey[-1]
         # XXX - we need something to make this truly unique.
         logger.debug("new imap message %r (flags=%s)", mid, flags)
+        if len(content) > SPOOL_MESSAGE_SIZE:
+          spool = tempfile.TemporaryFile()
+          spool.write(content)
+          spool.seek(0)
+          spools.append(spool)
+          content = spool
   
         # put our schemas together
         attachments = {'rfc822' : {'content_type': 'message',
@@ -727,7 +740,11 @@ class ImapProvider(object):
                       'items': {},
                       'attachments': attachments,})
       num += len(infos)
-      self.write_items(infos)
+      try:
+        self.write_items(infos)
+      finally:
+        for spool in spools:
+          spool.close()
     return num
 
   def shouldFetchMessage(self, msg_info):
@@ -0,0 +1,148 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""Schedules the work queues according to the dependencies between them.
+
+The graph of queues is derived from the schemas each extension consumes
+(its source_schemas) and the schemas it has emitted in the past.  Queues
+are put into levels via a topological sort; a queue only starts a batch
+once the queues upstream of it are idle (or it has waited long enough),
+so downstream extensions process bigger batches and see the finished
+output of their upstreams, rather than waking for each upstream write.
+"""
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_emitted_schemas(doc_model, ext_id, limit=1000):
+    """Get the schemas an extension has written from the megaview.  This is
+    only used when the queue state doesn't yet record them, so we only look
+    at a sample of the extension's output.
+    """
+    result = doc_model.open_view(key=['ext_id', ext_id], reduce=False,
+                                 limit=limit)
+    return set(row['value']['rd_schema_id'] for row in result['rows'])
+
+
+def build_graph(source_schemas, emitted_schemas):
+    """Build the graph of queues.  Both arguments are dicts keyed by queue
+    id; source_schemas values are the schemas the queue consumes (None means
+    the queue uses a filter function, so may consume anything) and
+    emitted_schemas values are the schemas the queue writes.
+
+    Returns a dict keyed by queue id with a set of the upstream queue ids.
+    """
+    producers = {}
+    for qid, schemas in emitted_schemas.iteritems():
+        for schema_id in schemas:
+            producers.setdefault(schema_id, set()).add(qid)
+    upstream = {}
+    for qid, schemas in source_schemas.iteritems():
+        ups = upstream[qid] = set()
+        if schemas is None:
+            # we can't tell what it wants - it depends on everyone.
+            ups.update(emitted_schemas)
+        else:
+            for schema_id in schemas:
+                ups.update(producers.get(schema_id, ()))
+        # an extension consuming what it writes isn't a dependency.
+        ups.discard(qid)
+    return upstream
+
+
+def topological_levels(upstream):
+    """Split the graph into levels using Kahn's algorithm - each queue is in
+    a higher level than all its upstream queues.  Cycles are broken by
+    putting the queue with the fewest unresolved upstreams into the next
+    level.
+
+    Returns a dict of queue id -> level.
+    """
+    remaining = dict((qid, set(ups) & set(upstream))
+                     for qid, ups in upstream.iteritems())
+    levels = {}
+    level = 0
+    while remaining:
+        ready = [qid for qid, ups in remaining.iteritems() if not ups]
+        if not ready:
+            # a cycle - break it.
+            qid = min(remaining, key=lambda q: (len(remaining[q]), q))
+            logger.info("breaking dependency cycle at queue %r (depends on %s)",
+                        qid, sorted(remaining[qid]))
+            ready = [qid]
+        for qid in ready:
+            levels[qid] = level
+            del remaining[qid]
+        for ups in remaining.itervalues():
+            ups.difference_update(ready)
+        level += 1
+    return levels
+
+
+class QueueScheduler(object):
+    """Gates each queue on the queues upstream of it.
+
+    is_idle is a callable taking a queue id which returns True if that queue
+    has nothing to do.  The caller is expected to ask can_run() again
+    whenever a queue may have become idle.
+    """
+    # The longest a queue waits for its upstream before going anyway, so a
+    # continuously busy upstream can't starve it.
+    MAX_UPSTREAM_WAIT = 10
+
+    def __init__(self, upstream, is_idle):
+        self.levels = topological_levels(upstream)
+        # we only wait for queues in an earlier level, so cycles can't
+        # deadlock us.
+        self.upstream = {}
+        for qid, ups in upstream.iteritems():
+            self.upstream[qid] = [u for u in ups if u in self.levels and
+                                  self.levels[u] < self.levels[qid]]
+        self.is_idle = is_idle
+        # queue id -> when we first held it back for its upstream.
+        self.held_since = {}
+        by_level = {}
+        for qid, level in self.levels.iteritems():
+            by_level.setdefault(level, []).append(qid)
+        for level in sorted(by_level):
+            logger.debug("queue level %d: %s", level, sorted(by_level[level]))
+
+    def can_run(self, qid):
+        """Returns True if queue qid, which has changes waiting, should start
+        a batch now - ie, all queues upstream of it are idle or it has been
+        held back for long enough.
+        """
+        busy = [u for u in self.upstream.get(qid, ()) if not self.is_idle(u)]
+        if not busy:
+            self.held_since.pop(qid, None)
+            return True
+        now = time.time()
+        since = self.held_since.setdefault(qid, now)
+        if now - since < self.MAX_UPSTREAM_WAIT:
+            return False
+        logger.debug("queue %r giving up waiting for upstream %s", qid, busy)
+        del self.held_since[qid]
+        return True
@@ -49,8 +49,9 @@ def get_conductor(pipeline):
   return conductor
 
 class OutgoingExtension:
-  def __init__(self, id):
+  def __init__(self, id, source_schemas):
     self.id = id
+    self.source_schemas = source_schemas
     self.uses_dependencies = False
 
 class OutgoingProcessor:
@@ -105,7 +106,7 @@ class SyncConductor(object):
     # (or fail) at its own pace.
     for sch_id in self.outgoing_handlers.iterkeys():
       ext_id = "outgoing-" + sch_id
-      ext = OutgoingExtension(ext_id)
+      ext = OutgoingExtension(ext_id, [sch_id])
       proc = OutgoingProcessor(self, ext, sch_id)
       self.pipeline.add_processor(proc)
 
@@ -282,6 +283,8 @@ class SyncConductor(object):
   def sync_incoming(self, options):
     assert self.num_new_items is None # eek - we didn't reset correctly...
     self.num_new_items = 0
+    # what we are about to fetch gets processed ahead of any backlog.
+    self.pipeline.prioritize_new_changes()
     # start synching all 'incoming' accounts.
     accts = self._get_specified_accounts(options)
     if not accts:
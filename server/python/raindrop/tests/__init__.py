@@ -6,6 +6,8 @@ import os
 import glob
 import base64
 import time
+import shutil
+import tempfile
 from email import message_from_string
 
 try:
@@ -17,6 +19,7 @@ from raindrop import json
 import raindrop.config
 from raindrop.model import get_db, fab_db, get_doc_model
 import raindrop.pipeline
+from raindrop import codecache
 from raindrop import bootstrap
 from raindrop import sync
 from raindrop.proto.imap import get_rdkey_for_email
@@ -78,6 +81,24 @@ class FakeOptions:
     folders = []
     max_age = 0
     continuous = False
+    changes_filter = False
+    inline_docs = False
+    process_pool_size = None
+    metrics_port = None
+    profile_exts = None
+    profile_dir = None
+    code_cache_dir = None
+    uptodate_cache = None
+    no_uptodate_cache = True
+    checkpoint_interval = 5
+    page_size = 500
+    reprocess_stale = False
+    queue_workers = 4
+    priority_age = 60*60*24
+    pending_window = 0
+    pending_max_delay = 0
+    view_refresh_workers = 2
+    view_refresh_lag = 1000
 
 class TestCase(unittest.TestCase):
     def resetRaindrop(self):
@@ -230,6 +251,16 @@ class TestCaseWithTestDB(TestCase):
         c.sync(self.pipeline.options, wait=True)
 
 class TestCaseWithCorpus(TestCaseWithTestDB):
+    code_cache_dir = None
+
+    def tearDown(self):
+        try:
+            TestCaseWithTestDB.tearDown(self)
+        finally:
+            if self.code_cache_dir is not None:
+                codecache.cache_dir = None
+                shutil.rmtree(self.code_cache_dir)
+
     def prepare_corpus_environment(self, corpus_name):
         raindrop.config.CONFIG = None
         cd = self.get_corpus_dir(corpus_name)
@@ -239,6 +270,12 @@ class TestCaseWithCorpus(TestCaseWithTestDB):
         dbinfo['name'] = 'raindrop_test_suite'
         dbinfo['port'] = 5984
         opts = self.get_options()
+        # the code cache would otherwise go next to the config file, in
+        # the source tree.
+        self.code_cache_dir = tempfile.mkdtemp()
+        opts.code_cache_dir = self.code_cache_dir
+        # this replaces the pipeline setUp made.
+        self.pipeline.finalize()
         self.pipeline = raindrop.pipeline.Pipeline(self.doc_model, opts)
         self.prepare_test_db(self.config)
         self.pipeline.initialize()
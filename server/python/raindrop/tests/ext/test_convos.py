@@ -2,6 +2,7 @@ import rfc822
 import time
 from pprint import pformat
 from raindrop.tests import TestCaseWithCorpus, TestCaseWithTestDB
+from raindrop.pipeline import ExtensionProcessor
 
 class ConvoTestMixin:
 
@@ -175,6 +176,19 @@ class TestSimpleCorpus(TestCaseWithCorpus, ConvoTestMixin):
 
 # the following tests don't use the corpos, they just introduce a few
 # 'simple' messages manually.
+class TestPendingWindow(TestCaseWithCorpus, ConvoTestMixin):
+    # The summaries are built via process_later - holding that work for a
+    # long time mustn't stop it being done once everything else is.
+    def get_options(self):
+        opts = TestCaseWithCorpus.get_options(self)
+        opts.pending_window = 60
+        opts.pending_max_delay = 600
+        return opts
+
+    def test_convo_single(self):
+        TestSimpleCorpus.test_convo_single.im_func(self)
+
+
 class TestConvCombine(TestCaseWithTestDB, ConvoTestMixin):
 
     msg_template = """\
@@ -373,3 +387,143 @@ Content-Transfer-Encoding: 7bit
         expected_ids = [msg_ids[0], msg_ids[1], msg_ids[3]]
         expected_keys = [['email', mid] for mid in expected_ids]
         self.failUnlessEqual(found_keys, expected_keys)
+
+    def get_summary_and_state(self):
+        key = ['schema_id', 'rd.conv.summary']
+        result = self.doc_model.open_view(key=key, reduce=False,
+                                          include_docs=True)
+        self.failUnlessEqual(len(result['rows']), 1)
+        summary = result['rows'][0]['doc']
+        state = self.doc_model.open_schemas([(summary['rd_key'],
+                                            'rd.conv.summary-state')])[0]
+        return summary, state
+
+    def test_convo_state_source(self):
+        # The summary state is written with the summary as its source, so
+        # unprocess removes it along with everything else the extensions
+        # made, and reprocess doesn't mistake it for a raw message.
+        msg_ids = ["1@something", "2@something"]
+        msg_keys = [['email', mid] for mid in msg_ids]
+        items = [self.get_message_schema_item(msgid, [msg_ids[0]])
+                 for msgid in msg_ids]
+        self.doc_model.create_schema_items(items)
+        self.ensure_pipeline_complete()
+        summary, state = self.get_summary_and_state()
+        result = self.doc_model.open_view(key=['source', summary['_id']],
+                                          reduce=False)
+        self.failUnless(state['_id'] in [row['id'] for row in result['rows']])
+        result = self.doc_model.open_view(key=['source', None], reduce=False)
+        self.failIf(state['_id'] in [row['id'] for row in result['rows']])
+
+        self.pipeline.unprocess()
+        state = self.doc_model.open_schemas([(summary['rd_key'],
+                                            'rd.conv.summary-state')])[0]
+        self.failUnlessEqual(state, None)
+        # and it all gets built again.
+        self.ensure_pipeline_complete()
+        summary, state = self.get_summary_and_state()
+        self.failUnlessEqual(summary['message_ids'], msg_keys)
+        self.failUnlessEqual(sorted(r['id'] for r in state['messages']),
+                             sorted(msg_keys))
+
+    def test_convo_incremental(self):
+        msg_ids = ["1@something", "2@something", "3@something", "4@something"]
+        msg_keys = [['email', mid] for mid in msg_ids]
+        dates = [time.time()+x for x in range(4)]
+        items = []
+        for msgid, date in zip(msg_ids, dates):
+            si = self.get_message_schema_item(msgid, [msg_ids[0]], date)
+            items.append(si)
+        self.doc_model.create_schema_items(items)
+        self.ensure_pipeline_complete()
+        get_summary_and_state = self.get_summary_and_state
+
+        def mark_seen(msgid):
+            si = {'rd_key': ['email', msgid],
+                  'rd_schema_id': 'rd.msg.seen',
+                  'rd_source' : None,
+                  'rd_ext_id': 'rd.testsuite',
+                  'items': {'seen': True,
+                            'outgoing_state': 'sent',},
+                  }
+            self.doc_model.create_schema_items([si])
+            self.ensure_pipeline_complete()
+
+        summary, state = get_summary_and_state()
+        self.failUnlessEqual(summary['unread_ids'], msg_keys)
+        self.failUnlessEqual(sorted(r['id'] for r in state['messages']),
+                             sorted(msg_keys))
+
+        # Marking messages as seen updates the summary from the state.
+        mark_seen(msg_ids[2])
+        mark_seen(msg_ids[3])
+        summary, state = get_summary_and_state()
+        self.failUnlessEqual(summary['message_ids'], msg_keys)
+        self.failUnlessEqual(summary['unread_ids'], msg_keys[:2])
+        self.failUnlessEqual([m['id'] for m in summary['messages']],
+                             [msg_keys[0], msg_keys[1], msg_keys[3]])
+        seen = self.doc_model.open_schemas([(msg_keys[3], 'rd.msg.seen')])[0]
+        for record in state['messages']:
+            if record['id'] == msg_keys[3]:
+                self.failUnlessEqual(record['revs']['rd.msg.seen'],
+                                     seen['_rev'])
+                self.failIf(record['unread'])
+
+        # Without the state the summary is rebuilt from scratch and must
+        # come out the same.
+        si = {'rd_key': summary['rd_key'],
+              'rd_schema_id': 'rd.conv.summary-state',
+              'rd_ext_id': state['rd_schema_provider'],
+              '_rev': state['_rev'],
+              '_deleted': True,
+              }
+        self.doc_model.create_schema_items([si])
+        mark_seen(msg_ids[0])
+        rebuilt, state = get_summary_and_state()
+        self.failIf(state is None)
+        self.failUnlessEqual(rebuilt['unread_ids'], [msg_keys[1]])
+        self.failUnlessEqual([m['id'] for m in rebuilt['messages']],
+                             [m['id'] for m in summary['messages']])
+        for name in ['message_ids', 'identities', 'from_display',
+                     'grouping-timestamp', 'all_grouping_tags']:
+            self.failUnlessEqual(rebuilt[name], summary[name], name)
+
+
+class TestConvPendingWindow(TestCaseWithTestDB, ConvoTestMixin):
+    # Summaries asked for while the window is open are built together.
+    msg_template = TestConvCombine.msg_template
+    get_message_schema_item = TestConvCombine.get_message_schema_item.im_func
+
+    def get_options(self):
+        opts = TestCaseWithTestDB.get_options(self)
+        opts.pending_window = 60
+        opts.pending_max_delay = 600
+        return opts
+
+    def test_coalesced(self):
+        calls = []
+        real_process_pending = ExtensionProcessor.process_pending
+        def process_pending(processor, pending):
+            if processor.ext.id == 'rd.ext.core.convo-to-summary':
+                calls.append(pending)
+            return real_process_pending(processor, pending)
+        msg_ids = ["1@something", "2@something", "3@something"]
+        ExtensionProcessor.process_pending = process_pending
+        try:
+            # each message is a separate change, so is likely to be in a
+            # batch of its own.
+            for msgid in msg_ids:
+                si = self.get_message_schema_item(msgid, [msg_ids[0]])
+                self.doc_model.create_schema_items([si])
+            self.ensure_pipeline_complete()
+        finally:
+            ExtensionProcessor.process_pending = real_process_pending
+        self.failUnlessEqual(len(calls), 1)
+        self.failUnlessEqual(len(calls[0]), len(msg_ids))
+        key = ['schema_id', 'rd.conv.summary']
+        result = self.doc_model.open_view(key=key, reduce=False,
+                                          include_docs=True)
+        self.failUnlessEqual(len(result['rows']), 1)
+        summary = result['rows'][0]['doc']
+        self.failUnlessEqual(sorted(summary['message_ids']),
+                             sorted(['email', mid] for mid in msg_ids))
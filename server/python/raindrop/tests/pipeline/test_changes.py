@@ -0,0 +1,185 @@
+# Tests of the multiplexed _changes feed, using the in-memory couch.
+import time
+
+from raindrop.tests import TestCase
+from raindrop.model import DocumentModel
+from raindrop.memcouch import MemoryCouchDB
+from raindrop.changesiter import ChangesFeedMultiplexer, ChangesIterFactory
+
+class TestChangesFeed(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.db = MemoryCouchDB('raindrop_test_suite')
+        self.doc_model = DocumentModel(self.db)
+        self.mux = ChangesFeedMultiplexer()
+
+    def tearDown(self):
+        self.mux.stop()
+        TestCase.tearDown(self)
+
+    def _make_items(self, schema_id, num, prefix='', **fields):
+        sis = []
+        for i in range(num):
+            items = {'field': i}
+            items.update(fields)
+            sis.append({'rd_key': ['test', '%s%s.%d' % (prefix, schema_id, i)],
+                        'rd_schema_id': schema_id,
+                        'rd_ext_id': 'rd.testsuite',
+                        'items': items,
+                        })
+        return [i['id'] for i in self.doc_model.create_schema_items(sis)]
+
+    def _wait_for_reader(self):
+        # wait until the reader has seen every change in the database.
+        db_seq = self.db.infoDB()['update_seq']
+        for i in range(100):
+            if self.mux.last_seq == db_seq:
+                return db_seq
+            time.sleep(0.05)
+        self.fail("reader stuck at %s of %s" % (self.mux.last_seq, db_seq))
+
+    def _drain(self, cursor):
+        got = []
+        while cursor.poll():
+            got.extend(elt[0] for elt in cursor.make_iter(100))
+        return got
+
+    def test_routing(self):
+        a_ids = self._make_items('rd.test.a', 2)
+        b_ids = self._make_items('rd.test.b', 3)
+        cur_a = self.mux.add_cursor(0, schemas=['rd.test.a'])
+        cur_b = self.mux.add_cursor(0, schemas=['rd.test.b'])
+        cur_all = self.mux.add_cursor(0)
+        self.mux.start(self.doc_model)
+        last_seq = self._wait_for_reader()
+        self.failUnlessEqual(self._drain(cur_a), a_ids)
+        self.failUnlessEqual(self._drain(cur_b), b_ids)
+        self.failUnlessEqual(self._drain(cur_all), a_ids + b_ids)
+        # every cursor is up-to-date, even those not given the last change.
+        for cursor in (cur_a, cur_b, cur_all):
+            self.failUnlessEqual(cursor.current_seq, last_seq)
+        self.failUnlessEqual(self.mux.idle_seq(), last_seq)
+
+    def test_cursor_seq(self):
+        # a cursor only sees changes after its own sequence.
+        old_ids = self._make_items('rd.test.a', 2)
+        start_seq = self.db.infoDB()['update_seq']
+        new_ids = self._make_items('rd.test.b', 2)
+        cur_old = self.mux.add_cursor(0)
+        cur_new = self.mux.add_cursor(start_seq)
+        self.mux.start(self.doc_model)
+        self._wait_for_reader()
+        self.failUnlessEqual(self._drain(cur_new), new_ids)
+        self.failUnlessEqual(self._drain(cur_old), old_ids + new_ids)
+
+    def test_slow_cursor(self):
+        # A cursor which isn't keeping up doesn't stop the feed for the
+        # others - it fetches what it missed itself.
+        self.mux.MAX_BUFFERED = 2
+        ids = self._make_items('rd.test.a', 7)
+        cur_fast = self.mux.add_cursor(0)
+        cur_slow = self.mux.add_cursor(0)
+        self.mux.start(self.doc_model)
+        # the fast one keeps up as the reader reads.
+        got = []
+        while len(got) < len(ids):
+            got.extend(elt[0] for elt in cur_fast.make_iter(100))
+        self.failUnlessEqual(got, ids)
+        last_seq = self._wait_for_reader()
+        self.failIfEqual(cur_slow.refetch_seq, None)
+        self.failUnless(cur_slow.has_changes())
+        # later changes are refetched too, without duplicates.
+        more_ids = self._make_items('rd.test.a', 1)
+        self.failUnlessEqual(self._drain(cur_slow), ids + more_ids)
+        self.failUnlessEqual(cur_slow.refetch_seq, None)
+        self.failUnlessEqual(cur_slow.current_seq,
+                             self.db.infoDB()['update_seq'])
+
+    def test_priority_seq(self):
+        # changes after the priority sequence jump the backlog.
+        old_ids = self._make_items('rd.test.a', 3)
+        self.mux.priority_seq = self.db.infoDB()['update_seq']
+        new_ids = self._make_items('rd.test.a', 2, 'new.')
+        cursor = self.mux.add_cursor(0)
+        self.mux.start(self.doc_model)
+        last_seq = self._wait_for_reader()
+        # a batch from the priority lane ends with it...
+        got = [elt[0] for elt in cursor.make_iter(100)]
+        self.failUnlessEqual(got, new_ids)
+        # and the cursor doesn't claim to be past the backlog.
+        self.failUnless(cursor.current_seq < self.mux.priority_seq)
+        self.failUnlessEqual(self._drain(cursor), old_ids)
+        self.failUnlessEqual(cursor.current_seq, last_seq)
+
+    def test_priority_age(self):
+        # so do documents with a recent timestamp.
+        self.mux.priority_age = 60
+        old_ids = self._make_items('rd.test.a', 2, timestamp=time.time()-120)
+        new_ids = self._make_items('rd.test.a', 2, 'new.',
+                                   timestamp=time.time())
+        more_ids = self._make_items('rd.test.a', 1, 'more.',
+                                    timestamp=time.time()-120)
+        cursor = self.mux.add_cursor(0)
+        self.mux.start(self.doc_model, include_docs=True)
+        self._wait_for_reader()
+        got = [elt[0] for elt in cursor.make_iter(100)]
+        self.failUnlessEqual(got, new_ids)
+        self.failUnlessEqual(self._drain(cursor), old_ids + more_ids)
+
+    def test_priority_age_needs_docs(self):
+        # without the docs in the feed we can't see their timestamps.
+        self.mux.priority_age = 60
+        old_ids = self._make_items('rd.test.a', 2, timestamp=time.time()-120)
+        new_ids = self._make_items('rd.test.a', 2, 'new.',
+                                   timestamp=time.time())
+        cursor = self.mux.add_cursor(0)
+        self.mux.start(self.doc_model)
+        self._wait_for_reader()
+        got = [elt[0] for elt in cursor.make_iter(100)]
+        self.failUnlessEqual(got, old_ids + new_ids)
+
+    def test_priority_age_big_doc(self):
+        # a doc too big to keep in the feed still has its timestamp seen.
+        feed = ChangesIterFactory()
+        feed.MAX_INLINE_DOC_SIZE = 100
+        now = time.time()
+        def make_change(seq, timestamp):
+            return {'seq': seq, 'id': 'doc%d' % seq,
+                    'changes': [{'rev': '1-a'}],
+                    'doc': {'_id': 'doc%d' % seq, 'timestamp': timestamp}}
+        small = feed._trim_change(make_change(1, now), 50)
+        big = feed._trim_change(make_change(2, now), 500)
+        old = feed._trim_change(make_change(3, now - 120), 500)
+        self.failIfEqual(feed._change_to_doc(small), None)
+        self.failUnlessEqual(feed._change_to_doc(big), None)
+        mux = ChangesFeedMultiplexer()
+        mux.feed = feed
+        mux.priority_age = 60
+        self.failUnless(mux._is_priority(1, small))
+        self.failUnless(mux._is_priority(2, big))
+        self.failIf(mux._is_priority(3, old))
+
+    def test_refetch_race(self):
+        # Changes the shared feed reads while a cursor is refetching aren't
+        # given to the cursor, so it must fetch them too.
+        self.mux.MAX_BUFFERED = 2
+        ids = self._make_items('rd.test.a', 5)
+        cursor = self.mux.add_cursor(0)
+        real_list_changes = self.db.listChanges
+        late_ids = []
+        def list_changes(**kw):
+            result = real_list_changes(**kw)
+            if not late_ids and len(result['results']) < kw['limit']:
+                # a short page - add more before the cursor sees it.
+                late_ids.extend(self._make_items('rd.test.a', 2, 'late.'))
+                self._wait_for_reader()
+            return result
+        self.db.listChanges = list_changes
+        self.mux.start(self.doc_model)
+        self._wait_for_reader()
+        self.failIfEqual(cursor.refetch_seq, None)
+        self.failUnlessEqual(self._drain(cursor), ids + late_ids)
+        self.failUnlessEqual(len(late_ids), 2)
+        self.failUnlessEqual(cursor.refetch_seq, None)
+        self.failUnlessEqual(cursor.current_seq,
+                             self.db.infoDB()['update_seq'])
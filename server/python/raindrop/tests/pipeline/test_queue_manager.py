@@ -0,0 +1,151 @@
+# Tests of how the queue manager shares its workers between the queues,
+# using stand-ins for the queues and their feeds.
+import random
+
+from raindrop.tests import TestCase, FakeOptions
+from raindrop.pipeline import StatefulQueueManager, QueueState
+
+class FakeFeed:
+    def __init__(self, current_seq, changes=True):
+        self.current_seq = current_seq
+        self.changes = changes
+        self.priority = False
+
+    def poll(self):
+        return self.changes
+
+class FakeQueue:
+    def __init__(self, queue_id):
+        self.queue_id = queue_id
+        self.due = False
+
+    def pending_due(self, window, max_delay):
+        return self.due
+
+class FakeChangesFeed:
+    def __init__(self, last_seq):
+        self.last_seq = last_seq
+
+class FakeScheduler:
+    def __init__(self):
+        self.held = set()
+
+    def can_run(self, queue_id):
+        return queue_id not in self.held
+
+class TestQueueManagerBase(TestCase):
+    last_seq = 1000
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.random_state = random.getstate()
+        random.seed(1)
+
+    def tearDown(self):
+        random.setstate(self.random_state)
+        TestCase.tearDown(self)
+
+    def _make_manager(self, seqs):
+        # one queue for each sequence, named for its position.
+        queues = [FakeQueue('q%d' % i) for i in range(len(seqs))]
+        mgr = StatefulQueueManager(None, queues, FakeOptions())
+        mgr.queue_states = []
+        for seq in seqs:
+            qs = QueueState()
+            qs.feed = FakeFeed(seq)
+            mgr.queue_states.append(qs)
+        mgr.changes_feed = FakeChangesFeed(self.last_seq)
+        mgr.scheduler = FakeScheduler()
+        # we never want to block.
+        mgr.READY_RECHECK_INTERVAL = 0
+        return mgr
+
+    def _count_chosen(self, mgr, ready, num):
+        counts = dict((q.queue_id, 0) for q, qs in ready)
+        for i in range(num):
+            q, qs = mgr._choose_queue(ready)
+            counts[q.queue_id] += 1
+        return counts
+
+class TestChooseQueue(TestQueueManagerBase):
+    def test_weighted_by_lag(self):
+        mgr = self._make_manager([900, 990, 1000])
+        ready = zip(mgr.queues, mgr.queue_states)
+        counts = self._count_chosen(mgr, ready, 5000)
+        # the biggest backlog gets most of the workers...
+        self.failUnless(counts['q0'] > counts['q1'] > counts['q2'], counts)
+        self.failUnless(counts['q0'] > 5000 * 0.8, counts)
+        # but a queue with no backlog isn't starved.
+        self.failUnless(counts['q2'] > 0, counts)
+
+    def test_ahead_of_feed(self):
+        # a queue can be ahead of what the feed has read - it still gets
+        # a chance.
+        mgr = self._make_manager([1000, 1005])
+        ready = zip(mgr.queues, mgr.queue_states)
+        counts = self._count_chosen(mgr, ready, 1000)
+        self.failUnless(counts['q0'] > 0 and counts['q1'] > 0, counts)
+
+class TestGetReadyQueue(TestQueueManagerBase):
+    def test_claims(self):
+        mgr = self._make_manager([0])
+        q, qs = mgr._get_ready_queue()
+        self.failUnless(q is mgr.queues[0])
+        self.failUnless(qs.running)
+
+    def test_skips_busy(self):
+        mgr = self._make_manager([0, 0, 0, 500])
+        mgr.queue_states[0].running = True
+        mgr.queue_states[1].failure = RuntimeError("failed")
+        # the scheduler is holding it for its upstream queues.
+        mgr.scheduler.held.add('q2')
+        for i in range(20):
+            q, qs = mgr._get_ready_queue()
+            self.failUnlessEqual(q.queue_id, 'q3')
+            qs.running = False
+
+    def test_pending_due(self):
+        # A queue without new changes is only chosen when the items it is
+        # holding are due.
+        mgr = self._make_manager([0, 1000])
+        mgr.queue_states[0].feed.changes = False
+        mgr.queue_states[1].feed.changes = False
+        mgr.queues[1].due = True
+        q, qs = mgr._get_ready_queue()
+        self.failUnlessEqual(q.queue_id, 'q1')
+        qs.running = False
+        # but not while its upstream queues are busy.
+        mgr.queues[0].due = True
+        mgr.scheduler.held.add('q1')
+        for i in range(20):
+            q, qs = mgr._get_ready_queue()
+            self.failUnlessEqual(q.queue_id, 'q0')
+            qs.running = False
+
+    def test_urgent(self):
+        # a queue with changes in its priority lane is chosen before any
+        # other, however far behind they are.
+        mgr = self._make_manager([0, 0, 990])
+        mgr.queue_states[2].feed.priority = True
+        for i in range(20):
+            q, qs = mgr._get_ready_queue()
+            self.failUnlessEqual(q.queue_id, 'q2')
+            qs.running = False
+        # once it is busy the others get their turn.
+        mgr.queue_states[2].running = True
+        q, qs = mgr._get_ready_queue()
+        self.failIfEqual(q.queue_id, 'q2')
+        qs.running = False
+        mgr.queue_states[2].running = False
+        # and they also do while the scheduler holds it for its upstream
+        # queues.
+        mgr.scheduler.held.add('q2')
+        for i in range(20):
+            q, qs = mgr._get_ready_queue()
+            self.failIfEqual(q.queue_id, 'q2')
+            qs.running = False
+
+    def test_stopping(self):
+        mgr = self._make_manager([0])
+        mgr.stopping = True
+        self.failUnlessEqual(mgr._get_ready_queue(), (None, None))
@@ -1,8 +1,17 @@
 # The first raindrop unittest!
 
+import os
 import re
+import shutil
+import threading
+import tempfile
 from raindrop.tests import TestCaseWithTestDB, FakeOptions
 from raindrop.model import get_doc_model
+from raindrop import metrics
+from raindrop import procpool
+from raindrop.pipeline import Extension, ExtensionInitError
+from raindrop.model import DocumentSaveError
+from raindrop.checkpoint import CheckpointService
 from raindrop.proto import test as test_proto
 
 import logging
@@ -116,6 +125,19 @@ class TestErrors(TestPipelineBase):
         seq = self.get_last_by_seq(2)
         return check_target_last(seq)
 
+    def test_metrics(self):
+        # Test the extensions count what they did.
+        metrics.reset_metrics()
+        test_proto.set_test_options(next_convert_fails=True)
+        self.process_doc(1)
+        m = metrics.get_extension_metrics('rd.test.core.test_converter')
+        self.failUnlessEqual(m.seen.value, 1)
+        self.failUnlessEqual(m.processed.value, 0)
+        self.failUnlessEqual(m.errors.value, 1)
+        self.failUnlessEqual(m.handler_time.count, 1)
+        self.failUnless('ext="rd.test.core.test_converter"' in
+                        metrics.format_text())
+
     def test_reprocess_errors(self):
         # Test that reprocessing an error results in the correct thing.
         def check_target_last(lasts, expected):
@@ -151,3 +173,637 @@ class TestErrors(TestPipelineBase):
         doc = self.process_doc(1)
         seq = self.get_last_by_seq(2)
         return check_last_doc(seq)
+
+class TestInlineDocs(TestPipelineBase):
+    extensions = ['rd.test.core.test_converter']
+
+    def get_options(self):
+        ret = TestPipelineBase.get_options(self)
+        ret.inline_docs = True
+        return ret
+
+    def test_not_fetched(self):
+        # The docs which came with the _changes feed aren't fetched again.
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        self.makeAnotherTestMessage()
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.test.raw'],
+                                          reduce=False)
+        raw_ids = [row['id'] for row in result['rows']]
+        self.failUnlessEqual(len(raw_ids), 1)
+        fetched = []
+        def open_documents_by_id(doc_ids, *args, **kw):
+            fetched.extend(doc_ids)
+            return orig(doc_ids, *args, **kw)
+        dm = self.doc_model
+        orig = dm.open_documents_by_id
+        dm.open_documents_by_id = open_documents_by_id
+        metrics.reset_metrics()
+        try:
+            self.ensure_pipeline_complete()
+        finally:
+            del dm.open_documents_by_id
+        m = metrics.get_extension_metrics('rd.test.core.test_converter')
+        self.failUnlessEqual(m.processed.value, 1)
+        self.failIf(raw_ids[0] in fetched, fetched)
+
+
+class TestBulkOps(TestPipelineBase):
+    extensions = TestPipelineBase.simple_extensions
+
+    def get_options(self):
+        ret = TestPipelineBase.get_options(self)
+        # small pages so the tests go through more than one.
+        ret.page_size = 2
+        return ret
+
+    def _count_schema(self, schema_id):
+        result = self.doc_model.open_view(key=['schema_id', schema_id])
+        return sum(row['value'] for row in result['rows'])
+
+    def _process_docs(self, num):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        for i in range(num):
+            self.makeAnotherTestMessage()
+        self.ensure_pipeline_complete()
+
+    def test_unprocess(self):
+        self._process_docs(3)
+        self.failUnlessEqual(self._count_schema('rd.msg.body'), 3)
+        self.pipeline.unprocess()
+        self.failUnlessEqual(self._count_schema('rd.msg.body'), 0)
+        self.failUnlessEqual(self._count_schema('rd.msg.email'), 0)
+        # the raw messages have no source, so are left alone, as is no
+        # record of the operation.
+        self.failUnlessEqual(self._count_schema('rd.msg.test.raw'), 3)
+        self.failUnlessEqual(self._count_schema('rd.core.bulk-op-state'), 0)
+
+    def test_unprocess_resumes(self):
+        self._process_docs(3)
+        # fail after the first page has been deleted.
+        real_delete = self.pipeline._delete_schema_items
+        calls = []
+        def failing_delete(items):
+            calls.append(items)
+            if len(calls) > 1:
+                raise RuntimeError("interrupted")
+            real_delete(items)
+        self.pipeline._delete_schema_items = failing_delete
+        self.failUnlessRaises(RuntimeError, self.pipeline.unprocess)
+        self.failUnlessEqual(self._count_schema('rd.core.bulk-op-state'), 1)
+        # the next run picks up from the page which failed.
+        del self.pipeline._delete_schema_items
+        self.pipeline.unprocess()
+        self.failUnlessEqual(self._count_schema('rd.msg.body'), 0)
+        self.failUnlessEqual(self._count_schema('rd.msg.test.raw'), 3)
+        self.failUnlessEqual(self._count_schema('rd.core.bulk-op-state'), 0)
+
+    def _change_extension(self, ext_id):
+        # Pretend a new version of the extension was installed.
+        dm = self.doc_model
+        doc = dm.open_schemas([(['ext', ext_id], 'rd.ext.workqueue')])[0]
+        doc['code'] += "\n# a new version\n"
+        dm.update_documents([doc])
+
+    def _get_ext_values(self, ext_id, name):
+        # the given field of the items written by the extension.
+        result = self.doc_model.open_view(key=['ext_id', ext_id],
+                                          reduce=False)
+        return [row['value'].get(name)
+                for row in result['rows']
+                if row['value']['rd_schema_id'] != 'rd.core.workqueue-state']
+
+    def _get_fingerprints(self, ext_id):
+        return self._get_ext_values(ext_id, 'rd_ext_fingerprint')
+
+    def _get_revs(self, ext_id):
+        return sorted(self._get_ext_values(ext_id, '_rev'))
+
+    def test_reprocess_stale(self):
+        self._process_docs(3)
+        ext_id = 'rd.ext.core.msg-rfc-to-email'
+        other_id = 'rd.ext.core.msg-email-to-body'
+        old = self._get_fingerprints(ext_id)
+        self.failUnlessEqual(len(old), 3)
+        self.failUnlessEqual(len(set(old)), 1)
+        other_revs = self._get_revs(other_id)
+        # nothing is stale, so nothing is done.
+        self.pipeline.reprocess_stale()
+        self.failUnlessEqual(self._get_fingerprints(ext_id), old)
+
+        self._change_extension(ext_id)
+        self.pipeline.reprocess_stale()
+        new = self._get_fingerprints(ext_id)
+        self.failUnlessEqual(len(new), 3)
+        self.failIf(set(new) & set(old), new)
+        # the other extension's items weren't touched.
+        self.failUnlessEqual(self._get_revs(other_id), other_revs)
+        self.failUnlessEqual(self._count_schema('rd.core.bulk-op-state'), 0)
+
+    def test_reprocess_stale_background(self):
+        self._process_docs(3)
+        ext_id = 'rd.ext.core.msg-rfc-to-email'
+        other_id = 'rd.ext.core.msg-email-to-body'
+        old = self._get_fingerprints(ext_id)
+        other_revs = self._get_revs(other_id)
+        self._change_extension(ext_id)
+        self.pipeline.options.reprocess_stale = True
+        self.ensure_pipeline_complete()
+        new = self._get_fingerprints(ext_id)
+        self.failUnlessEqual(len(new), 3)
+        self.failIf(set(new) & set(old), new)
+        # the new emails were processed by the extensions downstream.
+        revs = self._get_revs(other_id)
+        self.failUnlessEqual(len(revs), 3)
+        self.failIf(set(revs) & set(other_revs), revs)
+
+class TestBrokenExtension(TestPipelineBase):
+    extensions = ['rd.test.core.test_converter', 'rd.test.broken']
+
+    def get_options(self):
+        ret = TestPipelineBase.get_options(self)
+        ret.exts = self.extensions
+        return ret
+
+    def _install(self, code):
+        si = {'rd_key': ['ext', 'rd.test.broken'],
+              'rd_schema_id': 'rd.ext.workqueue',
+              'rd_ext_id': 'rd.testsuite',
+              'rd_source': None,
+              'items': {'source_schemas': ['rd.msg.test.raw'],
+                        'category': 'provider',
+                        'content_type': 'application/x-python',
+                        'code': code,
+                        },
+              }
+        self.doc_model.create_schema_items([si])
+
+    def _count_schema(self, schema_id):
+        result = self.doc_model.open_view(key=['schema_id', schema_id])
+        rows = result['rows']
+        return rows[0]['value'] if rows else 0
+
+    def test_init_fails(self):
+        # An extension which can't initialize is disabled and its queue
+        # stopped, rather than writing an error for every document.
+        f = lambda record: re.match("(Failed to initialize extension|queue) "
+                                    "u?'rd.test.broken'",
+                                    record.getMessage()) is not None
+        self.log_handler.ok_filters.append(f)
+        self._install("import rd_no_such_module\n"
+                      "def handler(doc):\n"
+                      "    pass\n")
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        for i in range(3):
+            self.makeAnotherTestMessage()
+        metrics.reset_metrics()
+        self.ensure_pipeline_complete()
+        self.failUnlessEqual(self._count_schema('rd.core.error'), 0)
+        m = metrics.get_extension_metrics('rd.test.broken')
+        self.failUnlessEqual(m.processed.value, 0)
+        # the other extensions weren't stopped.
+        self.failUnlessEqual(self._count_schema('rd.msg.rfc822'), 3)
+
+    def test_no_handler(self):
+        # one without a handler isn't even loaded.
+        self.log_handler.ok_filters.append(
+            lambda record: "doesn't have a 'handler'" in record.getMessage())
+        self._install("def not_handler(doc):\n"
+                      "    pass\n")
+        ext_ids = [ext.id for ext in self.pipeline.get_extensions()]
+        self.failIf('rd.test.broken' in ext_ids)
+        self.failUnless('rd.test.core.test_converter' in ext_ids)
+
+class TestConcurrency(TestPipelineBase):
+    extensions = TestPipelineBase.simple_extensions
+
+    def test_namespaces(self):
+        src = "def handler(doc):\n    pass\n"
+        doc = {'source_schemas': ['rd.msg.test.raw'],
+               'concurrency': 2,
+               'code': src,
+               }
+        ext = Extension('rd.test.concurrent', doc,
+                        code=compile(src, "<rd.test.concurrent>", "exec"))
+        # each concurrent caller gets a namespace of its own...
+        g1 = ext.acquire_namespace()
+        g2 = ext.acquire_namespace()
+        self.failIf(g1 is g2)
+        self.failUnless(callable(g2['handler']))
+        # up to the extension's concurrency.
+        self.failUnlessRaises(RuntimeError, ext.acquire_namespace)
+        # and they are re-used.
+        ext.release_namespace(g1)
+        self.failUnless(ext.acquire_namespace() is g1)
+
+    def test_slices(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        for i in range(6):
+            self.makeAnotherTestMessage()
+        self.ensure_pipeline_complete()
+        ext_id = 'rd.ext.core.msg-email-to-body'
+        metrics.reset_metrics()
+        qr = self.pipeline.get_queue_runners([ext_id])[0]
+        qr.processor.ext.concurrency = 3
+        self.pipeline.options.force = True
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.email'],
+                                          reduce=False)
+        # every doc twice.
+        elts = [(row['id'], row['value']['_rev'], 'rd.msg.email', None)
+                for row in result['rows']] * 2
+        slices = []
+        real_process_elts = qr._process_elts
+        def process_elts(elts, results):
+            slices.append((threading.currentThread(), [e[0] for e in elts]))
+            return real_process_elts(elts, results)
+        qr._process_elts = process_elts
+        qr.process_queue(iter(elts))
+        # the batch was split between threads...
+        self.failUnless(len(slices) > 1, slices)
+        self.failUnlessEqual(len(set(t for t, ids in slices)), len(slices))
+        # with all the changes for a document in the same slice.
+        seen = {}
+        for i, (t, ids) in enumerate(slices):
+            for src_id in ids:
+                self.failUnlessEqual(seen.setdefault(src_id, i), i)
+        self.failUnlessEqual(sorted(sum([ids for t, ids in slices], [])),
+                             sorted(elt[0] for elt in elts))
+        m = metrics.get_extension_metrics(ext_id)
+        self.failUnlessEqual(m.processed.value, 12)
+        self.failUnlessEqual(m.errors.value, 0)
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.body'])
+        self.failUnlessEqual(result['rows'][0]['value'], 6)
+
+class TestPrefetch(TestPipelineBase):
+    extensions = TestPipelineBase.simple_extensions
+
+    def setUp(self):
+        TestPipelineBase.setUp(self)
+        self.wrapped = []
+
+    def tearDown(self):
+        for name in self.wrapped:
+            delattr(self.doc_model, name)
+        TestPipelineBase.tearDown(self)
+
+    def _record_calls(self, name, want):
+        # Record the calls made to a method of our doc model for which
+        # want(args, kw) is true.
+        calls = []
+        real = getattr(self.doc_model, name)
+        def wrapper(*args, **kw):
+            if want(args, kw):
+                calls.append((args, kw))
+            return real(*args, **kw)
+        setattr(self.doc_model, name, wrapper)
+        self.wrapped.append(name)
+        return calls
+
+    def test_batched(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        for i in range(3):
+            self.makeAnotherTestMessage()
+        self.ensure_pipeline_complete()
+        ext_id = 'rd.ext.core.msg-email-to-body'
+        metrics.reset_metrics()
+        qr = self.pipeline.get_queue_runners([ext_id])[0]
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.email'],
+                                          reduce=False)
+        elts = [(row['id'], row['value']['_rev'], 'rd.msg.email', None)
+                for row in result['rows']]
+        src_ids = sorted(elt[0] for elt in elts)
+        self.failUnlessEqual(len(src_ids), 3)
+        # the lookups of what the extension wrote from each source doc, and
+        # the fetches of the source docs themselves.
+        view_calls = self._record_calls('open_view',
+                        lambda args, kw: 'ext_id-source' in repr(kw))
+        doc_calls = self._record_calls('open_documents_by_id',
+                        lambda args, kw: set(args[0]) & set(src_ids))
+        # everything is up-to-date - one request tells us so.
+        qr.process_queue(iter(elts))
+        self.failUnlessEqual(len(view_calls), 1)
+        self.failUnlessEqual(len(view_calls[0][1]['keys']), 3)
+        self.failUnlessEqual(doc_calls, [])
+        # when they all need doing, they are fetched in one request.
+        del view_calls[:]
+        self.pipeline.options.force = True
+        qr.process_queue(iter(elts))
+        self.failUnlessEqual(len(view_calls), 1)
+        self.failUnlessEqual(len(doc_calls), 1)
+        self.failUnlessEqual(sorted(doc_calls[0][0][0]), src_ids)
+        m = metrics.get_extension_metrics(ext_id)
+        self.failUnlessEqual(m.processed.value, 3)
+
+class TestCheckpoints(TestPipelineBase):
+    extensions = TestPipelineBase.simple_extensions
+
+    def _get_seq(self, ext_id):
+        doc = self.doc_model.open_schemas([(['ext', ext_id],
+                                            'rd.core.workqueue-state')])[0]
+        return doc['seq']
+
+    def _count_schema(self, schema_id):
+        result = self.doc_model.open_view(key=['schema_id', schema_id])
+        return result['rows'][0]['value']
+
+    def test_crash_resume(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        ext_id = 'rd.ext.core.msg-email-to-body'
+        for i in range(3):
+            self.makeAnotherTestMessage()
+        self.ensure_pipeline_complete()
+        saved_seq = self._get_seq(ext_id)
+        # process 2 more, but 'crash' before anything is checkpointed.
+        real_flush = CheckpointService.flush
+        CheckpointService.flush = lambda service: None
+        try:
+            for i in range(2):
+                self.makeAnotherTestMessage()
+            self.ensure_pipeline_complete()
+        finally:
+            CheckpointService.flush = real_flush
+        self.failUnlessEqual(self._get_seq(ext_id), saved_seq)
+        # the next run picks up where the checkpoint was - only the 2 new
+        # messages are looked at again, and nothing is duplicated.
+        metrics.reset_metrics()
+        self.ensure_pipeline_complete()
+        m = metrics.get_extension_metrics(ext_id)
+        self.failUnlessEqual(m.seen.value, 2)
+        self.failUnlessEqual(m.processed.value, 0)
+        self.failUnlessEqual(self._count_schema('rd.msg.body'), 5)
+        self.failUnless(self._get_seq(ext_id) > saved_seq)
+
+class TestConflicts(TestPipelineBase):
+    extensions = TestPipelineBase.simple_extensions
+
+    def _make_item(self, ext_id, items):
+        return {'rd_key': ['test', 'conflict'],
+                'rd_schema_id': 'rd.test.merge',
+                'rd_ext_id': ext_id,
+                'items': items,
+                }
+
+    def _get_runner(self):
+        return self.pipeline.get_queue_runners(['rd.ext.core.msg-email-to-body'])[0]
+
+    def test_merge(self):
+        # Another extension wrote its item to the doc first - ours is
+        # applied to the doc as it is now.
+        dm = self.doc_model
+        runner = self._get_runner()
+        # (after the pipeline has set the confidences of the real ones.)
+        dm.set_extension_confidences({'rd.test.a': 1, 'rd.test.b': 2})
+        si_a = self._make_item('rd.test.a', {'field_a': 'a'})
+        si_b = self._make_item('rd.test.b', {'field_b': 'b'})
+        did = dm.create_schema_items([si_a])[0]['id']
+        conflicts = [{'id': did, 'error': 'conflict',
+                      'reason': 'Document update conflict.'}]
+        left = runner._merge_conflicts(conflicts, {did: [si_b]})
+        self.failUnlessEqual(left, [])
+        doc = dm.open_documents_by_id([did])[0]
+        self.failUnlessEqual(sorted(doc['rd_schema_items']),
+                             ['rd.test.a', 'rd.test.b'])
+        self.failUnlessEqual(doc['field_a'], 'a')
+        self.failUnlessEqual(doc['field_b'], 'b')
+
+    def test_pinned_rev(self):
+        # an item for a specific _rev can't simply be applied again.
+        si = self._make_item('rd.test.a', {'field_a': 'a'})
+        si['_rev'] = '1-old'
+        did = self.doc_model.get_doc_id_for_schema_item(si)
+        conflicts = [{'id': did, 'error': 'conflict'}]
+        left = self._get_runner()._merge_conflicts(conflicts, {did: [si]})
+        self.failUnlessEqual(left, conflicts)
+
+    def test_not_conflict(self):
+        # any other error is raised as it was reported.
+        si = self._make_item('rd.test.a', {'field_a': 'a'})
+        did = self.doc_model.get_doc_id_for_schema_item(si)
+        errors = [{'id': did, 'error': 'forbidden', 'reason': 'no'}]
+        runner = self._get_runner()
+        try:
+            runner._merge_conflicts(errors, {did: [si]})
+        except DocumentSaveError, exc:
+            self.failUnlessEqual(exc.infos, errors)
+        else:
+            self.fail("the error was retried")
+
+    def test_not_conflict_when_merging(self):
+        si = self._make_item('rd.test.a', {'field_a': 'a'})
+        did = self.doc_model.get_doc_id_for_schema_item(si)
+        error = DocumentSaveError([{'id': did, 'error': 'forbidden'}])
+        calls = []
+        def failing_create(items):
+            calls.append(items)
+            raise error
+        self.doc_model.create_schema_items = failing_create
+        conflicts = [{'id': did, 'error': 'conflict'}]
+        try:
+            try:
+                self._get_runner()._merge_conflicts(conflicts, {did: [si]})
+            except DocumentSaveError, exc:
+                self.failUnless(exc is error)
+            else:
+                self.fail("the error was swallowed")
+        finally:
+            del self.doc_model.create_schema_items
+        self.failUnlessEqual(len(calls), 1)
+
+class TestProcessPool(TestPipelineBase):
+    # rd.ext.core.msg-rfc-to-email runs in the process pool.
+    extensions = TestPipelineBase.simple_extensions
+
+    def get_options(self):
+        ret = TestPipelineBase.get_options(self)
+        ret.process_pool_size = 2
+        return ret
+
+    def _make_ext(self, code):
+        doc = {'_rev': '1-test',
+               'code': code,
+               'source_schemas': ['rd.msg.test.raw'],
+               'execution': 'process',
+               }
+        return Extension('rd.test.procpool', doc)
+
+    def test_started(self):
+        # the pool is started by initialize, not by the first extension
+        # which needs it.
+        pool = procpool.get_pool()
+        self.failIfEqual(pool, None)
+        self.failUnlessEqual(pool.size, 2)
+
+    def test_process_ext(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        metrics.reset_metrics()
+        self.process_doc()
+        m = metrics.get_extension_metrics('rd.ext.core.msg-rfc-to-email')
+        self.failUnlessEqual(m.processed.value, 1)
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.email'])
+        self.failUnlessEqual(result['rows'][0]['value'], 1)
+
+    def test_proxied(self):
+        # open_schemas is one of the PROXIED_FUNCTIONS, so it is run in
+        # this process against our doc model.
+        self.failUnless('open_schemas' in procpool.PROXIED_FUNCTIONS)
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        self.process_doc()
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.rfc822'],
+                                          reduce=False, include_docs=True)
+        src_doc = result['rows'][0]['doc']
+        ext = self._make_ext("""
+def handler(doc):
+    emails = open_schemas([(doc['rd_key'], 'rd.msg.email')])
+    emit_schema('rd.test.procpool', {'email_id': emails[0]['_id']})
+""")
+        context = {'new_items': []}
+        procpool.get_pool().run(ext, self.doc_model, context, src_doc)
+        items = context['new_items']
+        self.failUnlessEqual(len(items), 1)
+        self.failUnlessEqual(items[0]['rd_schema_id'], 'rd.test.procpool')
+        self.failUnlessEqual(items[0]['rd_source'],
+                             [src_doc['_id'], src_doc['_rev']])
+        email = self.doc_model.open_schemas([(src_doc['rd_key'],
+                                              'rd.msg.email')])[0]
+        self.failUnlessEqual(items[0]['items']['email_id'], email['_id'])
+
+    def test_init_fails(self):
+        self.log_handler.ok_filters.append(
+            lambda record: record.getMessage().startswith(
+                            "Failed to initialize extension 'rd.test.procpool'"))
+        ext = self._make_ext("""
+import rd_no_such_module
+def handler(doc):
+    pass
+""")
+        src_doc = {'_id': 'test', '_rev': '1-test', 'rd_key': ['test', 'x'],
+                   'rd_schema_id': 'rd.msg.test.raw'}
+        pool = procpool.get_pool()
+        self.failUnlessRaises(ExtensionInitError, pool.run,
+                              ext, self.doc_model, {'new_items': []}, src_doc)
+        self.failIfEqual(ext.disabled, None)
+        # the worker is fine, and the extension isn't tried again.
+        self.failUnlessEqual(pool.idle.qsize(), 2)
+        self.failUnlessRaises(ExtensionInitError, pool.run,
+                              ext, self.doc_model, {'new_items': []}, src_doc)
+
+    def test_dead_worker(self):
+        f = lambda record: record.getMessage().startswith(
+                        "extension worker process for 'rd.test.procpool'")
+        self.log_handler.ok_filters.append(f)
+        ext = self._make_ext("""
+import os
+def handler(doc):
+    os._exit(1)
+""")
+        src_doc = {'_id': 'test', '_rev': '1-test', 'rd_key': ['test', 'x'],
+                   'rd_schema_id': 'rd.msg.test.raw'}
+        pool = procpool.get_pool()
+        self.failUnlessRaises(procpool.ExtensionWorkerError, pool.run,
+                              ext, self.doc_model, {'new_items': []}, src_doc)
+        self.failUnlessEqual(pool.num_dead, 1)
+        self.failUnlessEqual(pool.idle.qsize(), 1)
+        # the pipeline's main thread starts a new one.
+        procpool.replace_dead_workers()
+        self.failUnlessEqual(pool.num_dead, 0)
+        self.failUnlessEqual(pool.idle.qsize(), 2)
+        ext = self._make_ext("""
+def handler(doc):
+    emit_schema('rd.test.procpool', {'ok': True})
+""")
+        for i in range(2):
+            context = {'new_items': []}
+            pool.run(ext, self.doc_model, context, src_doc)
+            self.failUnlessEqual(len(context['new_items']), 1)
+
+class TestUpToDateCache(TestPipelineBase):
+    extensions = TestPipelineBase.simple_extensions
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        TestPipelineBase.setUp(self)
+
+    def tearDown(self):
+        TestPipelineBase.tearDown(self)
+        shutil.rmtree(self.temp_dir)
+
+    def get_options(self):
+        ret = TestPipelineBase.get_options(self)
+        ret.no_uptodate_cache = False
+        ret.uptodate_cache = os.path.join(self.temp_dir, 'uptodate')
+        return ret
+
+    def _replay(self, ext_id):
+        # Run the extension over every doc it would see again, as happens
+        # when a queue restarts from a checkpoint.
+        qr = self.pipeline.get_queue_runners([ext_id])[0]
+        schema_id = qr.processor.ext.source_schemas[0]
+        result = self.doc_model.open_view(key=['schema_id', schema_id],
+                                          reduce=False)
+        elts = [(row['id'], row['value']['_rev'], schema_id, None)
+                for row in result['rows']]
+        m = metrics.get_extension_metrics(ext_id)
+        couch_count = m.couch_time.count
+        qr.process_queue(iter(elts))
+        return m.couch_time.count - couch_count
+
+    def test_replay(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        for i in range(3):
+            self.makeAnotherTestMessage()
+        metrics.reset_metrics()
+        self.ensure_pipeline_complete()
+        ext_id = 'rd.ext.core.msg-email-to-body'
+        m = metrics.get_extension_metrics(ext_id)
+        self.failUnlessEqual(m.processed.value, 3)
+        # replaying is done without asking couch anything.
+        self.failUnlessEqual(self._replay(ext_id), 0)
+        self.failUnlessEqual(m.cached.value, 3)
+        self.failUnlessEqual(m.processed.value, 3)
+
+    def _rewind_queue(self, ext_id):
+        # As if we crashed before the queue's position was saved.
+        dm = self.doc_model
+        doc = dm.open_schemas([(['ext', ext_id], 'rd.core.workqueue-state')])[0]
+        doc['seq'] = 0
+        dm.update_documents([doc])
+
+    def test_second_run(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        for i in range(3):
+            self.makeAnotherTestMessage()
+        self.ensure_pipeline_complete()
+        ext_id = 'rd.ext.core.msg-email-to-body'
+        self._rewind_queue(ext_id)
+        metrics.reset_metrics()
+        self.ensure_pipeline_complete()
+        # the queue saw everything again, but didn't process any of it.
+        m = metrics.get_extension_metrics(ext_id)
+        self.failUnlessEqual(m.cached.value, 3)
+        self.failUnlessEqual(m.processed.value, 0)
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.body'])
+        self.failUnlessEqual(result['rows'][0]['value'], 3)
+
+    def test_unprocess_forgets(self):
+        test_proto.set_test_options(next_convert_fails=False,
+                                    emit_identities=False)
+        self.makeAnotherTestMessage()
+        self.ensure_pipeline_complete()
+        self.pipeline.unprocess()
+        # the items must be made again, so the cache can't be trusted.
+        metrics.reset_metrics()
+        self.ensure_pipeline_complete()
+        m = metrics.get_extension_metrics('rd.ext.core.msg-email-to-body')
+        self.failUnlessEqual(m.cached.value, 0)
+        self.failUnlessEqual(m.processed.value, 1)
+        result = self.doc_model.open_view(key=['schema_id', 'rd.msg.body'])
+        self.failUnlessEqual(result['rows'][0]['value'], 1)
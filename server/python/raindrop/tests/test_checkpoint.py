@@ -0,0 +1,80 @@
+# test of the checkpointing of work queue positions, using the in-memory
+# couch.
+from raindrop.tests import TestCase
+from raindrop.model import DocumentModel
+from raindrop.memcouch import MemoryCouchDB
+from raindrop.checkpoint import CheckpointService
+from raindrop.pipeline import QueueState
+
+class TestCheckpoints(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.db = MemoryCouchDB('raindrop_test_suite')
+        self.doc_model = DocumentModel(self.db)
+        # we flush when we want to.
+        self.service = CheckpointService(self.doc_model, 60)
+
+    def _add_queue(self, queue_id):
+        state = QueueState()
+        state.schema_item = {'rd_key': ['ext', queue_id],
+                             'rd_schema_id': 'rd.core.workqueue-state',
+                             'rd_ext_id': queue_id,
+                             'rd_source': None,
+                             'items': {'seq': 0},
+                             }
+        state.last_saved_items = state.schema_item['items'].copy()
+        self.service.add(state)
+        return state
+
+    def _get_saved(self, queue_id):
+        doc = self.doc_model.open_schemas([(['ext', queue_id],
+                                            'rd.core.workqueue-state')])[0]
+        if doc is None:
+            return None
+        return doc['seq'], doc.get('emitted_schemas')
+
+    def test_batched(self):
+        q1 = self._add_queue('q1')
+        q2 = self._add_queue('q2')
+        for seq in range(1, 10):
+            self.service.update(q1, seq)
+        self.service.update(q2, 4, set(['rd.test.b', 'rd.test.a']))
+        # nothing is written until the next checkpoint...
+        self.failUnlessEqual(self._get_saved('q1'), None)
+        self.service.flush()
+        # which writes every queue in one request.
+        self.failUnlessEqual(self.service.num_writes, 1)
+        self.failUnlessEqual(self._get_saved('q1'), (9, None))
+        self.failUnlessEqual(self._get_saved('q2'),
+                             (4, ['rd.test.a', 'rd.test.b']))
+        # nothing has changed, so nothing is written.
+        self.service.flush()
+        self.failUnlessEqual(self.service.num_writes, 1)
+        # only the queue which moved is written (without conflicting).
+        self.service.update(q1, 12)
+        self.service.flush()
+        self.failUnlessEqual(self.service.num_writes, 2)
+        self.failUnlessEqual(self._get_saved('q1'), (12, None))
+        self.failUnlessEqual(self._get_saved('q2'),
+                             (4, ['rd.test.a', 'rd.test.b']))
+
+    def test_stop(self):
+        q1 = self._add_queue('q1')
+        self.service.start()
+        self.service.update(q1, 3)
+        self.service.stop()
+        self.failUnlessEqual(self._get_saved('q1'), (3, None))
+
+    def test_interval(self):
+        self.service.interval = 0.01
+        q1 = self._add_queue('q1')
+        self.service.start()
+        try:
+            self.service.update(q1, 3)
+            for i in range(100):
+                if self.service.num_writes:
+                    break
+                self.service.stop_event.wait(0.05)
+            self.failUnlessEqual(self._get_saved('q1'), (3, None))
+        finally:
+            self.service.stop()
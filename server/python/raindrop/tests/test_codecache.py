@@ -0,0 +1,118 @@
+# test of the compiled code cache.
+import os
+import stat
+import marshal
+import shutil
+import tempfile
+
+from raindrop.tests import TestCase
+from raindrop import codecache
+
+class TestCodeCache(TestCase):
+    src = "def handler(doc):\n    return doc * 2\n"
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.old_cache_dir = codecache.cache_dir
+        self.temp_dir = tempfile.mkdtemp()
+        codecache.cache_dir = os.path.join(self.temp_dir, 'cache')
+
+    def tearDown(self):
+        codecache.cache_dir = self.old_cache_dir
+        shutil.rmtree(self.temp_dir)
+        TestCase.tearDown(self)
+
+    def _run(self, co):
+        globs = {}
+        exec co in globs
+        return globs['handler'](2)
+
+    def test_cached(self):
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
+        names = os.listdir(codecache.cache_dir)
+        self.failUnlessEqual(len(names), 1)
+        # the second time comes from the cache.
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(co.co_filename, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
+        self.failUnlessEqual(os.listdir(codecache.cache_dir), names)
+        # different source (or name) is a different entry.
+        co = codecache.compile_source(self.src.replace('2', '3'), "<test>")
+        self.failUnlessEqual(self._run(co), 6)
+        codecache.compile_source(self.src, "<test2>")
+        self.failUnlessEqual(len(os.listdir(codecache.cache_dir)), 3)
+
+    def test_corrupt(self):
+        self.log_handler.ok_filters.append(
+            lambda record: record.msg.startswith("ignoring corrupt"))
+        codecache.compile_source(self.src, "<test>")
+        name = os.path.join(codecache.cache_dir,
+                            os.listdir(codecache.cache_dir)[0])
+        f = open(name, 'wb')
+        f.write('\0garbage')
+        f.close()
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
+
+    def test_private(self):
+        codecache.compile_source(self.src, "<test>")
+        mode = os.stat(codecache.cache_dir).st_mode
+        self.failUnlessEqual(stat.S_IMODE(mode), 0700)
+        name = os.path.join(codecache.cache_dir,
+                            os.listdir(codecache.cache_dir)[0])
+        self.failIf(os.stat(name).st_mode & (stat.S_IRWXG | stat.S_IRWXO))
+
+    def _plant(self, src):
+        # Put the code for src where the cache keeps self.src.
+        codecache.compile_source(self.src, "<test>")
+        name = os.path.join(codecache.cache_dir,
+                            os.listdir(codecache.cache_dir)[0])
+        f = open(name, 'wb')
+        marshal.dump(compile(src, "<test>", "exec"), f)
+        f.close()
+        return name
+
+    def test_planted(self):
+        # the test for the tests below - a file we own is trusted.
+        self._plant(self.src.replace('2', '5'))
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 10)
+
+    def test_not_private_dir(self):
+        self.log_handler.ok_filters.append(
+            lambda record: record.msg.startswith("not using the code cache"))
+        self._plant(self.src.replace('2', '5'))
+        os.chmod(codecache.cache_dir, 0777)
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
+
+    def test_not_our_dir(self):
+        self.log_handler.ok_filters.append(
+            lambda record: record.msg.startswith("not using the code cache"))
+        self._plant(self.src.replace('2', '5'))
+        old_getuid = codecache._getuid
+        codecache._getuid = lambda: os.getuid() + 1
+        try:
+            co = codecache.compile_source(self.src, "<test>")
+        finally:
+            codecache._getuid = old_getuid
+        self.failUnlessEqual(self._run(co), 4)
+
+    def test_not_private_file(self):
+        self.log_handler.ok_filters.append(
+            lambda record: record.msg.startswith("ignoring code cache file"))
+        name = self._plant(self.src.replace('2', '5'))
+        os.chmod(name, 0666)
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
+        # and it has been replaced with our own.
+        self.failIf(os.stat(name).st_mode & stat.S_IWOTH)
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
+
+    def test_unwritable(self):
+        # a cache we can't write to just means we compile every time.
+        open(codecache.cache_dir, 'w').close()
+        co = codecache.compile_source(self.src, "<test>")
+        self.failUnlessEqual(self._run(co), 4)
@@ -0,0 +1,87 @@
+# test of the in-memory couch stand-in.
+from raindrop.tests import TestCase
+from raindrop.model import DocumentModel
+from raindrop.memcouch import MemoryCouchDB, MemoryChangesFeed
+
+class TestMemoryCouch(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.db = MemoryCouchDB('raindrop_test_suite')
+        self.doc_model = DocumentModel(self.db)
+
+    def _make_items(self, num):
+        sis = []
+        for i in range(num):
+            sis.append({'rd_key': ['test', 'test.%d' % i],
+                        'rd_schema_id': 'rd.test.whateva',
+                        'rd_ext_id': 'rd.testsuite',
+                        'items': {'field': i},
+                        })
+        return self.doc_model.create_schema_items(sis)
+
+    def test_conflicts(self):
+        info = self._make_items(1)[0]
+        doc = self.db.openDoc(info['id'])
+        self.failUnlessEqual(doc['_rev'], info['rev'])
+        # an update with the old (or no) revision must conflict.
+        for rev in (None, '1-bogus'):
+            bad = {'_id': info['id']}
+            if rev is not None:
+                bad['_rev'] = rev
+            result = self.db.updateDocuments([bad])[0]
+            self.failUnlessEqual(result['error'], 'conflict')
+        doc['field'] = 'new'
+        result = self.db.updateDocuments([doc])[0]
+        self.failUnless(result['rev'].startswith('2-'), result)
+        self.failUnlessEqual(self.db.openDoc(info['id'])['field'], 'new')
+
+    def test_attachments(self):
+        info = self._make_items(1)[0]
+        result = self.db.saveAttachment(info['id'], 'test', 'hello\0there',
+                                        'application/octet-stream',
+                                        info['rev'])
+        doc = self.db.openDoc(info['id'])
+        self.failUnlessEqual(doc['_rev'], result['rev'])
+        self.failUnless(doc['_attachments']['test']['stub'])
+        self.failUnlessEqual(self.db.openDoc(info['id'], attachment='test'),
+                             'hello\0there')
+        # an update which keeps the stub keeps the attachment.
+        doc['field'] = 'new'
+        self.db.updateDocuments([doc])
+        self.failUnlessEqual(self.db.openDoc(info['id'], attachment='test'),
+                             'hello\0there')
+
+    def test_megaview(self):
+        infos = self._make_items(3)
+        result = self.db.openView('raindrop!content!all', 'megaview',
+                                  key=['schema_id', 'rd.test.whateva'],
+                                  reduce=False, include_docs=True)
+        self.failUnlessEqual(sorted(r['id'] for r in result['rows']),
+                             sorted(i['id'] for i in infos))
+        result = self.db.openView('raindrop!content!all', 'megaview',
+                                  startkey=['key', ['test', 'test.1']],
+                                  endkey=['key', ['test', 'test.2']],
+                                  reduce=False)
+        self.failUnlessEqual([r['value']['rd_key'] for r in result['rows']],
+                             [['test', 'test.1'], ['test', 'test.2']])
+        result = self.db.openView('raindrop!content!all', 'megaview',
+                                  key=['ext_id', 'rd.testsuite'])
+        self.failUnlessEqual(result['rows'][0]['value'], 3)
+        # deleting a doc takes it out of the view.
+        doc = self.db.openDoc(infos[0]['id'])
+        self.db.updateDocuments([{'_id': doc['_id'], '_rev': doc['_rev'],
+                                  '_deleted': True}])
+        result = self.db.openView('raindrop!content!all', 'megaview',
+                                  key=['ext_id', 'rd.testsuite'])
+        self.failUnlessEqual(result['rows'][0]['value'], 2)
+
+    def test_changes(self):
+        infos = self._make_items(3)
+        feed = MemoryChangesFeed()
+        feed.initialize(self.doc_model, 1, filter_schemas=['rd.test.whateva'])
+        got = [feed._get_next_change(False) for i in range(3)]
+        self.failUnlessEqual([c and c['id'] for c in got],
+                             [infos[1]['id'], infos[2]['id'], None])
+        result = self.db.listChanges(since=2)
+        self.failUnlessEqual([c['seq'] for c in result['results']], [3])
+        self.failUnlessEqual(result['last_seq'], 3)
@@ -1,6 +1,9 @@
 # test of the back-end's document-model.
+from cStringIO import StringIO
+
 from raindrop.tests import TestCaseWithTestDB, FakeOptions
-from raindrop.model import get_doc_model
+from raindrop.model import get_doc_model, DocumentSaveError, encode_doc_id
+from raindrop import metrics
 
 class TestSchemas(TestCaseWithTestDB):
     def _make_test_schema_item(self, attach_data="hello\0there"):
@@ -186,6 +189,22 @@ class TestAttachments(TestCaseWithTestDB):
         data = '\0' * (self.doc_model.MAX_INLINE_ATTACH_SIZE+10)
         self.test_create_schema_items_small(data)
 
+    def test_create_schema_items_stream(self):
+        # a stream is always saved separately, however small.
+        data = 'foo\0bar' * 10
+        si = self._make_test_schema_item(StringIO(data))
+        ret = self.doc_model.create_schema_items([si])
+        self._check_rev_last(ret[0]['id'], ret[0]['rev'], data)
+        # and can be streamed back out.
+        stream = self.doc_model.db.openDoc(ret[0]['id'],
+                                           attachment='rd.testsuite/test',
+                                           stream=True)
+        try:
+            self.failUnlessEqual(stream.read(3), 'foo')
+            self.failUnlessEqual(stream.read(), data[3:])
+        finally:
+            stream.close()
+
     def test_update_docs_small(self, attach_data='foo\0bar'):
         si = self._make_test_schema_item(attach_data)
         ret = self.doc_model.create_schema_items([si])
@@ -203,3 +222,133 @@ class TestAttachments(TestCaseWithTestDB):
     def test_update_docs_large(self, attach_data='foo\0bar'):
         data = '\0' * (self.doc_model.MAX_INLINE_ATTACH_SIZE+10)
         self.test_update_docs_small(data)
+
+
+class TestDocumentCache(TestCaseWithTestDB):
+    def setUp(self):
+        TestCaseWithTestDB.setUp(self)
+        self.doc_model.set_extension_confidences({'rd.testsuite.1':1,
+                                                  'rd.testsuite.2':2})
+        self.doc_model.doc_cache.enable()
+
+    def tearDown(self):
+        self.doc_model.doc_cache.disable()
+        TestCaseWithTestDB.tearDown(self)
+
+    def _make_item(self, ext_id, value):
+        return {'rd_key' : ['test', 'test.1'],
+                'rd_schema_id': 'rd.test.cached',
+                'rd_ext_id' : ext_id,
+                'rd_source': None,
+                'items': {'field': value},
+                }
+
+    def test_write_twice(self):
+        # the second write should use the doc we cached from the first.
+        dm = self.doc_model
+        info = dm.create_schema_items([self._make_item('rd.testsuite.1', 1)])[0]
+        hits = dm.doc_cache.hits
+        info = dm.create_schema_items([self._make_item('rd.testsuite.2', 2)])[0]
+        self.failUnlessEqual(dm.doc_cache.hits, hits+1)
+        doc = dm.open_documents_by_id([info['id']])[0]
+        self.failUnlessEqual(doc['_rev'], info['rev'])
+        self.failUnlessEqual(sorted(doc['rd_schema_items'].keys()),
+                             ['rd.testsuite.1', 'rd.testsuite.2'])
+
+    def test_stale_cache_conflicts(self):
+        # Someone else updates the doc without the cache knowing - we
+        # should see a conflict, then succeed once it is invalidated.
+        dm = self.doc_model
+        info = dm.create_schema_items([self._make_item('rd.testsuite.1', 1)])[0]
+        doc = dm.open_documents_by_id([info['id']])[0]
+        dm.db.updateDocuments([doc])
+        si = self._make_item('rd.testsuite.2', 2)
+        self.failUnlessRaises(DocumentSaveError, dm.create_schema_items, [si])
+        info = dm.create_schema_items([si])[0]
+        doc = dm.open_documents_by_id([info['id']])[0]
+        self.failUnlessEqual(doc['_rev'], info['rev'])
+
+
+class TestDocIds(TestCaseWithTestDB):
+    def _make_item(self, key_val, schema_id='rd.test.ids'):
+        return {'rd_key' : ['test', key_val],
+                'rd_schema_id': schema_id,
+                'rd_ext_id' : 'rd.testsuite.1',
+                'rd_source': None,
+                'items': {'field': 1},
+                }
+
+    def test_memoized(self):
+        dm = self.doc_model
+        si = self._make_item(['test', 'test.1'])
+        doc_id = dm.get_doc_id_for_schema_item(si)
+        self.failUnlessEqual(doc_id, encode_doc_id(si['rd_key'], 'rd.test.ids'))
+        # the item itself isn't changed.
+        self.failUnlessEqual(si, self._make_item(['test', 'test.1']))
+        # a new item with the same key shares the ID.
+        si2 = self._make_item(['test', 'test.1'])
+        self.failUnless(dm.get_doc_id_for_schema_item(si2) is doc_id)
+        # but not with a different schema.
+        si3 = self._make_item(['test', 'test.1'], 'rd.test.other')
+        self.failIfEqual(dm.get_doc_id_for_schema_item(si3), doc_id)
+
+    def test_non_strings(self):
+        # 1, 1.0 and True compare (and hash) equal but encode differently.
+        dm = self.doc_model
+        for val in (1, 1.0, True, [1], [True]):
+            si = self._make_item(val)
+            self.failUnlessEqual(dm.get_doc_id_for_schema_item(si),
+                                 encode_doc_id(si['rd_key'], 'rd.test.ids'))
+
+    def test_written(self):
+        dm = self.doc_model
+        si = self._make_item('test.1')
+        info = dm.create_schema_items([si])[0]
+        self.failUnlessEqual(info['id'], dm.get_doc_id_for_schema_item(si))
+        self.failIf('rd_doc_id' in si)
+
+
+class TestViewRefresher(TestCaseWithTestDB):
+    def _make_item(self):
+        return {'rd_key' : ['test', 'test.1'],
+                'rd_schema_id': 'rd.test.refresh',
+                'rd_ext_id' : 'rd.testsuite',
+                'rd_source': None,
+                'items': {'field': 'value'},
+                }
+
+    def test_refresh_metrics(self):
+        metrics.reset_metrics()
+        refresher = self.doc_model.view_refresher
+        self.failUnless(refresher.refresh() > 0)
+        vm = metrics.get_view_metrics('raindrop!content!all')
+        self.failUnlessEqual(vm.get_refresh_time('megaview').count, 1)
+        self.failUnless('view="megaview"' in metrics.format_text())
+
+    def test_refresh_threshold(self):
+        refresher = self.doc_model.view_refresher
+        refresher.refresh()
+        # nothing has changed, so nothing to do.
+        self.failUnlessEqual(refresher.refresh(0), 0)
+        self.doc_model.create_schema_items([self._make_item()])
+        # a single change is within the threshold...
+        self.failUnlessEqual(refresher.refresh(1000), 0)
+        # but means they aren't completely up-to-date.
+        self.failUnless(refresher.refresh(0) > 0)
+
+    def test_shared(self):
+        # our pipeline started it; another pipeline using the same doc
+        # model stopping doesn't stop it for us.
+        refresher = self.doc_model.view_refresher
+        thread = refresher.thread
+        self.failUnless(thread.isAlive())
+        refresher.start()
+        self.failUnless(refresher.thread is thread)
+        refresher.stop()
+        self.failUnless(refresher.thread is thread)
+        self.failUnless(thread.isAlive())
+        # but it is stopped once nothing is using it.
+        self.pipeline.finalize()
+        self.pipeline = None
+        self.failUnlessEqual(refresher.thread, None)
+        self.failIf(thread.isAlive())
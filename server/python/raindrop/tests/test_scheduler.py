@@ -0,0 +1,92 @@
+# test of the scheduling of work queues by their dependencies.
+from raindrop.tests import TestCase
+from raindrop import scheduler
+
+class TestGraph(TestCase):
+    def test_build(self):
+        sources = {'a': ['rd.msg.raw'],
+                   'b': ['rd.msg.email'],
+                   'c': ['rd.msg.body', 'rd.msg.email'],
+                   'f': None, # a filter function.
+                   }
+        emitted = {'a': set(['rd.msg.email']),
+                   'b': set(['rd.msg.body', 'rd.msg.email']),
+                   'c': set(['rd.msg.summary']),
+                   'f': set(),
+                   }
+        upstream = scheduler.build_graph(sources, emitted)
+        self.failUnlessEqual(upstream, {'a': set(),
+                                        # not itself, even though it writes
+                                        # what it consumes.
+                                        'b': set(['a']),
+                                        'c': set(['a', 'b']),
+                                        'f': set(['a', 'b', 'c']),
+                                        })
+
+    def test_levels(self):
+        upstream = {'a': set(),
+                    'b': set(['a']),
+                    'c': set(['b']),
+                    'd': set(['a']),
+                    'e': set(['b', 'd']),
+                    }
+        self.failUnlessEqual(scheduler.topological_levels(upstream),
+                             {'a': 0, 'b': 1, 'd': 1, 'c': 2, 'e': 2})
+
+    def test_levels_cycle(self):
+        # b and c depend on each other; the cycle is broken at b, which has
+        # the fewest upstreams left once a is done.
+        upstream = {'a': set(),
+                    'b': set(['a', 'c']),
+                    'c': set(['a', 'b', 'd']),
+                    'd': set(['a']),
+                    }
+        self.failUnlessEqual(scheduler.topological_levels(upstream),
+                             {'a': 0, 'd': 1, 'b': 2, 'c': 3})
+
+    def test_levels_unknown(self):
+        # upstreams which aren't queues are ignored.
+        upstream = {'a': set(['gone']), 'b': set(['a'])}
+        self.failUnlessEqual(scheduler.topological_levels(upstream),
+                             {'a': 0, 'b': 1})
+
+
+class TestQueueScheduler(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.busy = set()
+
+    def _make(self, upstream):
+        return scheduler.QueueScheduler(upstream,
+                                        lambda qid: qid not in self.busy)
+
+    def test_waits_for_upstream(self):
+        sched = self._make({'a': set(), 'b': set(['a']), 'c': set(['b'])})
+        self.busy.update(['a', 'b'])
+        self.failUnless(sched.can_run('a'))
+        self.failIf(sched.can_run('b'))
+        self.failIf(sched.can_run('c'))
+        self.busy.discard('a')
+        self.failUnless(sched.can_run('b'))
+        self.failIf(sched.can_run('c'))
+        self.busy.discard('b')
+        self.failUnless(sched.can_run('c'))
+
+    def test_cycle(self):
+        # queues in a cycle only wait for the one in the earlier level, so
+        # they can't wait for each other forever.
+        sched = self._make({'a': set(), 'b': set(['a', 'c']),
+                            'c': set(['b'])})
+        self.busy.update(['b', 'c'])
+        self.failUnless(sched.can_run('b'))
+        self.failIf(sched.can_run('c'))
+
+    def test_max_wait(self):
+        sched = self._make({'a': set(), 'b': set(['a'])})
+        self.busy.add('a')
+        self.failIf(sched.can_run('b'))
+        # once it has waited long enough it goes anyway...
+        sched.held_since['b'] -= sched.MAX_UPSTREAM_WAIT
+        self.failUnless(sched.can_run('b'))
+        # and the wait starts again.
+        self.failIf(sched.can_run('b'))
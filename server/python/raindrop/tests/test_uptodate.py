@@ -0,0 +1,56 @@
+# test of the cache of documents extensions have processed.
+import os
+import shutil
+import tempfile
+
+from raindrop.tests import TestCase
+from raindrop import uptodate
+
+class TestUpToDateCache(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'cache', 'uptodate')
+        self.cache = uptodate.open_cache(self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+        TestCase.tearDown(self)
+
+    def test_simple(self):
+        cache = self.cache
+        self.failIf(cache.is_up_to_date('ext', 'fp', 'doc1', '1-a'))
+        cache.add('ext', 'fp', [('doc1', '1-a'), ('doc2', '1-b')])
+        self.failUnless(cache.is_up_to_date('ext', 'fp', 'doc1', '1-a'))
+        self.failUnless(cache.is_up_to_date('ext', 'fp', 'doc2', '1-b'))
+        # a different revision, extension or version of it isn't.
+        self.failIf(cache.is_up_to_date('ext', 'fp', 'doc1', '2-a'))
+        self.failIf(cache.is_up_to_date('ext2', 'fp', 'doc1', '1-a'))
+        self.failIf(cache.is_up_to_date('ext', 'fp2', 'doc1', '1-a'))
+        # a new revision replaces the old.
+        cache.add('ext', 'fp', [('doc1', '2-a')])
+        self.failIf(cache.is_up_to_date('ext', 'fp', 'doc1', '1-a'))
+        self.failUnless(cache.is_up_to_date('ext', 'fp', 'doc1', '2-a'))
+
+    def test_persistent(self):
+        self.cache.add('ext', 'fp', [('doc1', '1-a')])
+        self.cache.close()
+        self.cache = uptodate.open_cache(self.filename)
+        self.failUnless(self.cache.is_up_to_date('ext', 'fp', 'doc1', '1-a'))
+
+    def test_forget(self):
+        cache = self.cache
+        cache.add('ext', 'fp', [('doc1', '1-a')])
+        cache.add('ext2', 'fp', [('doc1', '1-a')])
+        cache.forget('ext')
+        self.failIf(cache.is_up_to_date('ext', 'fp', 'doc1', '1-a'))
+        self.failUnless(cache.is_up_to_date('ext2', 'fp', 'doc1', '1-a'))
+        cache.forget()
+        self.failIf(cache.is_up_to_date('ext2', 'fp', 'doc1', '1-a'))
+
+    def test_unopenable(self):
+        self.log_handler.ok_filters.append(
+            lambda record: record.msg.startswith("can't open"))
+        # a directory where the file should be.
+        self.failUnlessEqual(uptodate.open_cache(self.temp_dir), None)
@@ -0,0 +1,111 @@
+# test of the shared schema item writer, using the in-memory couch.
+from raindrop.tests import TestCase
+from raindrop.model import DocumentModel, DocumentSaveError
+from raindrop.memcouch import MemoryCouchDB
+from raindrop.writer import SchemaItemWriter
+
+class TestWriter(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.db = MemoryCouchDB('raindrop_test_suite')
+        self.doc_model = DocumentModel(self.db)
+        self.doc_model.set_extension_confidences({'rd.test.a': 1,
+                                                  'rd.test.b': 2})
+        self.writer = SchemaItemWriter(self.doc_model)
+        # nothing is written until we say.
+        self.writer.MAX_LATENCY = 60
+
+    def tearDown(self):
+        self.writer.stop()
+        TestCase.tearDown(self)
+
+    def _make_item(self, ext_id, key_val, items):
+        return {'rd_key': ['test', key_val],
+                'rd_schema_id': 'rd.test.write',
+                'rd_ext_id': ext_id,
+                'rd_source': None,
+                'items': items,
+                }
+
+    def _open(self, key_val):
+        return self.doc_model.open_schemas([(['test', key_val],
+                                             'rd.test.write')])[0]
+
+    def test_coalesced(self):
+        # two queues writing to the same doc, and another to its own.
+        f1 = self.writer.submit([self._make_item('rd.test.a', 'one',
+                                                 {'a': 1})])
+        f2 = self.writer.submit([self._make_item('rd.test.b', 'one',
+                                                 {'b': 2}),
+                                 self._make_item('rd.test.b', 'two',
+                                                 {'b': 3})])
+        self.writer.start()
+        self.failIf(f1.done() or f2.done())
+        f3 = self.writer.submit([self._make_item('rd.test.a', 'three',
+                                                 {'a': 4})], urgent=True)
+        for f in (f1, f2, f3):
+            f.result()
+        # a single request, and no conflicts.
+        self.failUnlessEqual(self.writer.num_writes, 1)
+        self.failUnlessEqual(self.writer.num_items, 4)
+        doc = self._open('one')
+        self.failUnlessEqual((doc['a'], doc['b']), (1, 2))
+        self.failUnlessEqual(self._open('two')['b'], 3)
+        self.failUnlessEqual(self._open('three')['a'], 4)
+
+    def test_latency(self):
+        self.writer.MAX_LATENCY = 0.01
+        self.writer.start()
+        f = self.writer.submit([self._make_item('rd.test.a', 'one', {'a': 1})])
+        f.result()
+        self.failUnlessEqual(self._open('one')['a'], 1)
+
+    def test_max_items(self):
+        self.writer.MAX_ITEMS = 2
+        self.writer.start()
+        f = self.writer.submit([self._make_item('rd.test.a', 'one', {'a': 1}),
+                                self._make_item('rd.test.a', 'two', {'a': 2})])
+        f.result()
+        self.failUnlessEqual(self.writer.num_writes, 1)
+
+    def test_stop_flushes(self):
+        self.writer.start()
+        f = self.writer.submit([self._make_item('rd.test.a', 'one', {'a': 1})])
+        self.writer.stop()
+        self.failUnless(f.done())
+        f.result()
+        self.failUnlessEqual(self._open('one')['a'], 1)
+
+    def test_errors(self):
+        # each submission only sees the errors for the docs it wrote to.
+        si_ok = self._make_item('rd.test.a', 'ok', {'a': 1})
+        si_bad = self._make_item('rd.test.a', 'bad', {'a': 2})
+        bad_id = self.doc_model.get_doc_id_for_schema_item(si_bad)
+        error = {'id': bad_id, 'error': 'conflict'}
+        def create_schema_items(items):
+            raise DocumentSaveError([error])
+        self.doc_model.create_schema_items = create_schema_items
+        f_ok = self.writer.submit([si_ok])
+        f_bad = self.writer.submit([si_bad], urgent=True)
+        self.writer.start()
+        f_ok.result()
+        try:
+            f_bad.result()
+        except DocumentSaveError, exc:
+            self.failUnlessEqual(exc.infos, [error])
+        else:
+            self.fail("no error")
+
+    def test_failure(self):
+        # anything else fails everything in the write.
+        self.log_handler.ok_filters.append(
+            lambda record: record.getMessage().startswith("failed to write"))
+        def create_schema_items(items):
+            raise RuntimeError("couch is down")
+        self.doc_model.create_schema_items = create_schema_items
+        f1 = self.writer.submit([self._make_item('rd.test.a', 'one', {})])
+        f2 = self.writer.submit([self._make_item('rd.test.a', 'two', {})],
+                                urgent=True)
+        self.writer.start()
+        self.failUnlessRaises(RuntimeError, f1.result)
+        self.failUnlessRaises(RuntimeError, f2.result)
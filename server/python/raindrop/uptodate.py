@@ -0,0 +1,126 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+
+"""A persistent record of the documents each extension has processed.
+
+Before an extension is run against a document, the pipeline checks the
+items the extension wrote last time were made from the same revision of
+the document, which means a request to couch per document.  After a
+restart the queues re-read the changes made since their last checkpoint,
+so most of the documents they see are already up-to-date - the cache
+records (ext_id, src_id) -> (src_rev, fingerprint) for every document an
+extension has successfully processed, so those are skipped without asking
+couch at all.
+
+The cache lives in an SQLite database beside the config file.  It is only
+an optimization - if it can't be opened we simply ask couch as normal.
+"""
+from __future__ import with_statement
+
+import os
+import threading
+import sqlite3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UpToDateCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        # the queues all share a single connection.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        # The cache can always be rebuilt, so losing the last few entries
+        # in a crash is better than waiting for the disk on every write.
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS uptodate ("
+                          "ext_id TEXT NOT NULL, "
+                          "src_id TEXT NOT NULL, "
+                          "src_rev TEXT NOT NULL, "
+                          "fingerprint TEXT, "
+                          "PRIMARY KEY (ext_id, src_id))")
+        self.conn.commit()
+
+    def is_up_to_date(self, ext_id, fingerprint, src_id, src_rev):
+        """Has the extension with the given fingerprint processed this
+        revision of the document?
+        """
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT src_rev, fingerprint "
+                                        "FROM uptodate "
+                                        "WHERE ext_id=? AND src_id=?",
+                                        (ext_id, src_id)).fetchone()
+        except sqlite3.Error, exc:
+            logger.debug("failed to read the up-to-date cache: %s", exc)
+            return False
+        return row is not None and row[0] == src_rev and \
+               row[1] == fingerprint
+
+    def add(self, ext_id, fingerprint, docs):
+        """Note the extension has processed the (src_id, src_rev) docs."""
+        if not docs:
+            return
+        try:
+            with self.lock:
+                self.conn.executemany("INSERT OR REPLACE INTO uptodate "
+                                      "VALUES (?, ?, ?, ?)",
+                                      [(ext_id, src_id, src_rev, fingerprint)
+                                       for src_id, src_rev in docs])
+                self.conn.commit()
+        except sqlite3.Error, exc:
+            # the docs will just be checked against couch next time.
+            logger.debug("failed to write the up-to-date cache: %s", exc)
+
+    def forget(self, ext_id=None):
+        """Forget everything the extension (or every extension, if ext_id is
+        None) has processed - eg, after its items have been deleted.
+        """
+        with self.lock:
+            if ext_id is None:
+                self.conn.execute("DELETE FROM uptodate")
+            else:
+                self.conn.execute("DELETE FROM uptodate WHERE ext_id=?",
+                                  (ext_id,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_cache(filename):
+    """Open the cache in the given file, or return None if we can't."""
+    try:
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        ret = UpToDateCache(filename)
+    except (OSError, sqlite3.Error), exc:
+        logger.warn("can't open the up-to-date cache %r: %s", filename, exc)
+        return None
+    logger.debug("opened the up-to-date cache %r", filename)
+    return ret
@@ -0,0 +1,226 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""Keeps the couch views reasonably up-to-date.
+
+Couch only updates a view's index when it is queried, so after a large
+import the first person to look at the UI would otherwise wait while every
+view catches up.  The ViewRefresher updates them from a background thread -
+when the pipeline goes idle, or when the views have fallen more than a
+threshold number of changes behind the database.  Each design doc has a
+single index shared by all its views, so design docs are refreshed in
+parallel by a few worker threads.
+"""
+from __future__ import with_statement
+
+import threading
+import time
+from Queue import Queue, Empty
+
+from raindrop import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ViewRefresher(object):
+    # How often, in seconds, the thread checks how far behind the views are.
+    CHECK_INTERVAL = 30
+    # How long stop() waits for a refresh in progress to finish.
+    STOP_TIMEOUT = 10
+
+    def __init__(self, doc_model, num_workers=2, max_lag=1000):
+        self.doc_model = doc_model
+        self.num_workers = num_workers
+        self.max_lag = max_lag
+        # only one refresh runs at a time.
+        self.refresh_lock = threading.Lock()
+        self.design_docs = None # [(design doc name, [view name, ...]), ...]
+        # no index can be older than this, so we needn't ask couch about
+        # them until the db has moved max_lag changes beyond it.
+        self.indexed_seq = None
+        self.wake_event = threading.Event()
+        self.idle = False
+        self.stopping = False
+        self.thread = None
+        # Every pipeline using the doc model shares us, so the thread runs
+        # until the last of them calls stop().
+        self.lifecycle_lock = threading.Lock()
+        self.num_users = 0
+
+    def start(self):
+        with self.lifecycle_lock:
+            self.num_users += 1
+            if self.thread is None:
+                self._start_thread()
+
+    def stop(self):
+        with self.lifecycle_lock:
+            if self.num_users == 0:
+                return
+            self.num_users -= 1
+            if self.num_users == 0:
+                self._stop_thread()
+
+    def _start_thread(self):
+        self.stopping = False
+        # stop() may have left these set.
+        self.wake_event.clear()
+        self.idle = False
+        self.thread = threading.Thread(target=self._refresh_thread)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _stop_thread(self):
+        self.stopping = True
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(self.STOP_TIMEOUT)
+            if self.thread.isAlive():
+                logger.info("abandoning the view refresh in progress")
+            self.thread = None
+
+    def notify_idle(self):
+        """Called when the pipeline has nothing to do, so the views can be
+        brought completely up-to-date.
+        """
+        if self.thread is None:
+            # nothing running to do it; couch will do it on demand.
+            return
+        self.idle = True
+        self.wake_event.set()
+
+    def forget_views(self):
+        """Called when the design documents have changed."""
+        self.design_docs = None
+        self.indexed_seq = None
+
+    def _refresh_thread(self):
+        while not self.stopping:
+            self.wake_event.wait(self.CHECK_INTERVAL)
+            self.wake_event.clear()
+            if self.stopping:
+                break
+            if self.idle:
+                self.idle = False
+                min_lag = 0
+            else:
+                min_lag = self.max_lag
+            try:
+                self.refresh(min_lag)
+            except Exception:
+                logger.exception("failed to refresh the views")
+
+    def _load_design_docs(self):
+        # these keys come from jquery.couch.js
+        result = self.doc_model.db.listDoc(startkey="_design",
+                                           endkey="_design0",
+                                           include_docs=True)
+        ddocs = []
+        for row in result['rows']:
+            if 'error' in row or 'deleted' in row['value']:
+                continue
+            doc_id = row['id'][len('_design/'):]
+            views = row['doc'].get('views')
+            if views:
+                ddocs.append((doc_id, sorted(views)))
+        return ddocs
+
+    def _get_lag(self, did, db_seq):
+        # Returns None if couch won't tell us about the index.
+        db = self.doc_model.db
+        try:
+            info = db.infoDesignDoc(did)
+            return db_seq - info['view_index']['update_seq']
+        except (db.NotFoundError, KeyError):
+            return None
+
+    def refresh(self, min_lag=None):
+        """Refresh the views in each design doc whose index is more than
+        min_lag changes behind the database, or all of them if min_lag is
+        None.  Returns the number of design docs refreshed.
+        """
+        with self.refresh_lock:
+            # forget_views() may reset design_docs at any time.
+            design_docs = self.design_docs
+            if design_docs is None:
+                design_docs = self.design_docs = self._load_design_docs()
+            db_seq = self.doc_model.db.infoDB()['update_seq']
+            if min_lag is not None and self.indexed_seq is not None and \
+               db_seq - self.indexed_seq <= min_lag:
+                return 0
+            todo = []
+            for did, vns in design_docs:
+                if min_lag is not None:
+                    lag = self._get_lag(did, db_seq)
+                    if lag is not None:
+                        metrics.get_view_metrics(did).lag.set(lag)
+                        if lag <= min_lag:
+                            continue
+                todo.append((did, vns))
+            if todo:
+                self._refresh_design_docs(todo)
+            if not self.stopping:
+                self.indexed_seq = db_seq - (min_lag or 0)
+            return len(todo)
+
+    def _refresh_design_docs(self, todo):
+        logger.info("refreshing the views in %d design docs", len(todo))
+        st = time.time()
+        q = Queue()
+        for item in todo:
+            q.put(item)
+        workers = []
+        for i in range(min(self.num_workers, len(todo))):
+            t = threading.Thread(target=self._refresh_worker, args=(q,))
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+        logger.info("refreshed views in %d design docs in %.2f secs",
+                    len(todo), time.time() - st)
+
+    def _refresh_worker(self, q):
+        dm = self.doc_model
+        while not self.stopping:
+            try:
+                did, vns = q.get(False)
+            except Empty:
+                break
+            vm = metrics.get_view_metrics(did)
+            for vn in vns:
+                tst = time.time()
+                try:
+                    # limit=0 updates without giving us rows.  The first
+                    # view in a design doc updates the shared index, so
+                    # is the one which takes the time.
+                    dm.open_view(did, vn, limit=0)
+                except Exception:
+                    logger.exception("failed to refresh view %s/%s", did, vn)
+                    continue
+                took = time.time() - tst
+                vm.get_refresh_time(vn).observe(took)
+                logger.debug("view %s/%s refreshed in %.2f secs", did, vn,
+                             took)
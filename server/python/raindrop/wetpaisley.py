@@ -55,6 +55,46 @@ class CouchError(Exception):
 class CouchNotFoundError(CouchError):
     pass
 
+# The size of the chunks attachments are streamed in.
+ATTACHMENT_CHUNK_SIZE = 65536
+
+class AttachmentReader(object):
+    """A file-like object reading an attachment straight off the wire.
+
+    Returned by openDoc(..., stream=True); the connection goes back to the
+    pool when the reader is closed, but only if the attachment was read to
+    the end - otherwise it is dropped rather than reading what's left.
+    """
+    def __init__(self, db, conn, response):
+        self.db = db
+        self.conn = conn
+        self.response = response
+        self.content_type = response.getheader('content-type')
+
+    def read(self, size=-1):
+        if self.response is None:
+            raise ValueError("I/O operation on closed attachment")
+        if size < 0:
+            return self.response.read()
+        return self.response.read(size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(ATTACHMENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if self.response is None:
+            return
+        if self.response.isclosed() and not self.response.will_close and \
+           len(self.db.connections_available) <= 10:
+            self.db.connections_available.append(self.conn)
+        else:
+            self.conn.close()
+        self.conn = self.response = None
+
 class CouchDB():
     _has_adbs = None # does this couch support the old _all_docs_by_seq api?
     Error = CouchError
@@ -81,26 +121,57 @@ class CouchDB():
     def _request(self, method, uri, body = None, headers = None):
         return json.loads(self._rawrequest(method, uri, body, headers))
 
-    def _rawrequest(self, method, uri, body = None, headers = None):
+    def _send_chunked(self, conn, method, uri, body, headers):
+        # httplib wants to know the length of the body up-front, so send
+        # file-like bodies using chunked transfer-encoding.
+        conn.putrequest(method, uri)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        while True:
+            chunk = body.read(ATTACHMENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+        conn.send('0\r\n\r\n')
+
+    def _rawrequest(self, method, uri, body = None, headers = None,
+                    stream = False):
         if headers is None:
             headers = {}
         if 'Accept' not in headers:
             headers['Accept'] = 'application/json'
+        # A file-like body can only be sent once, so it always gets a new
+        # connection rather than one couch may have since dropped.
+        send_chunked = hasattr(body, 'read')
 
         new_con_retries = 3
         while True: # retry on exceptions using pooled connections
-            try:
-                conn = self.connections_available.popleft()
-                reused = True
-            except IndexError:
+            conn = None
+            if not send_chunked:
+                try:
+                    conn = self.connections_available.popleft()
+                    reused = True
+                except IndexError:
+                    pass
+            if conn is None:
                 conn = httplib.HTTPConnection(self.host, self.port)
                 reused = False
             response = None
             try:
                 try:
-                    conn.request(method, uri, body, headers)
+                    if send_chunked:
+                        self._send_chunked(conn, method, uri, body, headers)
+                    else:
+                        conn.request(method, uri, body, headers)
                     response = conn.getresponse()
                     self._check_error(response)
+                    if stream:
+                        # the reader owns the connection now.
+                        reader = AttachmentReader(self, conn, response)
+                        conn = response = None
+                        return reader
                     return response.read()
                 except (httplib.BadStatusLine, socket.error), exc:
                     # couch may discard old connections resulting in these
@@ -112,6 +183,9 @@ class CouchDB():
                     conn.close()
                     conn = response = None
                     if not reused:
+                        if send_chunked:
+                            # some of the body may have been consumed.
+                            raise
                         if new_con_retries <= 0:
                             logger.warn("ran out of retries on brand-new connection: %s", exc)
                             raise
@@ -181,10 +255,12 @@ class CouchDB():
             return {}
 
     def openDoc(self, docId, revision=None, full=False, attachment="",
-                attachments=False):
+                attachments=False, stream=False):
+        # If stream is True, an attachment is returned as a file-like
+        # object which must be closed, rather than as a string.
         if attachment:
             uri = "/%s/%s/%s" % (self.dbName, docId, quote(attachment))
-            return self._rawrequest('GET', uri)
+            return self._rawrequest('GET', uri, stream=stream)
 
         uri = "/%s/%s" % (self.dbName, docId)
         try:
@@ -212,8 +288,9 @@ class CouchDB():
         #param name: name of the attachment
         @type name: C{str}
 
-        @param body: content of the attachment.
-        @type body: C{sequence}
+        @param body: content of the attachment - a string, or a file-like
+                     object which is streamed to couch in chunks.
+        @type body: C{sequence} or C{file}
 
         @param content_type: content type of the attachment
         @type body: C{str}
@@ -254,6 +331,14 @@ class CouchDB():
         headers = {"Accept": "application/json"}
         return self._request('GET', uri, None, headers)
 
+    def infoDesignDoc(self, docId):
+        """Information about a design doc, including how up-to-date the
+        index its views share is in ['view_index']['update_seq'].
+        """
+        uri = '/%s/_design/%s/_info' % (self.dbName, docId)
+        headers = {"Accept": "application/json"}
+        return self._request('GET', uri, None, headers)
+
     def createDB(self):
         self._request('PUT', '/%s/' % self.dbName)
 
@@ -0,0 +1,176 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+"""A shared writer for schema items.
+
+Rather than each queue thread writing its own small batches (and
+conflicting with the other queues writing to the same documents), the
+queues submit their schema items to a single writer thread.  Items which
+arrive while a write is in progress are coalesced into the next write, so
+the busier we are the bigger the batches become; items targeting the same
+document from different queues are merged in memory by
+DocumentModel.create_schema_items rather than conflicting in couch.
+"""
+from __future__ import with_statement
+
+import sys
+import time
+import threading
+
+from raindrop.model import DocumentSaveError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteFuture(object):
+    """The result of a submission to a SchemaItemWriter."""
+    def __init__(self, items):
+        self.items = items
+        self.doc_ids = None # set by the writer.
+        self.event = threading.Event()
+        self.errors = None
+        self.exc_info = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self):
+        """Wait for the items to be written.  Raises DocumentSaveError with
+        the errors for this submission's documents if any failed."""
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        if self.errors:
+            raise DocumentSaveError(self.errors)
+
+
+class SchemaItemWriter(object):
+    # Flush once this many items are pending...
+    MAX_ITEMS = 500
+    # ...or the oldest has been waiting this long (in seconds).
+    MAX_LATENCY = 0.1
+
+    def __init__(self, doc_model):
+        self.doc_model = doc_model
+        self.cond = threading.Condition()
+        self.pending = [] # list of WriteFuture objects.
+        self.num_pending_items = 0
+        self.first_pending_time = None
+        self.urgent = False
+        self.stopping = False
+        self.thread = None
+        self.num_writes = self.num_items = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._writer_thread)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the writer once everything pending has been written."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notifyAll()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        logger.debug("writer wrote %d items in %d requests", self.num_items,
+                     self.num_writes)
+
+    def submit(self, items, urgent=False):
+        """Queue schema items to be written, returning a WriteFuture.  If
+        urgent is True the write happens as soon as possible (eg, because the
+        caller is about to query for what it wrote.)
+        """
+        dm = self.doc_model
+        future = WriteFuture(items)
+        future.doc_ids = set(dm.get_doc_id_for_schema_item(si) for si in items)
+        with self.cond:
+            assert not self.stopping, "writer is stopped"
+            if not self.pending:
+                self.first_pending_time = time.time()
+            self.pending.append(future)
+            self.num_pending_items += len(items)
+            if urgent:
+                self.urgent = True
+            self.cond.notifyAll()
+        return future
+
+    def _take_pending(self):
+        # Wait until it is time to write, then return what we are to write.
+        with self.cond:
+            while True:
+                if self.pending:
+                    if self.urgent or self.stopping or \
+                       self.num_pending_items >= self.MAX_ITEMS:
+                        break
+                    wait = self.first_pending_time + self.MAX_LATENCY - time.time()
+                    if wait <= 0:
+                        break
+                elif self.stopping:
+                    return None
+                else:
+                    wait = None
+                self.cond.wait(wait)
+            ret = self.pending
+            self.pending = []
+            self.num_pending_items = 0
+            self.urgent = False
+            return ret
+
+    def _writer_thread(self):
+        while True:
+            futures = self._take_pending()
+            if futures is None:
+                break
+            self._write(futures)
+
+    def _write(self, futures):
+        items = []
+        for future in futures:
+            items.extend(future.items)
+        logger.debug("writing %d items from %d submissions", len(items),
+                     len(futures))
+        try:
+            self.doc_model.create_schema_items(items)
+        except DocumentSaveError, exc:
+            # give each submission the errors for the docs it wrote to.
+            by_id = {}
+            for info in exc.infos:
+                by_id.setdefault(info.get('id'), []).append(info)
+            for future in futures:
+                errors = []
+                for did in future.doc_ids:
+                    errors.extend(by_id.get(did, []))
+                future.errors = errors
+        except Exception:
+            logger.exception("failed to write %d schema items", len(items))
+            exc_info = sys.exc_info()
+            for future in futures:
+                future.exc_info = exc_info
+        self.num_writes += 1
+        self.num_items += len(items)
+        for future in futures:
+            future.event.set()
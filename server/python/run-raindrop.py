@@ -39,6 +39,7 @@ from raindrop import model
 from raindrop import bootstrap
 from raindrop import pipeline
 from raindrop import opts
+from raindrop import metrics
 from raindrop import proto
 from raindrop.sync import get_conductor
 from raindrop.config import get_config, init_config
@@ -202,6 +203,12 @@ def reprocess(parser, options):
     g_pipeline.reprocess()
     print "Message pipeline has finished..."
 
+def reprocess_stale(parser, options):
+    """Reprocess the messages an older version of an extension processed.
+    Use 'process --reprocess-stale' to do this in the background."""
+    g_pipeline.reprocess_stale()
+    print "Stale items have been reprocessed..."
+
 def retry_errors(parser, options):
     """Reprocess all conversions which previously resulted in an error."""
     g_pipeline.start_retry_errors()
@@ -396,6 +403,8 @@ def main():
         assert g_pipeline is None and g_conductor is None
         g_pipeline = pipeline.Pipeline(model.get_doc_model(), options)
         g_pipeline.initialize()
+        if options.metrics_port:
+            metrics.start_http_server(options.metrics_port)
         g_conductor = get_conductor(g_pipeline)
 
         # Now process the args specified.